@@ -0,0 +1,58 @@
+"""Add indexes for hot annotation queries
+
+Databases created by `db.create_all()` with the current models already have
+these indexes, so every index is created only if it does not exist.
+
+Revision ID: 3c9e4f1a2b7d
+Revises:
+Create Date: 2026-10-19 16:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9e4f1a2b7d'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+# (table, index, columns, partial index condition for sqlite and postgresql)
+INDEXES = [
+    ('node', 'node_lexicon_id_label_id', ['lexicon_id', 'label_id'], None),
+    ('node', 'node_label_id', ['label_id'], None),
+    ('node', 'node_deleted_updated_at', ['updated_at'],
+     ('is_deleted = 1', 'is_deleted')),
+    ('relation', 'relation_src_id', ['src_id'], None),
+    ('relation', 'relation_dst_id', ['dst_id'], None),
+    ('relation', 'relation_label_id', ['label_id'], None),
+    ('relation', 'relation_deleted_updated_at', ['updated_at'],
+     ('is_deleted = 1', 'is_deleted')),
+    ('verse', 'ix_verse_chapter_id', ['chapter_id'], None),
+    ('line', 'ix_line_verse_id', ['verse_id'], None),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table_name, index_name, columns, where in INDEXES:
+        existing_indexes = {
+            index['name'] for index in inspector.get_indexes(table_name)
+        }
+        if index_name in existing_indexes:
+            continue
+
+        kwargs = {}
+        if where is not None:
+            kwargs['sqlite_where'] = sa.text(where[0])
+            kwargs['postgresql_where'] = sa.text(where[1])
+        op.create_index(index_name, table_name, columns, **kwargs)
+
+
+def downgrade():
+    # ix_verse_chapter_id and ix_line_verse_id predate this revision
+    for table_name, index_name, columns, where in INDEXES:
+        if index_name.startswith('ix_'):
+            continue
+        op.drop_index(index_name, table_name=table_name)
@@ -0,0 +1,93 @@
+"""Add denormalised chapter_id and corpus_id to lines and annotations
+
+Columns are added only if they do not exist (databases created by
+`db.create_all()` with the current models already have them), and then
+backfilled for the rows where they are not set.
+
+Revision ID: 7a1d2e5c9f30
+Revises: 3c9e4f1a2b7d
+Create Date: 2026-10-19 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a1d2e5c9f30'
+down_revision = '3c9e4f1a2b7d'
+branch_labels = None
+depends_on = None
+
+# (table, indexed)
+TABLES = [
+    ('line', True),
+    ('node', True),
+    ('relation', True),
+    ('node_archive', False),
+    ('relation_archive', False),
+]
+COLUMNS = ['chapter_id', 'corpus_id']
+
+# Line gets its IDs from the verse (and chapter), the rest from the line
+BACKFILL = [
+    """
+    UPDATE line SET chapter_id = (
+        SELECT verse.chapter_id FROM verse WHERE verse.id = line.verse_id
+    ) WHERE chapter_id IS NULL
+    """,
+    """
+    UPDATE line SET corpus_id = (
+        SELECT chapter.corpus_id FROM chapter
+        WHERE chapter.id = line.chapter_id
+    ) WHERE corpus_id IS NULL
+    """,
+] + [
+    f"""
+    UPDATE {table_name} SET {column_name} = (
+        SELECT line.{column_name} FROM line
+        WHERE line.id = {table_name}.line_id
+    ) WHERE {column_name} IS NULL
+    """
+    for table_name, _ in TABLES[1:]
+    for column_name in COLUMNS
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    existing_tables = inspector.get_table_names()
+    for table_name, indexed in TABLES:
+        if table_name not in existing_tables:
+            continue
+        existing_columns = {
+            column['name'] for column in inspector.get_columns(table_name)
+        }
+        existing_indexes = {
+            index['name'] for index in inspector.get_indexes(table_name)
+        }
+        for column_name in COLUMNS:
+            if column_name not in existing_columns:
+                op.add_column(
+                    table_name, sa.Column(column_name, sa.Integer)
+                )
+            index_name = f'ix_{table_name}_{column_name}'
+            if indexed and index_name not in existing_indexes:
+                op.create_index(index_name, table_name, [column_name])
+
+    for statement in BACKFILL:
+        table_name = statement.split()[1]
+        if table_name in existing_tables:
+            op.execute(statement)
+
+
+def downgrade():
+    # SQLite (3.35+) drops columns in place; a batch (copy-and-move) rebuild
+    # would fail on the foreign keys referring to node
+    for table_name, indexed in reversed(TABLES):
+        for column_name in COLUMNS:
+            if indexed:
+                op.drop_index(
+                    f'ix_{table_name}_{column_name}', table_name=table_name
+                )
+            op.drop_column(table_name, column_name)
@@ -0,0 +1,45 @@
+"""Add integrity report table
+
+The table is created only if it does not exist (databases created by
+`db.create_all()` with the current models already have it).
+
+Revision ID: b4e8d2a6c1f7
+Revises: 7a1d2e5c9f30
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e8d2a6c1f7'
+down_revision = '7a1d2e5c9f30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if 'integrity_issue' in inspector.get_table_names():
+        return
+
+    op.create_table(
+        'integrity_issue',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(length=32), nullable=False),
+        sa.Column('entity_type', sa.String(length=32), nullable=False),
+        sa.Column('entity_id', sa.Integer(), nullable=False),
+        sa.Column('line_id', sa.Integer(), nullable=True),
+        sa.Column('related_id', sa.Integer(), nullable=True),
+        sa.Column('detected_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(
+        'ix_integrity_issue_kind', 'integrity_issue', ['kind']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_integrity_issue_kind', table_name='integrity_issue')
+    op.drop_table('integrity_issue')
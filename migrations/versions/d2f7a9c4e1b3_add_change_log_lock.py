@@ -0,0 +1,42 @@
+"""Add change log lock table
+
+The table holds a single row, locked by the transactions appending to the
+change log (see utils/changelog.py). It is created only if it does not
+exist (databases created by `db.create_all()` with the current models
+already have it), and the row is added if it is missing.
+
+Revision ID: d2f7a9c4e1b3
+Revises: b4e8d2a6c1f7
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2f7a9c4e1b3'
+down_revision = 'b4e8d2a6c1f7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if 'change_log_lock' not in inspector.get_table_names():
+        op.create_table(
+            'change_log_lock',
+            sa.Column('id', sa.Integer(), autoincrement=False,
+                      nullable=False),
+            sa.PrimaryKeyConstraint('id')
+        )
+    lock_row = bind.execute(
+        sa.text("SELECT id FROM change_log_lock WHERE id = 1")
+    ).first()
+    if lock_row is None:
+        op.execute("INSERT INTO change_log_lock (id) VALUES (1)")
+
+
+def downgrade():
+    op.drop_table('change_log_lock')
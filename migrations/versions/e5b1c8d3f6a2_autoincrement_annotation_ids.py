@@ -0,0 +1,100 @@
+"""Use AUTOINCREMENT for node and relation IDs on SQLite
+
+Without AUTOINCREMENT, SQLite reuses the ID of the row with the largest ID
+once it is deleted, e.g. compacted into the archive, so that a new row
+could take the ID of an archived one.
+
+The tables are rebuilt (SQLite can not alter a primary key), and the
+sequence of each table is set past the largest archived ID. Other
+databases never reuse IDs, and are left as they are.
+
+Revision ID: e5b1c8d3f6a2
+Revises: d2f7a9c4e1b3
+Create Date: 2026-10-19 19:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b1c8d3f6a2'
+down_revision = 'd2f7a9c4e1b3'
+branch_labels = None
+depends_on = None
+
+# (table, archive table, partial index on the soft-deleted rows)
+TABLES = [
+    ('node', 'node_archive', 'node_deleted_updated_at'),
+    ('relation', 'relation_archive', 'relation_deleted_updated_at'),
+]
+
+
+def _uses_autoincrement(bind, table_name: str) -> bool:
+    table_sql = bind.execute(
+        sa.text("SELECT sql FROM sqlite_master "
+                "WHERE type = 'table' AND name = :name"),
+        {"name": table_name}
+    ).scalar()
+    return table_sql is not None and 'AUTOINCREMENT' in table_sql.upper()
+
+
+def _rebuild(table_name: str, index_name: str, autoincrement: bool):
+    inspector = sa.inspect(op.get_bind())
+    index_names = [
+        index['name'] for index in inspector.get_indexes(table_name)
+    ]
+    # partial indexes are not reflected with their condition, re-create
+    if index_name in index_names:
+        op.drop_index(index_name, table_name=table_name)
+    with op.batch_alter_table(
+        table_name,
+        recreate='always',
+        table_kwargs={'sqlite_autoincrement': autoincrement}
+    ):
+        pass
+    op.create_index(
+        index_name, table_name, ['updated_at'],
+        sqlite_where=sa.text('is_deleted = 1')
+    )
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+
+    table_names = sa.inspect(bind).get_table_names()
+    for table_name, archive_table_name, index_name in TABLES:
+        if table_name not in table_names:
+            continue
+        if not _uses_autoincrement(bind, table_name):
+            _rebuild(table_name, index_name, autoincrement=True)
+
+        last_id = bind.execute(
+            sa.text(f"SELECT max(id) FROM {table_name}")
+        ).scalar() or 0
+        if archive_table_name in table_names:
+            last_archived_id = bind.execute(
+                sa.text(f"SELECT max(id) FROM {archive_table_name}")
+            ).scalar() or 0
+            last_id = max(last_id, last_archived_id)
+        bind.execute(
+            sa.text("DELETE FROM sqlite_sequence WHERE name = :name"),
+            {"name": table_name}
+        )
+        bind.execute(
+            sa.text("INSERT INTO sqlite_sequence (name, seq) "
+                    "VALUES (:name, :seq)"),
+            {"name": table_name, "seq": last_id}
+        )
+
+
+def downgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'sqlite':
+        return
+
+    for table_name, _, index_name in TABLES:
+        if _uses_autoincrement(bind, table_name):
+            _rebuild(table_name, index_name, autoincrement=False)
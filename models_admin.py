@@ -11,6 +11,7 @@ from flask_admin import AdminIndexView
 from flask_admin.contrib.sqla import ModelView
 
 from constants import ROLE_OWNER
+from utils.labels import invalidate_label_map
 
 ###############################################################################
 
@@ -81,6 +82,12 @@ class UserModelView(BaseModelView):
 class LabelModelView(BaseModelView):
     column_searchable_list = ('label', 'description')
 
+    def after_model_change(self, form, model, is_created):
+        invalidate_label_map(self.model)
+
+    def after_model_delete(self, model):
+        invalidate_label_map(self.model)
+
 
 class LexiconModelView(BaseModelView):
     column_searchable_list = ('lemma', 'transliteration')
@@ -11,17 +11,18 @@ SQLAlchemy Models
 import sqlite3
 from datetime import datetime as dt
 from sqlalchemy import (Boolean, DateTime, Column, Integer, String, Text,
-                        ForeignKey, JSON, Enum, Index, event)
+                        ForeignKey, JSON, Enum, Index, event, select, text)
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.engine import Engine
 
-from flask_sqlalchemy import SQLAlchemy
 from flask_security import UserMixin, RoleMixin, SQLAlchemyUserDatastore
 from flask_security import AsaList
 from sqlalchemy.ext.mutable import MutableList
 from flask_security.forms import LoginForm, StringField, Required
 from flask_security.utils import lookup_identity
 
+from utils.routing import RoutingSQLAlchemy
+
 ###############################################################################
 # Foreign Key Support for SQLite3
 
@@ -38,7 +39,44 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
 ###############################################################################
 # Create database connection object
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+###############################################################################
+# Denormalised Chapter and Corpus IDs
+# `Line`, `Node` and `Relation` carry the chapter and corpus of their line,
+# so that they can be filtered by chapter (or corpus) without joins.
+# The values are filled at insert time (ORM as well as Core inserts) by the
+# following context-sensitive column defaults.
+
+
+def _verse_chapter_id(context):
+    verse_id = context.get_current_parameters()['verse_id']
+    return context.connection.execute(
+        select(Verse.chapter_id).where(Verse.id == verse_id)
+    ).scalar()
+
+
+def _verse_corpus_id(context):
+    verse_id = context.get_current_parameters()['verse_id']
+    return context.connection.execute(
+        select(Chapter.corpus_id).join(
+            Verse, Verse.chapter_id == Chapter.id
+        ).where(Verse.id == verse_id)
+    ).scalar()
+
+
+def _line_chapter_id(context):
+    line_id = context.get_current_parameters()['line_id']
+    return context.connection.execute(
+        select(Line.chapter_id).where(Line.id == line_id)
+    ).scalar()
+
+
+def _line_corpus_id(context):
+    line_id = context.get_current_parameters()['line_id']
+    return context.connection.execute(
+        select(Line.corpus_id).where(Line.id == line_id)
+    ).scalar()
 
 ###############################################################################
 # Corpus Database Models
@@ -54,6 +92,14 @@ class Corpus(db.Model):
     description = Column(String(255), nullable=False)
 
 
+class CorpusShard(db.Model):
+    """Corpora stored in a database of their own (see utils/sharding.py)"""
+    __tablename__ = 'corpus_shard'
+    corpus_id = Column(Integer, ForeignKey('corpus.id', ondelete='CASCADE'),
+                       primary_key=True, autoincrement=False)
+    created_at = Column(DateTime, default=dt.utcnow, nullable=False)
+
+
 class Chapter(db.Model):
     id = Column(Integer, primary_key=True)
     corpus_id = Column(Integer, ForeignKey('corpus.id', ondelete='CASCADE'),
@@ -78,6 +124,8 @@ class Line(db.Model):
     id = Column(Integer, primary_key=True)
     verse_id = Column(Integer, ForeignKey('verse.id', ondelete='CASCADE'),
                       nullable=False, index=True)
+    chapter_id = Column(Integer, default=_verse_chapter_id, index=True)
+    corpus_id = Column(Integer, default=_verse_corpus_id, index=True)
     text = Column(Text, nullable=False)
     split = Column(Text, nullable=False)
 
@@ -201,6 +249,8 @@ class ActionLabel(db.Model):
 class Node(db.Model):
     id = Column(Integer, primary_key=True)
     line_id = Column(Integer, ForeignKey('line.id'), nullable=False)
+    chapter_id = Column(Integer, default=_line_chapter_id, index=True)
+    corpus_id = Column(Integer, default=_line_corpus_id, index=True)
     annotator_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     lexicon_id = Column(Integer, ForeignKey('lexicon.id'), nullable=False)
     label_id = Column(Integer, ForeignKey('node_label.id'), nullable=False)
@@ -216,12 +266,22 @@ class Node(db.Model):
         Index('node_line_id_annotator_id_lexicon_id_label_id',
               'line_id', 'annotator_id', 'lexicon_id', 'label_id',
               unique=True),
+        Index('node_lexicon_id_label_id', 'lexicon_id', 'label_id'),
+        Index('node_label_id', 'label_id'),
+        # Partial index: only the (few) soft-deleted rows, for compaction
+        Index('node_deleted_updated_at', 'updated_at',
+              sqlite_where=text('is_deleted = 1'),
+              postgresql_where=text('is_deleted')),
+        # Never reuse IDs (e.g. of compacted rows) on SQLite
+        {'sqlite_autoincrement': True},
     )
 
 
 class Relation(db.Model):
     id = Column(Integer, primary_key=True)
     line_id = Column(Integer, ForeignKey('line.id'), nullable=False)
+    chapter_id = Column(Integer, default=_line_chapter_id, index=True)
+    corpus_id = Column(Integer, default=_line_corpus_id, index=True)
     annotator_id = Column(Integer, ForeignKey('user.id'), nullable=False)
     # src_id = Column(Integer, ForeignKey('lexicon.id'), nullable=False)
     # dst_id = Column(Integer, ForeignKey('lexicon.id'), nullable=False)
@@ -247,6 +307,15 @@ class Relation(db.Model):
         Index('relation_line_id_annotator_id_src_id_dst_id_label_id_detail',
               'line_id', 'annotator_id',
               'src_id', 'dst_id', 'label_id', 'detail', unique=True),
+        Index('relation_src_id', 'src_id'),
+        Index('relation_dst_id', 'dst_id'),
+        Index('relation_label_id', 'label_id'),
+        # Partial index: only the (few) soft-deleted rows, for compaction
+        Index('relation_deleted_updated_at', 'updated_at',
+              sqlite_where=text('is_deleted = 1'),
+              postgresql_where=text('is_deleted')),
+        # Never reuse IDs (e.g. of compacted rows) on SQLite
+        {'sqlite_autoincrement': True},
     )
 
 
@@ -278,6 +347,123 @@ class Action(db.Model):
     )
 
 
+###############################################################################
+# Archive (History) Models
+# Same columns as `Node` and `Relation`, used to hold compacted soft-deleted
+# annotations. There are no foreign keys, so that the IDs of referenced rows
+# are retained even if those rows are archived as well.
+
+
+class NodeArchive(db.Model):
+    __tablename__ = 'node_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    line_id = Column(Integer, nullable=False, index=True)
+    chapter_id = Column(Integer)
+    corpus_id = Column(Integer)
+    annotator_id = Column(Integer, nullable=False)
+    lexicon_id = Column(Integer, nullable=False, index=True)
+    label_id = Column(Integer, nullable=False)
+    is_deleted = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, default=dt.utcnow, nullable=False)
+
+
+class RelationArchive(db.Model):
+    __tablename__ = 'relation_archive'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    line_id = Column(Integer, nullable=False, index=True)
+    chapter_id = Column(Integer)
+    corpus_id = Column(Integer)
+    annotator_id = Column(Integer, nullable=False)
+    src_id = Column(Integer, nullable=False, index=True)
+    dst_id = Column(Integer, nullable=False, index=True)
+    label_id = Column(Integer, nullable=False)
+    detail = Column(String(255))
+    is_deleted = Column(Boolean, default=False, nullable=False)
+    updated_at = Column(DateTime)
+    archived_at = Column(DateTime, default=dt.utcnow, nullable=False)
+
+
+###############################################################################
+# Change Log
+
+
+class ChangeLog(db.Model):
+    """Append-only log of annotation changes
+
+    `id` doubles as the sequence number for consumers (AUTOINCREMENT ensures
+    that it is never reused on SQLite).
+    IDs are committed in order, as every transaction appending to the log
+    holds the lock of `ChangeLogLock` until it ends (see utils/changelog.py).
+    `before` and `after` only contain the columns that changed.
+    """
+    __tablename__ = 'change_log'
+    id = Column(Integer, primary_key=True)
+    entity_type = Column(String(32), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    operation = Column(String(32), nullable=False)
+    before = Column(JSON)
+    after = Column(JSON)
+    user_id = Column(Integer, ForeignKey('user.id'))
+    created_at = Column(DateTime, default=dt.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index('change_log_entity_type_entity_id', 'entity_type', 'entity_id'),
+        {'sqlite_autoincrement': True},
+    )
+
+
+class ChangeLogLock(db.Model):
+    """Single row, locked by the transactions appending to `ChangeLog`
+
+    Serialises the writers of the change log from their first entry until
+    their commit, so that sequence numbers become visible in order.
+    """
+    __tablename__ = 'change_log_lock'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+
+
+###############################################################################
+# Concordance Index
+# Derived from `Node`, `Line` and `Lexicon` (see utils/concordance.py).
+# `start` and `end` are character offsets of the lemma in `Line.text`,
+# NULL if the lemma could not be located in the line.
+
+
+class Concordance(db.Model):
+    id = Column(Integer, primary_key=True)
+    lexicon_id = Column(Integer, ForeignKey('lexicon.id', ondelete='CASCADE'),
+                        nullable=False)
+    line_id = Column(Integer, ForeignKey('line.id', ondelete='CASCADE'),
+                     nullable=False, index=True)
+    verse_id = Column(Integer, nullable=False)
+    chapter_id = Column(Integer, nullable=False)
+    start = Column(Integer)
+    end = Column(Integer)
+
+    __table_args__ = (
+        Index('concordance_lexicon_id_chapter_id_verse_id_line_id',
+              'lexicon_id', 'chapter_id', 'verse_id', 'line_id'),
+    )
+
+
+###############################################################################
+# Integrity Report
+# Written by the integrity sweeper (see utils/integrity.py) and replaced on
+# every sweep. `related_id` is the other node involved in the issue, i.e.
+# the offending endpoint of a relation, or the node a duplicate duplicates.
+
+
+class IntegrityIssue(db.Model):
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(32), nullable=False, index=True)
+    entity_type = Column(String(32), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    line_id = Column(Integer)
+    related_id = Column(Integer)
+    detected_at = Column(DateTime, default=dt.utcnow, nullable=False)
+
+
 ###############################################################################
 # Setup Flask-Security
 
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark Graph Query Result Conversion
+
+Time taken by `Graph.convert_result()` to turn synthetic Cypher result rows
+into matches, nodes and edges (no Neo4j server is required).
+
+Every row holds a source node, a relationship, a target node and a path
+through them, nested in a list, i.e. the shape of
+`MATCH p=(s)-[r]->(t) RETURN s, r, t, [p]`. Entities recur across rows,
+as they do in real results.
+
+The previous implementation (a set union per row) is timed as well, for
+result sets up to `--legacy-limit` rows, and its output is compared with
+the current one.
+
+Usage: python3 scripts/benchmark_graph.py [--sizes 1000 10000 50000] ...
+(from the application directory)
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import sys
+import time
+import random
+import argparse
+from pathlib import Path
+
+from py2neo.data import Node, Relationship, Path as GraphPath
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Local
+from utils.graph import Graph, find_entity_type  # noqa: E402
+
+###############################################################################
+
+RELATION_TYPES = [Relationship.type(f"REL_{idx}") for idx in range(5)]
+
+###############################################################################
+
+
+def make_rows(size: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    node_count = max(size // 2, 2)
+    nodes = []
+    for identity in range(node_count):
+        node = Node("Entity", lemma=f"lemma_{identity}", line_id=identity)
+        node.identity = identity
+        nodes.append(node)
+
+    relationships = {}
+    rows = []
+    for _ in range(size):
+        source, target = rng.sample(nodes, 2)
+        relation_type = rng.choice(RELATION_TYPES)
+        key = (source.identity, relation_type, target.identity)
+        if key not in relationships:
+            relationship = relation_type(source, target, annotator_id=1)
+            relationship.identity = len(relationships)
+            relationships[key] = relationship
+        relationship = relationships[key]
+        rows.append({
+            "s": source,
+            "r": relationship,
+            "t": target,
+            "p": [GraphPath(source, relationship, target)],
+        })
+    return rows
+
+
+def legacy_convert_result(graph: Graph, matches: list):
+    """Conversion as done before (a set union per row)"""
+    nodes = set()
+    edges = set()
+    for match in matches:
+        nodes = nodes.union(find_entity_type(match.values(), Node))
+        edges = edges.union(find_entity_type(match.values(), Relationship))
+
+    final_nodes = {
+        graph.repr_entity(node): graph.format_node(node) for node in nodes
+    }
+    final_edges = {
+        graph.repr_entity(edge): graph.format_edge(edge) for edge in edges
+    }
+    final_matches = [
+        {graph.repr_entity(k): graph.repr_entity(v) for k, v in match.items()}
+        for match in matches
+    ]
+    return final_matches, final_nodes, final_edges
+
+
+def timed(function, *args) -> tuple:
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+###############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark graph query result conversion"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 2500, 5000, 10000, 25000, 50000],
+                        help="Number of result rows")
+    parser.add_argument("--legacy-limit", type=int, default=10000,
+                        help="Largest result to time the old conversion on")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Conversion only, no connection
+    graph = Graph.__new__(Graph)
+
+    print(f"{'rows':>8} {'nodes':>8} {'edges':>8} "
+          f"{'current (s)':>12} {'legacy (s)':>12}")
+    for size in args.sizes:
+        rows = make_rows(size, seed=args.seed)
+        current_time, result = timed(graph.convert_result, rows)
+        _, nodes, edges = result
+
+        legacy = "-"
+        if size <= args.legacy_limit:
+            legacy_time, legacy_result = timed(
+                legacy_convert_result, graph, rows
+            )
+            if legacy_result != result:
+                raise RuntimeError(f"Results differ for {size} rows.")
+            legacy = f"{legacy_time:.3f}"
+
+        print(f"{size:>8} {len(nodes):>8} {len(edges):>8} "
+              f"{current_time:>12.3f} {legacy:>12}")
+
+
+###############################################################################
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark SQLite Profiles
+
+Concurrent annotate-plus-read throughput of a scratch SQLite database with
+the application schema, for every profile in `utils.sqlite.SQLITE_PROFILES`.
+
+* Writers insert one node annotation per transaction (as `update_entity`)
+* Readers fetch the annotations of a random chapter (as `/api/chapter`)
+
+Usage: python3 scripts/benchmark_sqlite.py [--writers 4] [--readers 8] ...
+(from the application directory)
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import os
+import sys
+import time
+import random
+import tempfile
+import argparse
+import itertools
+import threading
+from pathlib import Path
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Local
+from models_sqla import db  # noqa: E402
+from utils.sqlite import (SQLITE_PROFILES, apply_sqlite_profile,  # noqa: E402
+                          get_profile_pragmas)
+
+###############################################################################
+
+TABLES = db.metadata.tables
+
+###############################################################################
+
+
+def seed_database(engine, chapters: int, lines_per_chapter: int):
+    with engine.begin() as connection:
+        connection.execute(TABLES["corpus"].insert(), [
+            {"id": 1, "name": "Corpus", "description": "Benchmark"}
+        ])
+        connection.execute(TABLES["user"].insert(), [
+            {"id": 1, "username": "annotator", "email": "annotator@localhost",
+             "fs_uniquifier": "annotator"}
+        ])
+        connection.execute(TABLES["node_label"].insert(), [
+            {"id": 1, "label": "LABEL", "is_deleted": False}
+        ])
+        connection.execute(TABLES["chapter"].insert(), [
+            {"id": chapter_id, "corpus_id": 1, "name": f"Chapter {chapter_id}",
+             "description": ""}
+            for chapter_id in range(1, chapters + 1)
+        ])
+        connection.execute(TABLES["verse"].insert(), [
+            {"id": chapter_id, "chapter_id": chapter_id}
+            for chapter_id in range(1, chapters + 1)
+        ])
+        connection.execute(TABLES["line"].insert(), [
+            {"verse_id": chapter_id, "text": f"line {idx}", "split": ""}
+            for chapter_id in range(1, chapters + 1)
+            for idx in range(lines_per_chapter)
+        ])
+
+
+def run_benchmark(
+    engine,
+    writers: int,
+    readers: int,
+    duration: float,
+    chapters: int,
+    lines_per_chapter: int,
+) -> dict:
+    node = TABLES["node"]
+    line = TABLES["line"]
+    verse = TABLES["verse"]
+    lexicon = TABLES["lexicon"]
+
+    line_count = chapters * lines_per_chapter
+    counter = itertools.count(1)
+    counter_lock = threading.Lock()
+    stop = threading.Event()
+    result = {"writes": 0, "reads": 0, "errors": 0}
+    result_lock = threading.Lock()
+
+    def record(key):
+        with result_lock:
+            result[key] += 1
+
+    def write():
+        while not stop.is_set():
+            with counter_lock:
+                idx = next(counter)
+            try:
+                with engine.begin() as connection:
+                    lexicon_id = connection.execute(
+                        lexicon.insert().values(lemma=f"lemma_{idx}")
+                    ).inserted_primary_key[0]
+                    connection.execute(node.insert().values(
+                        line_id=(idx % line_count) + 1,
+                        annotator_id=1,
+                        lexicon_id=lexicon_id,
+                        label_id=1,
+                        is_deleted=False
+                    ))
+            except OperationalError:
+                record("errors")
+            else:
+                record("writes")
+
+    def read():
+        query = select(node.c.id, node.c.lexicon_id, line.c.text).join(
+            line, line.c.id == node.c.line_id
+        ).join(
+            verse, verse.c.id == line.c.verse_id
+        )
+        while not stop.is_set():
+            chapter_id = random.randint(1, chapters)
+            try:
+                with engine.connect() as connection:
+                    connection.execute(
+                        query.where(verse.c.chapter_id == chapter_id)
+                    ).all()
+            except OperationalError:
+                record("errors")
+            else:
+                record("reads")
+
+    threads = [
+        threading.Thread(target=write) for _ in range(writers)
+    ] + [
+        threading.Thread(target=read) for _ in range(readers)
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    return {
+        "writes_per_second": result["writes"] / duration,
+        "reads_per_second": result["reads"] / duration,
+        "errors": result["errors"],
+    }
+
+###############################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SQLite profiles")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="Seconds per profile")
+    parser.add_argument("--chapters", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=500,
+                        help="Lines per chapter")
+    parser.add_argument("--profiles", nargs="+",
+                        default=list(SQLITE_PROFILES),
+                        choices=list(SQLITE_PROFILES))
+    args = parser.parse_args()
+
+    print(f"{args.writers} writers, {args.readers} readers, "
+          f"{args.duration}s per profile")
+    print(f"{'profile':<12} {'writes/s':>10} {'reads/s':>10} {'errors':>8}")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for profile in args.profiles:
+            database_path = os.path.join(temp_dir, f"{profile}.db")
+            engine = create_engine(f"sqlite:///{database_path}")
+            apply_sqlite_profile(
+                engine, get_profile_pragmas(profile), optimize=False
+            )
+            db.metadata.create_all(engine)
+            seed_database(engine, args.chapters, args.lines)
+
+            result = run_benchmark(
+                engine, args.writers, args.readers, args.duration,
+                args.chapters, args.lines
+            )
+            engine.dispose()
+            print(f"{profile:<12} {result['writes_per_second']:>10.1f} "
+                  f"{result['reads_per_second']:>10.1f} "
+                  f"{result['errors']:>8}")
+
+
+###############################################################################
+
+if __name__ == '__main__':
+    main()
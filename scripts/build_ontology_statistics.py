@@ -62,10 +62,14 @@ def get_ontology_statistics():
         "destination_node_relation": defaultdict(Counter),
     }
 
+    chapter_names = {
+        chapter.id: chapter.name for chapter in Chapter.query.all()
+    }
+
     for node in Node.query.filter(
         Node.is_deleted == False
     ):
-        chapter_name = node.line.verse.chapter.name
+        chapter_name = chapter_names[node.chapter_id]
         node_label = node.label.label
         stats["chapter_node"]["total"][node_label] += 1
         stats["chapter_node"][chapter_name][node_label] += 1
@@ -74,7 +78,7 @@ def get_ontology_statistics():
     for relation in Relation.query.filter(
         Relation.is_deleted == False
     ):
-        chapter_name = relation.line.verse.chapter.name
+        chapter_name = chapter_names[relation.chapter_id]
         relation_label = relation.label.label
         src_label = relation.src_node.label.label
         dst_label = relation.dst_node.label.label
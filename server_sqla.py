@@ -39,13 +39,16 @@ import glob
 import json
 import logging
 import datetime
+import threading
 import io
 import zipfile
+from typing import Dict, Iterable
 
 import git
+import click
 import requests
 from flask import (Flask, render_template, redirect, jsonify, url_for,
-                   request, flash, session, Response, abort)
+                   request, flash, session, Response, abort, g)
 from flask_security import (Security, RegisterForm,
                             auth_required, permissions_required,
                             hash_password, current_user,
@@ -64,8 +67,6 @@ from flask_wtf import CSRFProtect
 from flask_mail import Mail
 from flask_migrate import Migrate
 
-from indic_transliteration.sanscript import transliterate
-
 from constants import (
     ROLE_OWNER,
     ROLE_ADMIN,
@@ -91,7 +92,7 @@ from constants import (
 
 from models_sqla import (db, user_datastore, User,
                          CustomLoginForm,
-                         Corpus, Chapter, Verse, Line, Analysis,
+                         Corpus, Chapter, Line, Analysis,
                          Lexicon, NodeLabel, Node,
                          RelationLabel, Relation,
                          ActionLabel, ActorLabel, Action)
@@ -106,11 +107,64 @@ from utils.database import (
     get_chapter_data,
     build_graph
 )
-from utils.graph import Graph
+from utils.graph import Graph, GraphConnectionManager, GraphUnavailable
 from utils.property_graph import PropertyGraph
 from utils.query import load_queries
 from utils.cypher_utils import graph_to_cypher
 from utils.plaintext import Tokenizer
+from utils.changelog import (
+    snapshot,
+    log_object_change,
+    log_object_changes,
+    read_changes,
+    get_last_sequence,
+    ENTITY_MODELS,
+)
+from utils.archive import compact_annotations, restore_node, restore_relation
+from utils.backup import backup_database, restore_database
+from utils.concordance import (
+    build_concordance,
+    refresh_concordance,
+    refresh_lexicon_concordance,
+    get_concordance
+)
+from utils.agreement import get_agreement
+from utils.importer import (
+    import_annotations,
+    read_annotations_csv
+)
+from utils.bulk import fetch_in, resolve_lexicons
+from utils.routing import set_bind, reset_bind, read_only, read_only_engine
+from utils.sharding import shards
+from utils.sqlite import apply_sqlite_profile, get_profile_pragmas
+from utils.index_advisor import advise_indexes
+from utils.curation import merge_nodes, merge_lexicons
+from utils.integrity import sweep_integrity, get_integrity_report, ISSUE_KINDS
+from utils.batch import apply_batch
+from utils.labels import get_label_id, invalidate_label_map
+from utils.graph_sync import (
+    sync_graph,
+    get_synced_sequence,
+    save_sync_state
+)
+from utils.graph_loader import (
+    load_graph_records,
+    iter_graph_records,
+    iter_jsonl_records
+)
+from utils.query_cache import query_cache
+from utils.cypher_engine import embedded_graph, CypherError
+from utils.query_jobs import (
+    query_jobs,
+    QueryJob,
+    QueryJobError,
+    STATUS_DONE,
+)
+from utils.query_cursors import query_cursors, QueryCursorError
+from utils.transliteration import (
+    get_transliteration as get_cached_transliteration,
+    retransliterate_lexicon
+)
 
 ###############################################################################
 
@@ -198,6 +252,30 @@ if app.smtp_enabled:
 
 db.init_app(webapp)
 
+sqlite_pragmas = get_profile_pragmas(
+    app.sqlite['profile'], app.sqlite['pragmas']
+)
+shards.init_app(webapp, app.sharding, sqlite_pragmas=sqlite_pragmas)
+read_only_engine.init_app(webapp, app.read_only)
+query_cache.init_app(webapp, app.query_cache)
+query_jobs.init_app(webapp, app.query_jobs)
+query_cursors.init_app(webapp, app.query_cursors)
+embedded_graph.init_app(
+    webapp, app.embedded_graph,
+    build=build_graph,
+    get_version=get_last_sequence
+)
+
+with webapp.app_context():
+    apply_sqlite_profile(
+        db.engine, sqlite_pragmas,
+        optimize=app.sqlite['optimize_on_exit']
+    )
+if read_only_engine.enabled:
+    apply_sqlite_profile(
+        read_only_engine.engine, sqlite_pragmas, read_only=True
+    )
+
 csrf = CSRFProtect(webapp)
 security = Security(webapp, user_datastore, login_form=CustomLoginForm,
                     confirm_register_form=RegisterForm)
@@ -241,31 +319,155 @@ limiter = Limiter(
 ###############################################################################
 # Neo4j Graph
 
-GRAPH = None
-
 
 def connect_graph_server():
-    try:
-        return Graph(
-            server=app.neo4j['server'],
-            username=app.neo4j['username'],
-            password=app.neo4j['password']
+    return Graph(
+        server=app.neo4j['server'],
+        username=app.neo4j['username'],
+        password=app.neo4j['password'],
+        max_size=app.neo4j['pool_size']
+    )
+
+
+GRAPH_CONNECTION = GraphConnectionManager(
+    connect_graph_server,
+    pool_size=app.neo4j['pool_size'],
+    acquire_timeout=app.neo4j['acquire_timeout'],
+    check_interval=app.neo4j['check_interval'],
+    max_backoff=app.neo4j['max_backoff']
+)
+
+# Initialize Graph Connection
+GRAPH_CONNECTION.start()
+
+
+def get_graph_version(graph: Graph) -> str:
+    """Graph version, including the last change synchronised to the graph
+
+    Synchronisation may change properties only, which the counts of
+    `Graph.get_version()` do not reflect.
+    """
+    synced_sequence = get_synced_sequence(app.graph_sync['path'])
+    return f"{graph.get_version()}:{synced_sequence}"
+
+
+def run_graph_query(
+    cypher_query: str,
+    marked_query: str = None,
+    cancelled: threading.Event = None
+):
+    """Result of a Cypher query, from the query result cache if possible
+
+    If given, `marked_query` (the query text with a job marker) is sent to
+    the graph database in place of `cypher_query`.
+
+    When the graph database is not connected, the query is run by the
+    embedded graph engine (if enabled), which stops once `cancelled` is set.
+    """
+    if not GRAPH_CONNECTION.available and embedded_graph.enabled:
+        return run_embedded_query(cypher_query, cancelled)
+
+    with GRAPH_CONNECTION.session() as graph:
+        query_cache.check_version(
+            lambda: get_graph_version(graph), graph.generation
         )
-    except Exception as e:
-        logging.error(f"Graph Database connection failed. ({e})")
-        return None
+        result = query_cache.get(cypher_query)
+        if result is None:
+            result = graph.run_query(marked_query or cypher_query)
+            query_cache.put(cypher_query, result)
+    return result
+
+
+def run_embedded_query(
+    cypher_query: str,
+    cancelled: threading.Event = None
+):
+    """Result of a Cypher query, run by the embedded graph engine"""
+    # may run on a query job thread
+    with webapp.app_context():
+        engine = embedded_graph.get_engine()
+    query_cache.check_version(lambda: f"embedded:{engine.version}")
+    result = query_cache.get(cypher_query)
+    if result is None:
+        result = engine.run_query(cypher_query, cancelled=cancelled)
+        query_cache.put(cypher_query, result)
+    return result
+
+
+def terminate_graph_queries(marker: str) -> int:
+    """Terminate the running queries containing `marker`
+
+    Queries of the embedded graph engine can not be terminated, and stop
+    on their own instead (see `QueryJob.cancelled`).
+    """
+    if not GRAPH_CONNECTION.available and embedded_graph.enabled:
+        return 0
+    with GRAPH_CONNECTION.session() as graph:
+        return graph.terminate_queries(marker)
+
+
+def run_paginated_query(
+    cypher_query: str,
+    page_size: int,
+    user_id: int,
+    max_rows: int = None,
+    marked_query: str = None,
+    cancelled: threading.Event = None
+):
+    """First page of the result of a Cypher query, and its cursor
+
+    The rest of the result is held for the `query_page` action.
+    If given, `max_rows` is the LIMIT applied to the query, and a result
+    reaching it is marked as truncated.
+    """
+    result = run_graph_query(cypher_query, marked_query, cancelled)
+    truncated = max_rows is not None and len(result[0]) >= max_rows
+    (matches, nodes, edges), cursor = query_cursors.open(
+        result, page_size=page_size, user_id=user_id, truncated=truncated
+    )
+    return matches, nodes, edges, cursor
 
 
-def initialize_graph_connection():
-    """Establish graph connection if not connected already"""
-    global GRAPH
-    if GRAPH is None:
-        GRAPH = connect_graph_server()
-    return GRAPH is not None
+def set_query_result(
+    api_response: dict,
+    matches: list,
+    nodes: dict,
+    edges: dict,
+    cursor: dict = None
+):
+    """Add a query result (or a page of it, with its cursor)"""
+    api_response['success'] = True
+    api_response['matches'] = matches
+    api_response['nodes'] = nodes
+    api_response['edges'] = edges
+    api_response['message'] = (
+        f'Query executed successfully. ({len(matches)} results)'
+    )
+    if cursor is not None:
+        api_response['cursor'] = cursor
+        first = cursor['offset'] + 1 if matches else 0
+        last = cursor['offset'] + len(matches)
+        more = '+' if cursor['truncated'] else ''
+        api_response['message'] = (
+            f'Query executed successfully. '
+            f'(results {first}-{last} of {cursor["total"]}{more})'
+        )
 
 
-# Initialize Graph Connection
-initialize_graph_connection()
+def set_query_job_response(api_response: dict, job: QueryJob):
+    """Add the status (and the result, if done) of a query job"""
+    api_response['job'] = job.to_dict()
+    if job.status == STATUS_DONE:
+        set_query_result(api_response, *job.result)
+    elif not job.finished:
+        api_response['success'] = True
+        api_response['message'] = 'Query is running.'
+        api_response['style'] = 'info'
+    else:
+        api_response['success'] = False
+        api_response['message'] = job.error or f'Query {job.status}.'
+        api_response['style'] = 'error'
+
 
 ###############################################################################
 
@@ -282,14 +484,18 @@ def get_lexicon(lemma: str) -> int:
         return lexicon.id
 
 
-def create_lexicon(lemma: str, commit: bool = False) -> int:
+def get_transliteration(lemma: str) -> str:
+    """Searchable transliterations of a lemma (`Lexicon.transliteration`)"""
+    return get_cached_transliteration(
+        lemma, tuple(app.config['schemes']), app.config['unnamed_prefix']
+    )
+
+
+def create_lexicon(
+    lemma: str, commit: bool = False, user_id: int = None
+) -> int:
     """Create a new Lexicon and return its id"""
-    transliterations = [
-        f"##{transliterate(lemma, 'devanagari', scheme)}"
-        if not lemma.startswith(app.config['unnamed_prefix']) else ''
-        for scheme in app.config['schemes']
-    ]
-    transliteration = ''.join(transliterations)
+    transliteration = get_transliteration(lemma)
     lexicon = Lexicon()
     lexicon.lemma = lemma
     if transliteration:
@@ -297,23 +503,39 @@ def create_lexicon(lemma: str, commit: bool = False) -> int:
 
     try:
         db.session.add(lexicon)
+        db.session.flush()
+        log_object_change(lexicon, user_id=user_id)
     except Exception as e:
         webapp.logger.exception(e)
         db.session.rollback()
         return None
     else:
-        if not commit:
-            db.session.flush()
-        else:
+        if commit:
             db.session.commit()
         return lexicon.id
 
 
-def get_or_create_lexicon(lemma: str) -> int:
-    return get_lexicon(lemma) or create_lexicon(lemma)
+def get_or_create_lexicon(lemma: str, user_id: int = None) -> int:
+    return get_lexicon(lemma) or create_lexicon(lemma, user_id=user_id)
+
+
+def get_lexicons(lemmas: Iterable[str]) -> Dict[str, int]:
+    """Fetch ids of existing Lexicons (one query)"""
+    return dict(fetch_in([Lexicon.lemma, Lexicon.id], set(lemmas)))
 
 
-def update_lexicon(old_lemma: str, new_lemma: str) -> bool:
+def get_or_create_lexicons(
+    lemmas: Iterable[str], user_id: int = None
+) -> Dict[str, int]:
+    """Fetch ids of Lexicons, creating the missing ones in bulk"""
+    return resolve_lexicons(
+        lemmas, make_transliteration=get_transliteration, user_id=user_id
+    )
+
+
+def update_lexicon(
+    old_lemma: str, new_lemma: str, user_id: int = None
+) -> bool:
     """
     Change lemma of a lexicon entry
 
@@ -326,20 +548,18 @@ def update_lexicon(old_lemma: str, new_lemma: str) -> bool:
     such as `ROLE_CURATOR` or `ROLE_ADMIN`.
     These decisions are left out of scope of this function.
     """
-    transliterations = [
-        f"##{transliterate(new_lemma, 'devanagari', scheme)}"
-        if not new_lemma.startswith(app.config['unnamed_prefix']) else ''
-        for scheme in app.config['schemes']
-    ]
-    transliteration = ''.join(transliterations)
+    transliteration = get_transliteration(new_lemma)
     lexicon = Lexicon.query.filter(Lexicon.lemma == old_lemma).one_or_none()
     if lexicon is None:
         return False
 
     try:
+        before = snapshot(lexicon)
         lexicon.lemma = new_lemma
         lexicon.transliteration = transliteration
         db.session.add(lexicon)
+        log_object_change(lexicon, before, user_id=user_id)
+        refresh_lexicon_concordance(lexicon.id)
     except Exception as e:
         webapp.logger.exception(e)
         db.session.rollback()
@@ -351,7 +571,7 @@ def update_lexicon(old_lemma: str, new_lemma: str) -> bool:
 
 
 def update_node_label_id(
-    node_id: int, old_label_id: int, new_label_id: int
+    node_id: int, old_label_id: int, new_label_id: int, user_id: int = None
 ) -> bool:
     """
     Change node label (label_id) of a node
@@ -376,8 +596,10 @@ def update_node_label_id(
         return False
 
     try:
+        before = snapshot(node)
         node.label_id = new_label_id
         db.session.add(node)
+        log_object_change(node, before, user_id=user_id)
     except Exception as e:
         webapp.logger.exception(e)
         db.session.rollback()
@@ -392,7 +614,8 @@ def update_node_label_id(
 
 
 def update_relation_label_id(
-    relation_id: int, old_label_id: int, new_label_id: int
+    relation_id: int, old_label_id: int, new_label_id: int,
+    user_id: int = None
 ) -> bool:
     """
     Change relation label (label_id) of a relation
@@ -414,8 +637,10 @@ def update_relation_label_id(
         return False
 
     try:
+        before = snapshot(relation)
         relation.label_id = new_label_id
         db.session.add(relation)
+        log_object_change(relation, before, user_id=user_id)
     except Exception as e:
         webapp.logger.exception(e)
         db.session.rollback()
@@ -426,35 +651,41 @@ def update_relation_label_id(
     return False
 
 
-def update_node_id_in_relations(old_node_id: int, new_node_id: int) -> bool:
+def update_node_id_in_relations(
+    old_node_id: int, new_node_id: int, user_id: int = None
+) -> bool:
     """
     Change all occurrences of `old_node_id` in relations to `new_node_id`
-    """
-    old_node = Node.query.get(old_node_id)
-    new_node = Node.query.get(new_node_id)
-
-    if old_node is None or new_node is None:
-        return False
-
-    src_relations = Relation.query.filter(Relation.src_id == old_node_id).all()
-    dst_relations = Relation.query.filter(Relation.dst_id == old_node_id).all()
 
+    Relations which would become duplicates are collapsed,
+    see `utils.curation.merge_nodes()`.
+    """
     try:
-        for relation in src_relations:
-            relation.src_id = new_node_id
-            db.session.add(relation)
-
-        for relation in dst_relations:
-            relation.dst_id = new_node_id
-            db.session.add(relation)
+        merge_nodes(
+            old_node_id, new_node_id, delete_node=False, user_id=user_id
+        )
+    except ValueError:
+        return False
     except Exception as e:
         webapp.logger.exception(e)
-        db.session.rollback()
+        return False
     else:
-        db.session.commit()
         return True
 
 
+def get_corpus_list():
+    """List of corpora with their chapters (from their respective shards)"""
+    corpus_list = []
+    for corpus in Corpus.query.all():
+        with shards.use_corpus(corpus.id):
+            chapters = corpus.chapters.all()
+        corpus_list.append({'id': corpus.id, 'name': corpus.name, 'chapters': [
+            {'id': chapter.id, 'name': chapter.name}
+            for chapter in chapters
+        ]})
+    return corpus_list
+
+
 ###############################################################################
 # Hooks
 
@@ -542,6 +773,21 @@ def init_database():
 
     db.session.commit()
 
+
+@webapp.before_request
+def route_to_shard():
+    """Send the statements of a request to the shard of its corpus"""
+    shard_id = shards.shard_of_request(request)
+    if shard_id is not None:
+        g.shard_token = set_bind(shards.get_engine(shard_id))
+
+
+@webapp.teardown_request
+def reset_shard(exception=None):
+    shard_token = g.pop('shard_token', None)
+    if shard_token is not None:
+        reset_bind(shard_token)
+
 ###############################################################################
 # Signals
 
@@ -718,7 +964,8 @@ def show_admin():
 
     data['filetypes'] = {
         'chapter': [FILE_TYPE_PLAINTEXT, FILE_TYPE_JSON],
-        'ontology': [FILE_TYPE_CSV, FILE_TYPE_JSON]
+        'ontology': [FILE_TYPE_CSV, FILE_TYPE_JSON],
+        'annotation': [FILE_TYPE_JSON, FILE_TYPE_CSV]
     }
 
     data['users'] = [user.username for user in user_query.all()]
@@ -730,13 +977,7 @@ def show_admin():
         if role.level < user_level
     ]
 
-    data['corpus_list'] = [
-        {'id': corpus.id, 'name': corpus.name, 'chapters': [
-            {'id': chapter.id, 'name': chapter.name}
-            for chapter in corpus.chapters.all()
-        ]}
-        for corpus in Corpus.query.all()
-    ]
+    data['corpus_list'] = get_corpus_list()
 
     admin_result = session.get('admin_result', None)
     if admin_result:
@@ -883,13 +1124,7 @@ def show_custom_page(page):
 def show_home():
     data = {}
     data['title'] = 'Home'
-    data['corpus_list'] = [
-        {'id': corpus.id, 'name': corpus.name, 'chapters': [
-            {'id': chapter.id, 'name': chapter.name}
-            for chapter in corpus.chapters.all()
-        ]}
-        for corpus in Corpus.query.all()
-    ]
+    data['corpus_list'] = get_corpus_list()
 
     return render_template('home.html', data=data)
 
@@ -899,6 +1134,7 @@ def show_home():
 
 @webapp.route("/ontology", methods=["GET"])
 @auth_required()
+@read_only()
 def get_ontology():
     ontology = {
         'node_labels': [
@@ -948,9 +1184,13 @@ def api():
             'update_node_label_id',
             'update_relation_label_id',
             'update_node_id_in_relations',
+            'update_batch',
         ],
-        ROLE_CURATOR: [],
-        ROLE_QUERIER: ['query', 'graph_query']
+        ROLE_CURATOR: ['merge_nodes', 'merge_lexicons'],
+        ROLE_QUERIER: [
+            'query', 'query_status', 'query_cancel', 'query_page',
+            'query_close', 'graph_query'
+        ]
     }
     valid_actions = [
         action for actions in role_actions.values() for action in actions
@@ -997,7 +1237,9 @@ def api():
             return jsonify(api_response)
 
         try:
-            status = update_lexicon(current_lemma, replacement_lemma)
+            status = update_lexicon(
+                current_lemma, replacement_lemma, user_id=annotator_id
+            )
             if not status:
                 api_response["success"] = False
                 api_response["message"] = "Original text not found."
@@ -1036,7 +1278,9 @@ def api():
             return jsonify(api_response)
 
         try:
-            status = update_node_label_id(node_id, old_label_id, new_label_id)
+            status = update_node_label_id(
+                node_id, old_label_id, new_label_id, user_id=annotator_id
+            )
             if not status:
                 api_response["success"] = False
                 api_response["message"] = "Failed to update."
@@ -1076,7 +1320,7 @@ def api():
 
         try:
             status = update_relation_label_id(
-                relation_id, old_label_id, new_label_id
+                relation_id, old_label_id, new_label_id, user_id=annotator_id
             )
             if not status:
                 api_response["success"] = False
@@ -1115,7 +1359,9 @@ def api():
             return jsonify(api_response)
 
         try:
-            status = update_node_id_in_relations(old_node_id, new_node_id)
+            status = update_node_id_in_relations(
+                old_node_id, new_node_id, user_id=annotator_id
+            )
             if not status:
                 api_response["success"] = False
                 api_response["message"] = "Failed to update."
@@ -1131,6 +1377,130 @@ def api():
             api_response["style"] = "error"
         return jsonify(api_response)
 
+    if action == 'merge_nodes':
+        try:
+            report = merge_nodes(
+                request.form['old_node_id'],
+                request.form['new_node_id'],
+                user_id=current_user.id
+            )
+        except ValueError as e:
+            api_response["success"] = False
+            api_response["message"] = str(e)
+            api_response["style"] = "warning"
+        except Exception as e:
+            webapp.logger.exception(e)
+            api_response["success"] = False
+            api_response["message"] = "Something went wrong."
+            api_response["style"] = "error"
+        else:
+            api_response["success"] = True
+            api_response["message"] = (
+                f"Merged node {request.form['old_node_id']} into "
+                f"{request.form['new_node_id']}: "
+                f"{report['relations_updated']} relations updated, "
+                f"{report['relations_collapsed']} duplicates collapsed."
+            )
+            api_response["style"] = "success"
+            api_response["data"] = report
+        return jsonify(api_response)
+
+    if action == 'merge_lexicons':
+        source_lemmas = [
+            lemma.strip()
+            for lemma in request.form['source_lemmas'].split('##')
+            if lemma.strip()
+        ]
+        target_lemma = request.form['target_lemma'].strip()
+
+        lexicon_ids = dict(
+            db.session.query(Lexicon.lemma, Lexicon.id).filter(
+                Lexicon.lemma.in_(source_lemmas + [target_lemma])
+            )
+        )
+        missing = [
+            lemma
+            for lemma in source_lemmas + [target_lemma]
+            if lemma not in lexicon_ids
+        ]
+        if missing:
+            api_response["success"] = False
+            api_response["message"] = (
+                f"Lemma not found: {', '.join(missing)}"
+            )
+            api_response["style"] = "warning"
+            return jsonify(api_response)
+
+        try:
+            report = merge_lexicons(
+                [lexicon_ids[lemma] for lemma in source_lemmas],
+                lexicon_ids[target_lemma],
+                user_id=current_user.id
+            )
+        except ValueError as e:
+            api_response["success"] = False
+            api_response["message"] = str(e)
+            api_response["style"] = "warning"
+        except Exception as e:
+            webapp.logger.exception(e)
+            api_response["success"] = False
+            api_response["message"] = "Something went wrong."
+            api_response["style"] = "error"
+        else:
+            api_response["success"] = True
+            api_response["message"] = (
+                f"Merged {report['lexicons_deleted']} lemmas into "
+                f"'{target_lemma}': "
+                f"{report['nodes_updated'] + report['nodes_merged']} "
+                f"nodes updated, {report['nodes_merged']} duplicates merged."
+            )
+            api_response["style"] = "success"
+            api_response["data"] = report
+        return jsonify(api_response)
+
+    # ----------------------------------------------------------------------- #
+
+    if action == 'update_batch':
+        try:
+            operations = json.loads(request.form['operations'])
+        except ValueError:
+            api_response['success'] = False
+            api_response['message'] = "Invalid operations."
+            api_response['style'] = 'warning'
+            return jsonify(api_response)
+
+        try:
+            result = apply_batch(
+                operations,
+                annotator_id=current_user.id,
+                curate=current_user.has_permission(PERMISSION_CURATE),
+                make_transliteration=get_transliteration
+            )
+        except Exception as e:
+            webapp.logger.exception(e)
+            api_response['success'] = False
+            api_response['message'] = 'Something went wrong.'
+            api_response['style'] = 'danger'
+            return jsonify(api_response)
+
+        api_response['success'] = result['success']
+        api_response['data'] = result['lines']
+        if result['success']:
+            api_response['message'] = (
+                f"Updated {len(result['lines'])} lines!"
+            )
+            api_response['style'] = 'success'
+        else:
+            api_message = [result.get('message', "No changes were made.")]
+            api_message.extend(
+                f"Line {line['line_id']}: {error}"
+                for line in result['lines']
+                for error in line['errors']
+            )
+            api_response['message'] = "<br>".join(api_message)
+            api_response['style'] = 'danger'
+        return jsonify(api_response)
+
     # ----------------------------------------------------------------------- #
 
     if action in ['update_entity', 'update_relation']:  # , 'update_action']:
@@ -1139,90 +1509,152 @@ def api():
 
         objects_to_update = []
         objects_untouched = []
+        # state of `objects_to_update` prior to the change (for change log)
+        objects_before = []
+
+        line = Line.query.get(line_id)
+        if line is None:
+            api_response['success'] = False
+            api_response['message'] = f"Invalid line '{line_id}'."
+            api_response['style'] = "warning"
+            return jsonify(api_response)
 
         # ------------------------------------------------------------------- #
 
         if action == 'update_entity':
             entities_add = request.form['entity_add'].split('##')
             entities_del = request.form['entity_delete'].split('##')
-            for entity in entities_add + entities_del:
+
+            entities = []
+            for entity in dict.fromkeys(entities_add + entities_del):
                 if '$' not in entity:
                     continue
                 parts = entity.split('$')
                 entity_lemma = parts[0]
                 entity_label = parts[1]
-                _lexicon_id = get_or_create_lexicon(entity_lemma)
 
-                label_query = NodeLabel.query.filter(
-                    NodeLabel.label == entity_label
-                )
-                _label = label_query.first()
-                if _label is None:
+                _label_id = get_label_id(NodeLabel, entity_label)
+                if _label_id is None:
                     api_response['success'] = False
                     api_response['message'] = (
                         f"Invalid node type '{entity_label}'."
                     )
                     api_response['style'] = "warning"
                     return jsonify(api_response)
-                _label_id = _label.id
-
-                node_query = Node.query.filter(and_(
-                    Node.line_id == line_id,
-                    Node.annotator_id == annotator_id,
-                    Node.lexicon_id == _lexicon_id,
-                    Node.label_id == _label_id
-                ))
-
-                # Curator can edit annotations by others
-                # i.e. (no annotator_id check)
-                if current_user.has_permission(PERMISSION_CURATE):
-                    node_query = Node.query.filter(and_(
-                        Node.line_id == line_id,
-                        Node.lexicon_id == _lexicon_id,
-                        Node.label_id == _label_id
-                    ))
-                n = node_query.first()
+                entities.append(
+                    (entity, entity_lemma, entity_label, _label_id)
+                )
+
+            # Lexicon entries are created only for the entities being added
+            lexicon_ids = get_or_create_lexicons(
+                (
+                    entity_lemma
+                    for entity, entity_lemma, _, _ in entities
+                    if entity in entities_add
+                ),
+                user_id=annotator_id
+            )
+            lexicon_ids.update(get_lexicons(
+                entity_lemma
+                for _, entity_lemma, _, _ in entities
+                if entity_lemma not in lexicon_ids
+            ))
+
+            node_query = Node.query.filter(
+                Node.line_id == line_id,
+                Node.annotator_id == annotator_id
+            )
+
+            # Curator can edit annotations by others
+            # i.e. (no annotator_id check)
+            if current_user.has_permission(PERMISSION_CURATE):
+                node_query = Node.query.filter(Node.line_id == line_id)
+
+            line_nodes = {}
+            for n in node_query.order_by(Node.id):
+                line_nodes.setdefault((n.lexicon_id, n.label_id), n)
+
+            nodes_to_delete = []
+            for entity, entity_lemma, entity_label, _label_id in entities:
+                _lexicon_id = lexicon_ids.get(entity_lemma)
+                n = line_nodes.get((_lexicon_id, _label_id))
 
                 if n is None:
                     if entity in entities_add:
                         n = Node()
                         n.line_id = line_id
                         n.annotator_id = annotator_id
+                        n.chapter_id = line.chapter_id
+                        n.corpus_id = line.corpus_id
                         n.lexicon_id = _lexicon_id
                         n.label_id = _label_id
                         objects_to_update.append(n)
+                        objects_before.append(None)
                 else:
                     if entity in entities_del:
-                        relation_query = Relation.query.filter(
-                            or_(
-                                Relation.src_id == n.id,
-                                Relation.dst_id == n.id
-                            ),
-                            Relation.is_deleted == False  # noqa
-                        )
-                        relations_with_n = relation_query.count()
-                        if relations_with_n:
-                            objects_untouched.append({
-                                "node_id": n.id,
-                                "reason": (
-                                    f"Node {n.id} "
-                                    f"({entity_lemma}::{entity_label}) "
-                                    f"used in {relations_with_n} relations."
-                                )
-                            })
-                        else:
-                            n.is_deleted = True
-                            objects_to_update.append(n)
+                        nodes_to_delete.append((n, entity_lemma, entity_label))
                     else:
+                        objects_before.append(snapshot(n))
                         n.is_deleted = False
                         objects_to_update.append(n)
 
+            if nodes_to_delete:
+                relation_counts = {n.id: 0 for n, _, _ in nodes_to_delete}
+                relation_query = db.session.query(
+                    Relation.src_id, Relation.dst_id
+                ).filter(
+                    or_(
+                        Relation.src_id.in_(relation_counts),
+                        Relation.dst_id.in_(relation_counts)
+                    ),
+                    Relation.is_deleted == False  # noqa
+                )
+                for src_id, dst_id in relation_query:
+                    for node_id in {src_id, dst_id}:
+                        if node_id in relation_counts:
+                            relation_counts[node_id] += 1
+
+            for n, entity_lemma, entity_label in nodes_to_delete:
+                relations_with_n = relation_counts[n.id]
+                if relations_with_n:
+                    objects_untouched.append({
+                        "node_id": n.id,
+                        "reason": (
+                            f"Node {n.id} "
+                            f"({entity_lemma}::{entity_label}) "
+                            f"used in {relations_with_n} relations."
+                        )
+                    })
+                else:
+                    objects_before.append(snapshot(n))
+                    n.is_deleted = True
+                    objects_to_update.append(n)
+
         # ------------------------------------------------------------------- #
 
         if action == 'update_relation':
             relations_add = request.form['relation_add'].split('##')
             relations_del = request.form['relation_delete'].split('##')
-            for relation in relations_add + relations_del:
+
+            relation_query = Relation.query.filter(
+                Relation.line_id == line_id,
+                Relation.annotator_id == annotator_id
+            )
+
+            # Curator can edit annotations by others
+            # i.e. (no annotator_id check)
+            if current_user.has_permission(PERMISSION_CURATE):
+                relation_query = Relation.query.filter(
+                    Relation.line_id == line_id
+                )
+
+            line_relations = {}
+            for r in relation_query.order_by(Relation.id):
+                line_relations.setdefault(
+                    (r.src_id, r.dst_id, r.label_id, r.detail), r
+                )
+
+            for relation in dict.fromkeys(relations_add + relations_del):
                 if '$' not in relation:
                     continue
                 parts = relation.split('$')
@@ -1251,9 +1683,6 @@ def api():
                 _dst_lemma = parts[7]
                 _dst_label = parts[8]
 
-                _src_lexicon_id = get_lexicon(_src_lemma)
-                _dst_lexicon_id = get_lexicon(_dst_lemma)
-
                 if _src_node_id is None:
                     objects_untouched.append({
                         "relation": (_src_lemma, _relation_label, _dst_lemma),
@@ -1274,38 +1703,17 @@ def api():
                     })
                     continue
 
-                label_query = RelationLabel.query.filter(
-                    RelationLabel.label == _relation_label
-                )
-                _label = label_query.first()
-                if _label is None:
+                _label_id = get_label_id(RelationLabel, _relation_label)
+                if _label_id is None:
                     objects_untouched.append({
                         "relation": (_src_lemma, _relation_label, _dst_lemma),
                         "reason": f"Invalid relation type '{_relation_label}'."
                     })
                     continue
-                _label_id = _label.id
-
-                relation_query = Relation.query.filter(and_(
-                    Relation.line_id == line_id,
-                    Relation.annotator_id == annotator_id,
-                    Relation.src_id == _src_node_id,
-                    Relation.dst_id == _dst_node_id,
-                    Relation.label_id == _label_id,
-                    Relation.detail == _detail
-                ))
-
-                # Curator can edit annotations by others
-                # i.e. (no annotator_id check)
-                if current_user.has_permission(PERMISSION_CURATE):
-                    relation_query = Relation.query.filter(and_(
-                        Relation.line_id == line_id,
-                        Relation.src_id == _src_node_id,
-                        Relation.dst_id == _dst_node_id,
-                        Relation.label_id == _label_id,
-                        Relation.detail == _detail
-                    ))
-                r = relation_query.first()
+
+                r = line_relations.get(
+                    (_src_node_id, _dst_node_id, _label_id, _detail)
+                )
 
                 if r is None:
                     if relation in relations_add:
@@ -1314,10 +1722,14 @@ def api():
                         r.annotator_id = annotator_id
                         r.src_id = _src_node_id
                         r.dst_id = _dst_node_id
+                        r.chapter_id = line.chapter_id
+                        r.corpus_id = line.corpus_id
                         r.label_id = _label_id
                         r.detail = _detail
                         objects_to_update.append(r)
+                        objects_before.append(None)
                 else:
+                    objects_before.append(snapshot(r))
                     r.is_deleted = (relation in relations_del)
                     objects_to_update.append(r)
 
@@ -1413,7 +1825,18 @@ def api():
             updated_count = len(objects_to_update)
             print(f"Total objects to update: {updated_count}")
             if objects_to_update:
-                db.session.bulk_save_objects(objects_to_update)
+                db.session.bulk_save_objects(
+                    objects_to_update, return_defaults=True
+                )
+                log_object_changes(
+                    zip(objects_to_update, objects_before),
+                    user_id=annotator_id
+                )
+                refresh_concordance(
+                    (_object.lexicon_id, _object.line_id)
+                    for _object in objects_to_update
+                    if isinstance(_object, Node)
+                )
                 db.session.commit()
                 api_response['message'] = f'Updated {updated_count} objects!'
                 api_response['style'] = 'success'
@@ -1423,6 +1846,7 @@ def api():
         except Exception as e:
             print(e)
             print(request.form)
+            db.session.rollback()
             api_response['success'] = False
             api_response['message'] = 'Something went wrong.'
             api_response['style'] = 'danger'
@@ -1431,8 +1855,7 @@ def api():
     # ----------------------------------------------------------------------- #
 
     if action == 'query':
-        initialize_graph_connection()
-        if GRAPH is None:
+        if not GRAPH_CONNECTION.available and not embedded_graph.enabled:
             api_response['success'] = False
             api_response['message'] = 'Graph Database is not connected.'
             return jsonify(api_response)
@@ -1446,8 +1869,22 @@ def api():
         pattern = r'[.,;*\s)(]'
         query_words = re.split(pattern, cypher_query.upper())
 
-        # limit handling
+        # pagination: the result is capped at `max_rows` (not `query_limit`)
+        # and served `page_size` (at most `query_limit`) rows at a time
         query_limit = app.config['query_limit']
+        paginate = bool(request.form.get('paginate'))
+        page_size = None
+        if paginate:
+            page_size = (
+                request.form.get('page_size', type=int) or
+                query_cursors.page_size
+            )
+            if query_limit > 0:
+                page_size = min(page_size, query_limit)
+            query_limit = query_cursors.max_rows
+        max_rows = None
+
+        # limit handling
         try:
             limit_index = query_words.index('LIMIT')
             limit = int(query_words[limit_index + 1])
@@ -1458,9 +1895,11 @@ def api():
                 )
                 api_response['warning'] = f'LIMIT reset to {query_limit}'
                 logging.warning(f"Limit exceeded. ({limit} > {query_limit}).")
+                max_rows = query_limit
         except ValueError:
             if query_limit > 0:
                 cypher_query = f'{cypher_query} LIMIT {query_limit}'
+                max_rows = query_limit
 
         # bad-words
         must_have = ['MATCH', 'RETURN']
@@ -1484,13 +1923,37 @@ def api():
 
         try:
             logging.debug(cypher_query)
-            matches, nodes, edges = GRAPH.run_query(cypher_query)
-            api_response['matches'] = matches
-            api_response['nodes'] = nodes
-            api_response['edges'] = edges
-            api_response['message'] = (
-                f'Query executed successfully. ({len(matches)} results)'
-            )
+
+            user_id = current_user.id
+
+            def run_query(marked_query: str = None, cancelled=None):
+                if paginate:
+                    return run_paginated_query(
+                        cypher_query, page_size, user_id,
+                        max_rows=max_rows, marked_query=marked_query,
+                        cancelled=cancelled
+                    )
+                return run_graph_query(cypher_query, marked_query, cancelled)
+
+            # Asynchronous: wait for a short budget, else return the job
+            if request.form.get('async'):
+                job = query_jobs.submit(
+                    cypher_query,
+                    run=lambda job: run_query(
+                        job.marked_query, job.cancelled
+                    ),
+                    terminate=terminate_graph_queries,
+                    user_id=user_id
+                )
+                query_jobs.wait(job)
+                set_query_job_response(api_response, job)
+                return jsonify(api_response)
+
+            set_query_result(api_response, *run_query())
+        except (GraphUnavailable, QueryJobError, CypherError) as e:
+            api_response['success'] = False
+            api_response['message'] = str(e)
+            api_response['style'] = 'error'
         except Exception as e:
             api_response['success'] = False
             api_response['message'] = f'Something went wrong. ({e})'
@@ -1498,6 +1961,42 @@ def api():
 
         return jsonify(api_response)
 
+    if action == 'query_page':
+        try:
+            page, cursor = query_cursors.fetch(
+                request.form['cursor'], user_id=current_user.id
+            )
+        except QueryCursorError as e:
+            api_response['success'] = False
+            api_response['message'] = str(e)
+            api_response['style'] = 'error'
+            return jsonify(api_response)
+
+        set_query_result(api_response, *page, cursor)
+        return jsonify(api_response)
+
+    if action == 'query_close':
+        query_cursors.close(request.form['cursor'], user_id=current_user.id)
+        api_response['message'] = 'Query result closed.'
+        return jsonify(api_response)
+
+    if action in ['query_status', 'query_cancel']:
+        job_id = request.form['job_id']
+        if action == 'query_cancel':
+            job = query_jobs.cancel(
+                job_id, terminate_graph_queries, user_id=current_user.id
+            )
+        else:
+            job = query_jobs.get(job_id, user_id=current_user.id)
+
+        if job is None:
+            api_response['success'] = False
+            api_response['message'] = 'Invalid query job.'
+            return jsonify(api_response)
+
+        set_query_job_response(api_response, job)
+        return jsonify(api_response)
+
     if action == 'graph_query':
         graph_data = json.loads(request.form['data'])
         graph = PropertyGraph()
@@ -1536,6 +2035,7 @@ def api():
 
 @webapp.route("/api/chapter/<int:chapter_id>")
 @auth_required()
+@read_only()
 def api_chapter(chapter_id):
     chapter = Chapter.query.get(chapter_id)
     if chapter is None:
@@ -1556,6 +2056,7 @@ def api_chapter(chapter_id):
 
 @webapp.route("/api/line/<int:line_id>")
 @auth_required()
+@read_only()
 def api_line(line_id):
     line = Line.query.get(line_id)
     if line is None:
@@ -1581,8 +2082,119 @@ def api_line(line_id):
 # --------------------------------------------------------------------------- #
 
 
+@webapp.route("/api/changes")
+@auth_required()
+@permissions_required(PERMISSION_VIEW_ACP)
+def api_changes():
+    """Change log reader
+
+    Consumers resume from the `cursor` returned in the previous response.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = min(request.args.get('limit', 1000, type=int), 10000)
+    entity_types = [
+        entity_type
+        for entity_type in request.args.getlist('entity')
+        if entity_type in ENTITY_MODELS
+    ]
+    return jsonify(read_changes(
+        since=since, limit=limit, entity_types=entity_types or None
+    ))
+
+# --------------------------------------------------------------------------- #
+
+
+@webapp.route("/api/agreement")
+@auth_required()
+@permissions_required(PERMISSION_VIEW_ACP)
+def api_agreement():
+    """Inter-annotator agreement (cached per data version)"""
+    refresh = 'refresh' in request.args
+    agreement = get_agreement(refresh=refresh)
+    corpus_names = dict(db.session.query(Corpus.id, Corpus.name))
+    chapters = []
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            chapters.extend(
+                db.session.query(Chapter.id, Chapter.corpus_id, Chapter.name)
+            )
+    names = {
+        'annotators': {
+            user.id: user.username
+            for user in User.query.filter(
+                User.id.in_(agreement['annotators'])
+            )
+        },
+        'chapters': {
+            chapter_id: f"{corpus_names.get(corpus_id)} - {chapter_name}"
+            for chapter_id, corpus_id, chapter_name in chapters
+        },
+        'entity': {
+            label.id: label.label for label in NodeLabel.query.all()
+        },
+        'relation': {
+            label.id: label.label for label in RelationLabel.query.all()
+        }
+    }
+    # the (cached) result is shared between requests, and is not modified
+    return jsonify({**agreement, 'names': names})
+
+# --------------------------------------------------------------------------- #
+
+
+@webapp.route("/api/integrity")
+@auth_required()
+@permissions_required(PERMISSION_VIEW_ACP)
+def api_integrity():
+    """Report of the integrity sweeper (`refresh` runs a new sweep)"""
+    if 'refresh' in request.args:
+        sweep_integrity()
+    kind = request.args.get('kind')
+    if kind is not None and kind not in ISSUE_KINDS:
+        return jsonify({'message': f"Invalid kind: '{kind}'"}), 400
+    limit = min(request.args.get('limit', 100, type=int), 10000)
+    return jsonify(get_integrity_report(kind=kind, limit=limit))
+
+# --------------------------------------------------------------------------- #
+
+
+@webapp.route("/api/query-cache")
+@auth_required()
+@permissions_required(PERMISSION_VIEW_ACP)
+def api_query_cache():
+    """Statistics of the query result cache (`clear` drops all results)"""
+    if 'clear' in request.args:
+        query_cache.clear()
+    return jsonify(query_cache.stats())
+
+# --------------------------------------------------------------------------- #
+
+
+@webapp.route("/api/concordance")
+@auth_required()
+@read_only()
+def api_concordance():
+    """Paginated KWIC listing of a lemma (by `lemma` or `lexicon_id`)"""
+    lexicon_id = request.args.get('lexicon_id', type=int)
+    lemma = request.args.get('lemma')
+    if lexicon_id is None and lemma:
+        lexicon_id = get_lexicon(lemma)
+    if lexicon_id is None:
+        return jsonify({})
+
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', 50, type=int), 500)
+    width = min(request.args.get('width', 40, type=int), 200)
+    return jsonify(get_concordance(
+        lexicon_id, page=page, per_page=per_page, width=width
+    ))
+
+# --------------------------------------------------------------------------- #
+
+
 @webapp.route("/api/suggest-node")
 @limiter.limit("60 per minute")
+@read_only()
 def suggest_node():
     # Parse q (category search starting ':')
     # e.g. Sample q values => "maz", ":SUB", "maz :SUB", ... etc.
@@ -1632,6 +2244,7 @@ def suggest_node():
 
 @webapp.route("/api/suggest-lexicon")
 @limiter.limit("60 per minute")
+@read_only()
 def suggest_lexicon():
     word = request.args.get('q')
     min_length = app.config['suggest_min_length']
@@ -1699,6 +2312,7 @@ def perform_action():
             # Data
             'corpus_add', 'chapter_add',
             'annotation_download',
+            'annotation_upload',
             'download_property_graph_csv',
             'download_property_graph_jsonl',
         ],
@@ -1946,6 +2560,7 @@ def perform_action():
 
         if status:
             db.session.commit()
+            invalidate_label_map(_model)
             flash(message, "success")
         else:
             flash(message, "info")
@@ -1963,9 +2578,12 @@ def perform_action():
             corpus.description = corpus_description
             db.session.add(corpus)
             db.session.commit()
+            if shards.enabled:
+                shards.create_shard(corpus.id)
             flash((f"Created corpus '{corpus_name}' successfully."
                    f" (ID: {corpus.id})"), "success")
-        except Exception:
+        except Exception as e:
+            webapp.logger.exception(e)
             flash("Something went wrong during corpus creation.")
         return redirect(request.referrer)
 
@@ -2081,25 +2699,23 @@ def perform_action():
         try:
             User = user_datastore.user_model
             annotator_ids = None
-            line_ids = None
-
-            if usernames:
-                annotator_ids =  [
-                    user.id
-                    for user in User.query.filter(User.username.in_(usernames))
-                ]
-            if chapters:
-                line_ids = [
-                    line.id
-                    for chapter in Chapter.query.filter(Chapter.id.in_(chapters))
-                    for verse in chapter.verses
-                    for line in verse.lines
-                ]
-
-            graph, errors = build_graph(
-                line_ids=line_ids,
-                annotator_ids=annotator_ids
-            )
+            chapter_ids = None
+
+            with read_only():
+                if usernames:
+                    annotator_ids =  [
+                        user.id
+                        for user in User.query.filter(
+                            User.username.in_(usernames)
+                        )
+                    ]
+                if chapters:
+                    chapter_ids = [int(chapter_id) for chapter_id in chapters]
+
+                graph = build_graph(
+                    chapter_ids=chapter_ids,
+                    annotator_ids=annotator_ids
+                )
 
             if file_extension == "jsonl":
                 filename = f'{file_prefix}_{request_time}.{file_extension}'
@@ -2155,103 +2771,121 @@ def perform_action():
         chapters = request.form.getlist('chapter_id')
         try:
             User = user_datastore.user_model
-            _chapters = set(str(chapter.id) for chapter in Chapter.query.all())
-            _usernames = set(user.username for user in User.query.all())
-
-            # Conditions for query-optimization
-            all_chapters = set(chapters) == _chapters
-            all_users = set(usernames) == _usernames
-            logging.info(f"{all_chapters=}, {all_users=}")
-
-            # Node and Relation Queries
-            # NOTE: 'elif' is important
-            if all_chapters and all_users:
-                # no condition
-                node_query = Node.query.filter(
-                    Node.is_deleted == False  # noqa
-                )
-                relation_query = Relation.query.filter(
-                    Relation.is_deleted == False  # noqa
-                )
-            elif all_users:
-                # only chapter condition
-                node_query = (
-                    Node.query.join(Line).join(Verse).filter(
-                        and_(
-                            Verse.chapter_id.in_(chapters),
-                            Node.is_deleted == False  # noqa
-                        )
-                    )
-                )
-                relation_query = (
-                    Relation.query.join(Line).join(Verse).filter(
-                        and_(
-                            Verse.chapter_id.in_(chapters),
-                            Relation.is_deleted == False  # noqa
-                        )
-                    )
-                )
-            elif all_chapters:
-                # only user condition
-                node_query = (
-                    Node.query.join(User).filter(
-                        and_(
-                            User.username.in_(usernames),
-                            Node.is_deleted == False  # noqa
+            with read_only():
+                _chapters = set()
+                for shard_id in shards.iter_shards():
+                    with shards.use_shard(shard_id):
+                        _chapters.update(
+                            str(chapter.id) for chapter in Chapter.query.all()
                         )
-                    )
-                )
-                relation_query = (
-                    Relation.query.join(User).filter(
-                        and_(
-                            User.username.in_(usernames),
-                            Relation.is_deleted == False  # noqa
-                        )
-                    )
-                )
-            else:
-                # both user and chapter conditions
-                node_query = (
-                    Node.query.join(User).join(Line).join(Verse).filter(
-                        and_(
-                            User.username.in_(usernames),
-                            Verse.chapter_id.in_(chapters),
-                            Node.is_deleted == False  # noqa
-                        )
-                    )
-                )
-                relation_query = (
-                    Relation.query.join(User).join(Line).join(Verse).filter(
-                        and_(
-                            User.username.in_(usernames),
-                            Verse.chapter_id.in_(chapters),
-                            Relation.is_deleted == False  # noqa
-                        )
-                    )
-                )
+                _usernames = set(user.username for user in User.query.all())
 
-            annotations = {
-                'nodes': [
-                    {
-                        'line_id': node.line_id,
-                        'annotator_id': node.annotator_id,
-                        'lemma': node.lemma.lemma,
-                        'label': node.label.label
-                    }
-                    for node in node_query.all()
-                ],
-                'relations': [
-                    {
-                        'line_id': relation.line_id,
-                        'annotator_id': relation.annotator_id,
-                        'source': relation.src_node.lemma.lemma,
-                        'relation': relation.label.label,
-                        'detail': relation.detail,
-                        'target': relation.dst_node.lemma.lemma
+                # Conditions for query-optimization
+                all_chapters = set(chapters) == _chapters
+                all_users = set(usernames) == _usernames
+                logging.info(f"{all_chapters=}, {all_users=}")
+
+                if all_chapters:
+                    shard_chapters = {
+                        shard_id: None for shard_id in shards.iter_shards()
                     }
-                    for relation in relation_query.all()
-                ]
-            }
+                else:
+                    shard_chapters = shards.partition(map(int, chapters))
+
+                annotations = {'nodes': [], 'relations': []}
+                for shard_id, chapters in shard_chapters.items():
+                    with shards.use_shard(shard_id):
+                        # Node and Relation Queries
+                        # NOTE: 'elif' is important
+                        if all_chapters and all_users:
+                            # no condition
+                            node_query = Node.query.filter(
+                                Node.is_deleted == False  # noqa
+                            )
+                            relation_query = Relation.query.filter(
+                                Relation.is_deleted == False  # noqa
+                            )
+                        elif all_users:
+                            # only chapter condition
+                            node_query = (
+                                Node.query.filter(
+                                    and_(
+                                        Node.chapter_id.in_(chapters),
+                                        Node.is_deleted == False  # noqa
+                                    )
+                                )
+                            )
+                            relation_query = (
+                                Relation.query.filter(
+                                    and_(
+                                        Relation.chapter_id.in_(chapters),
+                                        Relation.is_deleted == False  # noqa
+                                    )
+                                )
+                            )
+                        elif all_chapters:
+                            # only user condition
+                            node_query = (
+                                Node.query.join(User).filter(
+                                    and_(
+                                        User.username.in_(usernames),
+                                        Node.is_deleted == False  # noqa
+                                    )
+                                )
+                            )
+                            relation_query = (
+                                Relation.query.join(User).filter(
+                                    and_(
+                                        User.username.in_(usernames),
+                                        Relation.is_deleted == False  # noqa
+                                    )
+                                )
+                            )
+                        else:
+                            # both user and chapter conditions
+                            node_query = (
+                                Node.query.join(User).filter(
+                                    and_(
+                                        User.username.in_(usernames),
+                                        Node.chapter_id.in_(chapters),
+                                        Node.is_deleted == False  # noqa
+                                    )
+                                )
+                            )
+                            relation_query = (
+                                Relation.query.join(User).filter(
+                                    and_(
+                                        User.username.in_(usernames),
+                                        Relation.chapter_id.in_(chapters),
+                                        Relation.is_deleted == False  # noqa
+                                    )
+                                )
+                            )
+
+                        annotations['nodes'].extend(
+                            [
+                                {
+                                    'line_id': node.line_id,
+                                    'annotator_id': node.annotator_id,
+                                    'lemma': node.lemma.lemma,
+                                    'label': node.label.label
+                                }
+                                for node in node_query.all()
+                            ]
+                        )
+                        annotations['relations'].extend(
+                            [
+                                {
+                                    'line_id': relation.line_id,
+                                    'annotator_id': relation.annotator_id,
+                                    'source': relation.src_node.lemma.lemma,
+                                    'relation': relation.label.label,
+                                    'detail': relation.detail,
+                                    'target': relation.dst_node.lemma.lemma
+                                }
+                                for relation in relation_query.all()
+                            ]
+                        )
 
             filename = 'annotations.json'
             content = json.dumps(annotations, ensure_ascii=False)
@@ -2267,6 +2901,60 @@ def perform_action():
             flash("Failed to get annotations.", "error")
         return redirect(request.referrer)
 
+    # ----------------------------------------------------------------------- #
+    # Annotations Upload
+
+    if action in ["annotation_upload"]:
+        annotation_file = request.files['annotation_file']
+        upload_format = request.form['upload_format']
+        content = annotation_file.read().decode()
+        try:
+            if upload_format == FILE_TYPE_JSON["value"]:
+                annotations = json.loads(content)
+            elif upload_format == FILE_TYPE_CSV["value"]:
+                annotations = read_annotations_csv(content)
+            else:
+                flash("Invalid annotation file type.", "error")
+                return redirect(request.referrer)
+        except (json.decoder.JSONDecodeError, csv.Error) as e:
+            webapp.logger.exception(e)
+            flash("Invalid file format.", "error")
+            return redirect(request.referrer)
+
+        try:
+            report = import_annotations(
+                annotations,
+                default_annotator_id=current_user.id,
+                make_transliteration=get_transliteration,
+                user_id=current_user.id
+            )
+        except Exception as e:
+            webapp.logger.exception(e)
+            flash("Failed to import annotations.", "error")
+            return redirect(request.referrer)
+
+        errors = report["errors"]
+        flash(
+            f"Imported annotations. "
+            f"Nodes: {report['nodes']['added']} added, "
+            f"{report['nodes']['restored']} restored. "
+            f"Relations: {report['relations']['added']} added, "
+            f"{report['relations']['restored']} restored. "
+            f"({len(errors)} errors)",
+            "warning" if errors else "success"
+        )
+        if errors:
+            # NOTE: session is stored in a cookie, keep the report small
+            max_errors = 50
+            report_lines = [
+                f"{error['type']} #{error['row']}: {error['error']}"
+                for error in errors[:max_errors]
+            ]
+            if len(errors) > max_errors:
+                report_lines.append(f"... {len(errors) - max_errors} more")
+            session['admin_result'] = "\n".join(report_lines)
+        return redirect(request.referrer)
+
     # ----------------------------------------------------------------------- #
     # Update Settings
 
@@ -2304,6 +2992,316 @@ def perform_action():
     return redirect(request.referrer)
 
 ###############################################################################
+# Command Line Interface
+# $ export FLASK_APP="server:webapp"
+# $ flask <command> --help
+
+
+@webapp.cli.command("compact-annotations")
+@click.option("--days", default=30, show_default=True,
+              help="Archive rows not updated for these many days.")
+@click.option("--dry-run", is_flag=True,
+              help="Only report the number of rows to be archived.")
+def compact_annotations_command(days, dry_run):
+    """Move old soft-deleted annotations to the archive tables"""
+    result = compact_annotations(
+        older_than=datetime.timedelta(days=days),
+        dry_run=dry_run
+    )
+    prefix = "Would archive" if dry_run else "Archived"
+    click.echo(
+        f"{prefix} {result['nodes']} nodes "
+        f"and {result['relations']} relations."
+    )
+
+
+@webapp.cli.command("restore-annotation")
+@click.argument("entity_type", type=click.Choice(["node", "relation"]))
+@click.argument("entity_id", type=int)
+def restore_annotation_command(entity_type, entity_id):
+    """Restore an archived node or relation"""
+    restore = restore_node if entity_type == "node" else restore_relation
+    if restore(entity_id):
+        click.echo(f"Restored {entity_type} {entity_id}.")
+    else:
+        raise click.ClickException(
+            f"Could not restore {entity_type} {entity_id}."
+        )
+
+
+@webapp.cli.command("import-annotations")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--annotator", default=None,
+              help="Username for rows without an annotator.")
+@click.option("--dry-run", is_flag=True,
+              help="Only report what would be imported.")
+def import_annotations_command(path, annotator, dry_run):
+    """Import annotations from a JSON or CSV file (see annotation_download)"""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    if path.lower().endswith(".csv"):
+        annotations = read_annotations_csv(content)
+    else:
+        annotations = json.loads(content)
+
+    default_annotator_id = None
+    if annotator is not None:
+        user = user_datastore.find_user(username=annotator)
+        if user is None:
+            raise click.ClickException(f"User '{annotator}' does not exist.")
+        default_annotator_id = user.id
+
+    report = import_annotations(
+        annotations,
+        default_annotator_id=default_annotator_id,
+        make_transliteration=get_transliteration,
+        dry_run=dry_run
+    )
+    for annotation_type in ["nodes", "relations"]:
+        counts = ", ".join(
+            f"{count} {status}"
+            for status, count in report[annotation_type].items()
+        )
+        click.echo(f"{annotation_type}: {counts}")
+    for error in report["errors"]:
+        click.echo(f"{error['type']} #{error['row']}: {error['error']}")
+
+
+@webapp.cli.command("build-concordance")
+def build_concordance_command():
+    """Rebuild the lemma concordance index from the node annotations"""
+    row_count = build_concordance()
+    click.echo(f"Concordance index built with {row_count} rows.")
+
+
+@webapp.cli.command("backup")
+@click.argument("path", type=click.Path(file_okay=False))
+@click.option("--no-compress", is_flag=True, help="Write plain JSONL files.")
+@click.option("--batch-size", default=10000, show_default=True)
+def backup_command(path, no_compress, batch_size):
+    """Stream every table to JSONL files in PATH"""
+    manifest = backup_database(
+        db.engine, db.metadata, path,
+        compress=not no_compress,
+        batch_size=batch_size,
+        include_shards=True
+    )
+    for table in manifest["tables"]:
+        click.echo(f"{table['name']}: {table['rows']} rows")
+    for corpus_id in manifest.get("shards", []):
+        click.echo(f"shard {corpus_id}: backed up")
+
+
+@webapp.cli.command("restore")
+@click.argument("path", type=click.Path(exists=True, file_okay=False))
+@click.option("--database-uri", default=None,
+              help="Restore into this database instead of the configured one.")
+@click.option("--batch-size", default=5000, show_default=True)
+def restore_command(path, database_uri, batch_size):
+    """Restore a backup from PATH into an empty database
+
+    Shards of the backup are restored only into the configured database.
+    """
+    engine = db.engine
+    if database_uri is not None:
+        engine = db.create_engine(database_uri, {})
+    try:
+        restored = restore_database(
+            engine, db.metadata, path, batch_size=batch_size,
+            include_shards=database_uri is None
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for table_name, row_count in restored.items():
+        click.echo(f"{table_name}: {row_count} rows")
+
+
+@webapp.cli.command("create-shard")
+@click.argument("corpus_id", type=int)
+def create_shard_command(corpus_id):
+    """Create the database shard of an (empty) corpus"""
+    if not shards.enabled:
+        raise click.ClickException("Sharding is not enabled.")
+    if Corpus.query.get(corpus_id) is None:
+        raise click.ClickException(f"Corpus {corpus_id} does not exist.")
+    if Chapter.query.filter(Chapter.corpus_id == corpus_id).first():
+        raise click.ClickException(
+            f"Corpus {corpus_id} has chapters in the main database."
+        )
+    shards.create_shard(corpus_id)
+    click.echo(f"Created shard for corpus {corpus_id}.")
+
+
+@webapp.cli.command("graph-sync")
+@click.option("--full", is_flag=True,
+              help="Replace the whole graph instead of the changes only.")
+def graph_sync_command(full):
+    """Apply the annotation changes since the last sync to the graph
+
+    A full sync (also the first one) replaces the graph in a single
+    transaction; for a large graph, use `graph-load` on an empty graph.
+    """
+    try:
+        with GRAPH_CONNECTION.session() as graph:
+            report = sync_graph(
+                graph,
+                state_path=app.graph_sync['path'],
+                full=full,
+                batch_size=app.graph_sync['batch_size']
+            )
+    except GraphUnavailable as e:
+        raise click.ClickException(str(e))
+
+    if report['statements'] == 0:
+        click.echo(f"Graph is up to date (change {report['until']}).")
+        return
+    kind = "Full" if report['full'] else "Incremental"
+    click.echo(
+        f"{kind} sync of changes {report['since']}-{report['until']}: "
+        f"{report['nodes']} nodes and {report['edges']} relationships "
+        f"written in {report['statements']} statements."
+    )
+
+
+@webapp.cli.command("graph-load")
+@click.argument("path", required=False,
+                type=click.Path(exists=True, dir_okay=False))
+@click.option("--batch-size", default=None, type=int,
+              help="Rows per statement (GRAPH_SYNC_BATCH_SIZE).")
+@click.option("--workers", default=None, type=int,
+              help="Concurrent node batches (GRAPH_LOAD_WORKERS).")
+def graph_load_command(path, batch_size, workers):
+    """Load a JSONL graph (or the database annotations) without APOC
+
+    When the annotations are loaded into an empty graph, the graph sync
+    state is set, so that `graph-sync` continues from there.
+    """
+    batch_size = batch_size or app.graph_sync['batch_size']
+    workers = workers or app.graph_sync['workers']
+    try:
+        with GRAPH_CONNECTION.session() as graph:
+            sequence = None
+            if path is not None:
+                records = iter_jsonl_records(path)
+            else:
+                if graph.graph.evaluate("MATCH (n) RETURN count(n)") == 0:
+                    sequence = get_last_sequence()
+                property_graph = build_graph()
+                records = iter_graph_records(property_graph)
+
+            report = load_graph_records(
+                graph, records, batch_size=batch_size, workers=workers
+            )
+            graph.generation += 1
+    except GraphUnavailable as e:
+        raise click.ClickException(str(e))
+
+    if sequence is not None:
+        save_sync_state(app.graph_sync['path'], {
+            'sequence': sequence,
+            'synced_at': datetime.datetime.utcnow().isoformat(),
+            'full': True,
+        })
+    click.echo(
+        f"Loaded {report['nodes']} nodes and {report['edges']} relationships "
+        f"in {report['seconds']} seconds "
+        f"({report['nodes_per_second']} nodes/s, "
+        f"{report['edges_per_second']} relationships/s, "
+        f"{report['batches']} batches)."
+    )
+    if report['skipped_edges']:
+        click.echo(f"Skipped {report['skipped_edges']} relationships "
+                   "with an unknown endpoint.")
+
+
+@webapp.cli.command("index-advisor")
+@click.option("--verbose", is_flag=True, help="Show every query plan.")
+def index_advisor_command(verbose):
+    """Report full table scans in the query plans of the main queries"""
+    try:
+        report = advise_indexes()
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    scan_count = 0
+    for item in report:
+        if item['scans']:
+            scan_count += 1
+            click.echo(f"FULL SCAN: {item['name']}")
+            for step in item['scans']:
+                click.echo(f"    {step}")
+        elif verbose:
+            click.echo(f"OK: {item['name']}")
+        if verbose:
+            for step in item['plan']:
+                click.echo(f"    | {step}")
+    click.echo(f"{scan_count} of {len(report)} queries scan entire tables.")
+
+
+@webapp.cli.command("merge-lexicons")
+@click.argument("target")
+@click.argument("sources", nargs=-1, required=True)
+def merge_lexicons_command(target, sources):
+    """Merge lexicon entries (lemmas) SOURCES into TARGET"""
+    lemmas = [target, *sources]
+    lexicon_ids = dict(
+        db.session.query(Lexicon.lemma, Lexicon.id).filter(
+            Lexicon.lemma.in_(lemmas)
+        )
+    )
+    missing = [lemma for lemma in lemmas if lemma not in lexicon_ids]
+    if missing:
+        raise click.ClickException(f"Lemma not found: {', '.join(missing)}")
+
+    try:
+        report = merge_lexicons(
+            [lexicon_ids[lemma] for lemma in sources], lexicon_ids[target]
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for key, count in report.items():
+        click.echo(f"{key}: {count}")
+
+
+@webapp.cli.command("integrity-sweep")
+@click.option("--fix", is_flag=True,
+              help="Soft-delete relations with a deleted endpoint.")
+def integrity_sweep_command(fix):
+    """Find dangling and cross-line relations, and duplicate nodes"""
+    result = sweep_integrity(fix=fix)
+    for kind in ISSUE_KINDS:
+        click.echo(f"{kind}: {result[kind]}")
+    if fix:
+        click.echo(f"Soft-deleted {result['fixed']} dangling relations.")
+
+
+@webapp.cli.command("retransliterate-lexicon")
+@click.option("--workers", default=None, type=int,
+              help="Number of worker processes.  [default: CPU count]")
+@click.option("--chunk-size", default=1000, show_default=True,
+              help="Lexicon entries per worker task.")
+@click.option("--restart", is_flag=True,
+              help="Ignore the saved progress of an interrupted run.")
+def retransliterate_lexicon_command(workers, chunk_size, restart):
+    """Recompute transliterations of all lexicon entries (resumable)"""
+    checkpoint_path = os.path.join(app.db_dir, "retransliterate.json")
+    if restart and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+    result = retransliterate_lexicon(
+        app.config['schemes'],
+        app.config['unnamed_prefix'],
+        checkpoint_path=checkpoint_path,
+        chunk_size=chunk_size,
+        workers=workers
+    )
+    if result['resumed_from']:
+        click.echo(f"Resumed after lexicon {result['resumed_from']}.")
+    click.echo(
+        f"Checked {result['checked']} lexicon entries, "
+        f"updated {result['updated']}."
+    )
+
+###############################################################################
 
 
 if __name__ == '__main__':
@@ -9,6 +9,7 @@ const KEY_ONTOLOGY_TAB_ACTIVE = "ontology_tab_active";
 const DATA_COLLAPSIBLE_PARENT_ID = "manage_data";
 const DATA_COLLAPSIBLE_DEFAULT_SHOW_ID = "corpus_container";
 const ONTOLOGY_TAB_PARENT_ID = "labels-tab";
+const AGREEMENT_RESULT_ID = "agreement_result";
 
 /* ********************************* Main ********************************* */
 
@@ -42,3 +43,55 @@ $(`#${ONTOLOGY_TAB_PARENT_ID} .ontology-tab`).on('shown.bs.tab', function (event
     const target_id = target_element.id;
     storage.setItem(KEY_ONTOLOGY_TAB_ACTIVE, target_id);
 });
+
+$("#agreement_show, #agreement_refresh").click(function () {
+    const $result = $(`#${AGREEMENT_RESULT_ID}`);
+    $result.html("Computing ...");
+    $.getJSON($(this).data("url"), function (agreement) {
+        $result.html(format_agreement(agreement));
+    }).fail(function () {
+        $result.html("Failed to compute agreement.");
+    });
+});
+
+/* ******************************* Functions ******************************* */
+
+function format_score(score) {
+    return (score === null) ? "-" : score.toFixed(3);
+}
+
+function format_agreement(agreement) {
+    const names = agreement.names;
+    const rows = [];
+    for (const annotation_type of ["entity", "relation"]) {
+        const result = agreement[annotation_type];
+        const scopes = [["Overall", result.overall]];
+        for (const [chapter_id, value] of Object.entries(result.chapters)) {
+            scopes.push([names.chapters[chapter_id] || chapter_id, value]);
+        }
+        for (const [label_id, value] of Object.entries(result.labels)) {
+            scopes.push([names[annotation_type][label_id] || label_id, value]);
+        }
+        for (const [scope, value] of scopes) {
+            const pairwise = value.pairwise.map(function (pair) {
+                const [a, b] = pair.annotators.map(
+                    (user_id) => names.annotators[user_id] || user_id
+                );
+                return `${a} / ${b}: ${format_score(pair.agreement)}`;
+            }).join("<br>");
+            rows.push(
+                `<tr><td>${annotation_type}</td><td>${scope}</td>` +
+                `<td>${value.fleiss.items}</td>` +
+                `<td>${format_score(value.fleiss.kappa)}</td>` +
+                `<td>${pairwise}</td></tr>`
+            );
+        }
+    }
+    return (
+        `<p class="text-muted">Data version: ${agreement.version}</p>` +
+        '<table class="table table-sm table-striped">' +
+        "<thead><tr><th>Type</th><th>Scope</th><th>Items</th>" +
+        "<th>Fleiss' Kappa</th><th>Pairwise Agreement</th></tr></thead>" +
+        `<tbody>${rows.join("")}</tbody></table>`
+    );
+}
@@ -208,27 +208,32 @@ function setup_network() {
 // Query
 
 
+const QUERY_POLL_INTERVAL = 1000;
+var CURRENT_QUERY_JOB = null;
+
 function run_cypher_query(cypher_query_text, response_handler) {
+    // cancel the previous query, if it is still running
+    if (CURRENT_QUERY_JOB) {
+        $.post(API_URL, {
+            action: "query_cancel",
+            job_id: CURRENT_QUERY_JOB,
+        });
+        CURRENT_QUERY_JOB = null;
+    }
     $.post(API_URL, {
         action: "query",
         query: cypher_query_text,
+        async: 1,
     },
     function (response) {
-        if (response.success) {
+        if (response.success && response.job && response.job.status != "done") {
             $.notify({
                 message: response.message
             }, {
-                type: "success"
-            });
-            response_handler(response);
-        } else {
-            console.log(response.message);
-            $.notify({
-                message: response.message
-            }, {
-                type: "danger"
+                type: "info"
             });
         }
+        handle_query_response(response, response_handler);
         if (response.warning) {
             console.log(response.warning);
             $.notify({
@@ -241,6 +246,44 @@ function run_cypher_query(cypher_query_text, response_handler) {
     'json');
 }
 
+function handle_query_response(response, response_handler) {
+    if (response.success && response.job && response.job.status != "done") {
+        // query is still running, poll for the result
+        const job_id = response.job.job_id;
+        CURRENT_QUERY_JOB = job_id;
+        setTimeout(function () {
+            if (CURRENT_QUERY_JOB != job_id) {
+                return;
+            }
+            $.post(API_URL, {
+                action: "query_status",
+                job_id: job_id,
+            },
+            function (status_response) {
+                handle_query_response(status_response, response_handler);
+            },
+            'json');
+        }, QUERY_POLL_INTERVAL);
+        return;
+    }
+    CURRENT_QUERY_JOB = null;
+    if (response.success) {
+        $.notify({
+            message: response.message
+        }, {
+            type: "success"
+        });
+        response_handler(response);
+    } else {
+        console.log(response.message);
+        $.notify({
+            message: response.message
+        }, {
+            type: "danger"
+        });
+    }
+}
+
 function process_fresh_query_response(response) {
     // Create Node and Edge datasets suitable for Vis.js Network
     prepare_network_data(response.nodes, response.edges, true);
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the embedded Cypher engine (utils/cypher_engine.py)
+
+The query templates of the examples must be parsed and executed, and so
+must the documented subset of Cypher.
+"""
+
+###############################################################################
+
+import glob
+import json
+import os
+import threading
+
+import pytest
+
+from utils.cypher_engine import (
+    CypherCancelled,
+    CypherEngine,
+    CypherError,
+    parse_query,
+)
+from utils.property_graph import PropertyGraph
+
+###############################################################################
+
+EXAMPLES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "examples"
+)
+
+# Templates which are not valid Cypher (rejected by Neo4j as well)
+INVALID_TEMPLATES = [
+    "RETURN labels(node) as entity_labels",
+    "[r3:IS_DECREASED_BY)",
+    "MATCH (node)-[relation]->(entity) WHERE n.lemma",
+]
+
+
+def _templates():
+    templates = []
+    pattern = os.path.join(EXAMPLES_DIR, "*", "query*.json")
+    for path in sorted(glob.glob(pattern)):
+        with open(path, encoding="utf-8") as f:
+            for idx, template in enumerate(json.load(f)):
+                query = template["cypher"]
+                for position in range(len(template["input"])):
+                    query = query.replace(f"{{{position}}}", "rAma")
+                name = f"{os.path.relpath(path, EXAMPLES_DIR)}:{idx}"
+                marks = []
+                if any(text in query for text in INVALID_TEMPLATES):
+                    marks.append(pytest.mark.xfail(
+                        raises=CypherError, strict=True,
+                        reason="invalid template"
+                    ))
+                templates.append(pytest.param(query, id=name, marks=marks))
+    return templates
+
+###############################################################################
+
+
+@pytest.fixture(scope="module")
+def engine():
+    graph = PropertyGraph()
+    graph.add_node(1, ["PERSON"], {"lemma": "rAma", "line_id": 1})
+    graph.add_node(2, ["PERSON"], {"lemma": "daSaraTa", "line_id": 1})
+    graph.add_node(3, ["PERSON"], {"lemma": "sItA", "line_id": 2})
+    graph.add_node(4, ["PLACE"], {"lemma": "ayoDyA", "line_id": 2})
+    graph.add_node(5, ["SUBSTANCE"], {"lemma": "Gfta", "line_id": 3})
+    graph.add_edge(2, "IS_FATHER_OF", 1, {"detail": "", "line_id": 1})
+    graph.add_edge(1, "IS_HUSBAND_OF", 3, {"detail": "", "line_id": 2})
+    graph.add_edge(1, "LIVES_IN", 4, {"detail": "", "line_id": 2})
+    graph.add_edge(2, "LIVES_IN", 4, {"detail": "", "line_id": 2})
+    graph.add_edge(1, "USES", 5, {"detail": "daily", "line_id": 3})
+    return CypherEngine(graph)
+
+
+def _values(engine, query, column):
+    return [row[column] for row in engine.execute(query)]
+
+
+def _ids(engine, query, column):
+    return sorted(value.id for value in _values(engine, query, column))
+
+###############################################################################
+
+
+@pytest.mark.parametrize("query", _templates())
+def test_template(engine, query):
+    parse_query(query)
+    matches, nodes, edges = engine.run_query(query)
+    assert isinstance(matches, list)
+    assert isinstance(nodes, dict)
+    assert isinstance(edges, dict)
+
+
+def test_templates_found():
+    assert len(_templates()) > len(INVALID_TEMPLATES)
+
+###############################################################################
+# Documented subset
+
+
+def test_labels_and_properties(engine):
+    assert _ids(engine, "MATCH (n:PERSON) RETURN n", "n") == [1, 2, 3]
+    assert _ids(engine, "MATCH (n {lemma: 'sItA'}) RETURN n", "n") == [3]
+    assert _ids(engine, "MATCH (n) WHERE n:PLACE RETURN n", "n") == [4]
+
+
+def test_relationship_types_and_directions(engine):
+    query = "MATCH (a {lemma: 'rAma'})-[r:LIVES_IN|USES]->(b) RETURN b"
+    assert _ids(engine, query, "b") == [4, 5]
+    query = "MATCH (a {lemma: 'rAma'})<-[r]-(b) RETURN b"
+    assert _ids(engine, query, "b") == [2]
+    query = "MATCH (a {lemma: 'rAma'})-[r]-(b) RETURN b"
+    assert _ids(engine, query, "b") == [2, 3, 4, 5]
+    query = "MATCH (a)-[r {detail: 'daily'}]->(b) RETURN type(r) AS t"
+    assert _values(engine, query, "t") == ["USES"]
+
+
+def test_variable_length_and_paths(engine):
+    query = "MATCH (a {lemma: 'daSaraTa'})-[*2]->(b) RETURN b"
+    assert _ids(engine, query, "b") == [3, 4, 5]
+    query = "MATCH (a {lemma: 'daSaraTa'})-[*1..2]->(b) RETURN DISTINCT b"
+    assert _ids(engine, query, "b") == [1, 3, 4, 5]
+    query = (
+        "MATCH p = (a {lemma: 'daSaraTa'})-[*..3]->(b {lemma: 'Gfta'}) "
+        "RETURN length(p) AS l, size(nodes(p)) AS n"
+    )
+    assert engine.execute(query) == [{"l": 2, "n": 3}]
+
+
+def test_relationship_used_once_per_match(engine):
+    query = "MATCH (a)-[r1]-(b)-[r2]-(c) WHERE id(a) = id(c) RETURN a"
+    assert engine.execute(query) == []
+
+
+def test_where(engine):
+    query = "MATCH (n) WHERE n.lemma =~ '[rs].*' RETURN n"
+    assert _ids(engine, query, "n") == [1, 3]
+    query = (
+        "MATCH (n) WHERE n.lemma STARTS WITH 'da' OR n.line_id > 2 RETURN n"
+    )
+    assert _ids(engine, query, "n") == [2, 5]
+    query = "MATCH (n) WHERE n.line_id IN [1, 3] AND NOT n:PERSON RETURN n"
+    assert _ids(engine, query, "n") == [5]
+    query = (
+        "MATCH (n) WHERE n.lemma CONTAINS 'yA' XOR n.line_id = 1 RETURN n"
+    )
+    assert _ids(engine, query, "n") == [1, 2, 4]
+    query = (
+        "MATCH (n) WHERE n.missing IS NULL AND n.lemma ENDS WITH 'A' "
+        "RETURN n"
+    )
+    assert _ids(engine, query, "n") == [3, 4]
+
+
+def test_return_and_aggregates(engine):
+    query = (
+        "MATCH (n) RETURN labels(n) AS label, count(n) AS count "
+        "ORDER BY count DESC, label"
+    )
+    assert engine.execute(query) == [
+        {"label": ["PERSON"], "count": 3},
+        {"label": ["PLACE"], "count": 1},
+        {"label": ["SUBSTANCE"], "count": 1},
+    ]
+    query = (
+        "MATCH (n:PERSON) RETURN min(n.line_id) AS a, max(n.line_id) AS b, "
+        "sum(n.line_id) AS c, avg(n.line_id) AS d, "
+        "collect(toUpper(n.lemma)) AS e"
+    )
+    [row] = engine.execute(query)
+    assert (row["a"], row["b"], row["c"]) == (1, 2, 4)
+    assert row["d"] == pytest.approx(4 / 3)
+    assert sorted(row["e"]) == ["DASARATA", "RAMA", "SITA"]
+
+
+def test_order_skip_limit(engine):
+    query = "MATCH (n) RETURN n.lemma AS lemma ORDER BY lemma SKIP 1 LIMIT 2"
+    assert _values(engine, query, "lemma") == ["ayoDyA", "daSaraTa"]
+
+
+def test_multiple_match_clauses(engine):
+    query = (
+        "MATCH (a)-[:IS_FATHER_OF]->(b) MATCH (b)-[:LIVES_IN]->(c) "
+        "RETURN a, c"
+    )
+    assert _ids(engine, query, "a") == [2]
+    assert _ids(engine, query, "c") == [4]
+
+
+def test_result_format(engine):
+    matches, nodes, edges = engine.run_query(
+        "MATCH (a {lemma: 'rAma'})-[r:USES]->(b) RETURN *"
+    )
+    assert len(matches) == 1
+    assert set(matches[0]) == {"a", "r", "b"}
+    assert len(nodes) == 2
+    assert len(edges) == 1
+
+
+@pytest.mark.parametrize("query", [
+    "CREATE (n) RETURN n",
+    "MATCH (n) SET n.x = 1",
+    "MATCH (n) RETURN m",
+    "MATCH (n RETURN n",
+    "MATCH (n) WITH n RETURN n",
+])
+def test_unsupported(engine, query):
+    with pytest.raises(CypherError):
+        engine.run_query(query)
+
+
+def test_cancelled(engine):
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(CypherCancelled):
+        engine.run_query("MATCH (n) RETURN n", cancelled=cancelled)
+
+###############################################################################
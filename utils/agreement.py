@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inter-Annotator Agreement
+
+Annotations are pulled in bulk and encoded as integer tuples,
+* entity: (line_id, lexicon_id, label_id)
+* relation: (line_id, src_lexicon_id, src_label_id,
+             dst_lexicon_id, dst_label_id, label_id)
+
+An annotator is considered to have rated a line if they have any live node
+or relation on that line. Every tuple annotated by anyone on a line is an
+item, which each rater of the line has either annotated or not.
+This yields a binary (present / absent) rating per (item, rater), on which,
+* Fleiss' kappa (with varying number of raters per item) and
+* pairwise positive agreement (F1 between two annotators on shared lines)
+are computed with NumPy, overall, per chapter and per label.
+
+With sharding enabled, the annotations of every shard are pulled and
+concatenated (line IDs are unique across the shards).
+
+Results are cached per data version, i.e. the last change log sequence
+(shared by all the shards), so they are recomputed only after the
+annotations change.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+import threading
+from typing import Dict, List
+
+import numpy as np
+from sqlalchemy.orm import aliased
+
+from models_sqla import db, Node, Relation
+from utils.changelog import get_last_sequence
+from utils.sharding import shards
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+###############################################################################
+
+
+def _fetch_array(query, width: int) -> np.ndarray:
+    """Rows of the query from every shard"""
+    arrays = []
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            rows = query.all()
+        if rows:
+            arrays.append(np.array(rows, dtype=np.int64))
+    if not arrays:
+        return np.empty((0, width), dtype=np.int64)
+    return np.concatenate(arrays)
+
+
+def fetch_entity_annotations() -> np.ndarray:
+    """Live node annotations as rows of
+    (chapter_id, annotator_id, line_id, lexicon_id, label_id)
+    """
+    query = db.session.query(
+        Node.chapter_id, Node.annotator_id,
+        Node.line_id, Node.lexicon_id, Node.label_id
+    ).filter(
+        Node.is_deleted == False  # noqa
+    )
+    return _fetch_array(query, 5)
+
+
+def fetch_relation_annotations() -> np.ndarray:
+    """Live relation annotations as rows of
+    (chapter_id, annotator_id, line_id, src_lexicon_id, src_label_id,
+     dst_lexicon_id, dst_label_id, label_id)
+    """
+    src_node = aliased(Node)
+    dst_node = aliased(Node)
+    query = db.session.query(
+        Relation.chapter_id, Relation.annotator_id, Relation.line_id,
+        src_node.lexicon_id, src_node.label_id,
+        dst_node.lexicon_id, dst_node.label_id,
+        Relation.label_id
+    ).join(
+        src_node, src_node.id == Relation.src_id
+    ).join(
+        dst_node, dst_node.id == Relation.dst_id
+    ).filter(
+        Relation.is_deleted == False  # noqa
+    )
+    return _fetch_array(query, 8)
+
+###############################################################################
+
+
+def encode_items(
+    annotations: np.ndarray,
+    raters: np.ndarray,
+    annotator_ids: np.ndarray
+) -> Dict[str, np.ndarray]:
+    """Encode annotations as an item x annotator rating matrix
+
+    Parameters
+    ----------
+    annotations : np.ndarray
+        Rows of (chapter_id, annotator_id, line_id, *key), where `key`
+        identifies the annotated item within the line and ends in label_id
+    raters : np.ndarray
+        Rows of (line_id, annotator_id) of annotators who rated the line
+    annotator_ids : np.ndarray
+        Sorted annotator IDs, defining the columns of the matrices
+
+    Returns
+    -------
+    dict
+        `chapters`, `labels`: chapter and label ID of every item,
+        `ratings`: bool matrix, True if the annotator annotated the item,
+        `rated`: bool matrix, True if the annotator rated the item's line
+    """
+    items, item_index = np.unique(
+        annotations[:, 2:], axis=0, return_inverse=True
+    )
+    item_index = item_index.reshape(-1)
+    annotator_index = np.searchsorted(annotator_ids, annotations[:, 1])
+
+    ratings = np.zeros((len(items), len(annotator_ids)), dtype=bool)
+    ratings[item_index, annotator_index] = True
+
+    chapters = np.zeros(len(items), dtype=np.int64)
+    chapters[item_index] = annotations[:, 0]
+
+    line_ids, line_index = np.unique(raters[:, 0], return_inverse=True)
+    line_raters = np.zeros((len(line_ids), len(annotator_ids)), dtype=bool)
+    line_raters[
+        line_index.reshape(-1), np.searchsorted(annotator_ids, raters[:, 1])
+    ] = True
+    rated = line_raters[np.searchsorted(line_ids, items[:, 0])]
+
+    return {
+        "chapters": chapters,
+        "labels": items[:, -1],
+        "ratings": ratings,
+        "rated": rated,
+    }
+
+###############################################################################
+
+
+def fleiss_kappa(ratings: np.ndarray, rated: np.ndarray) -> Dict:
+    """Fleiss' kappa for binary ratings with varying raters per item
+
+    Items rated by fewer than two annotators are ignored.
+    """
+    n = rated.sum(axis=1)
+    mask = n >= 2
+    n = n[mask]
+    positive = (ratings[mask] & rated[mask]).sum(axis=1)
+    negative = n - positive
+
+    result = {"items": int(mask.sum()), "kappa": None,
+              "observed": None, "expected": None}
+    if not len(n):
+        return result
+
+    item_agreement = (
+        positive * (positive - 1) + negative * (negative - 1)
+    ) / (n * (n - 1))
+    observed = item_agreement.mean()
+    p_positive = positive.sum() / n.sum()
+    expected = p_positive ** 2 + (1 - p_positive) ** 2
+
+    result["observed"] = float(observed)
+    result["expected"] = float(expected)
+    if expected < 1:
+        result["kappa"] = float((observed - expected) / (1 - expected))
+    return result
+
+
+def pairwise_agreement(
+    ratings: np.ndarray,
+    rated: np.ndarray,
+    annotator_ids: np.ndarray
+) -> List[Dict]:
+    """Positive agreement (F1) for every pair of annotators
+
+    Only the lines rated by both annotators of a pair are considered.
+    """
+    ratings = ratings.astype(np.int64)
+    rated = rated.astype(np.int64)
+    # common[a, b]: items annotated by both a and b
+    common = ratings.T @ ratings
+    # own[a, b]: items annotated by a on lines rated by b
+    own = ratings.T @ rated
+    shared_lines = rated.T @ rated
+
+    result = []
+    for a, b in zip(*np.triu_indices(len(annotator_ids), k=1)):
+        if not shared_lines[a, b]:
+            continue
+        total = own[a, b] + own[b, a]
+        result.append({
+            "annotators": [int(annotator_ids[a]), int(annotator_ids[b])],
+            "items": int(total - common[a, b]),
+            "agreement": float(2 * common[a, b] / total) if total else None
+        })
+    return result
+
+
+def _agreement(
+    ratings: np.ndarray,
+    rated: np.ndarray,
+    annotator_ids: np.ndarray
+) -> Dict:
+    return {
+        "fleiss": fleiss_kappa(ratings, rated),
+        "pairwise": pairwise_agreement(ratings, rated, annotator_ids)
+    }
+
+
+def _grouped_agreement(
+    groups: np.ndarray,
+    ratings: np.ndarray,
+    rated: np.ndarray,
+    annotator_ids: np.ndarray
+) -> Dict[int, Dict]:
+    order = np.argsort(groups, kind="stable")
+    group_ids, starts = np.unique(groups[order], return_index=True)
+    ends = np.append(starts[1:], len(order))
+    return {
+        int(group_id): _agreement(
+            ratings[order[start:end]], rated[order[start:end]],
+            annotator_ids
+        )
+        for group_id, start, end in zip(group_ids, starts, ends)
+    }
+
+###############################################################################
+
+
+def compute_agreement() -> Dict:
+    """Compute agreement for entities and relations
+
+    Returns
+    -------
+    dict
+        `annotators`: IDs of annotators,
+        `entity`, `relation`: each with `overall`, `chapters` (keyed by
+        chapter ID) and `labels` (keyed by label ID), where every value has
+        `fleiss` (items, kappa, observed, expected) and `pairwise`
+        (list of annotators, items and agreement)
+    """
+    annotations = {
+        "entity": fetch_entity_annotations(),
+        "relation": fetch_relation_annotations(),
+    }
+    raters = np.unique(
+        np.concatenate([
+            _annotations[:, [2, 1]] for _annotations in annotations.values()
+        ]),
+        axis=0
+    )
+    annotator_ids = np.unique(raters[:, 1])
+
+    result = {"annotators": annotator_ids.tolist()}
+    for annotation_type, _annotations in annotations.items():
+        if not len(_annotations):
+            result[annotation_type] = {
+                "overall": _agreement(
+                    np.zeros((0, len(annotator_ids)), dtype=bool),
+                    np.zeros((0, len(annotator_ids)), dtype=bool),
+                    annotator_ids
+                ),
+                "chapters": {},
+                "labels": {}
+            }
+            continue
+
+        encoded = encode_items(_annotations, raters, annotator_ids)
+        ratings = encoded["ratings"]
+        rated = encoded["rated"]
+        result[annotation_type] = {
+            "overall": _agreement(ratings, rated, annotator_ids),
+            "chapters": _grouped_agreement(
+                encoded["chapters"], ratings, rated, annotator_ids
+            ),
+            "labels": _grouped_agreement(
+                encoded["labels"], ratings, rated, annotator_ids
+            ),
+        }
+    return result
+
+
+def get_agreement(refresh: bool = False) -> Dict:
+    """Agreement for the current data version, computed if not cached
+
+    Parameters
+    ----------
+    refresh : bool, optional
+        If True, recompute even if a cached result exists.
+        The default is False.
+
+    Returns
+    -------
+    dict
+        Result of `compute_agreement()`, along with the data `version`
+    """
+    version = get_last_sequence()
+    with _CACHE_LOCK:
+        if not refresh and _CACHE.get("version") == version:
+            return _CACHE["result"]
+
+        result = compute_agreement()
+        result["version"] = version
+        _CACHE["version"] = version
+        _CACHE["result"] = result
+        LOGGER.info(f"Computed agreement for data version {version}.")
+    return result
+
+###############################################################################
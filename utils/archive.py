@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Soft-delete Compaction
+
+`Node` and `Relation` rows are never removed by the annotation interface,
+only flagged with `is_deleted`. Compaction moves old soft-deleted rows into
+the archive tables (`NodeArchive`, `RelationArchive`), which have the same
+columns, keeping the live tables (and their unique indexes) small.
+
+Relations are archived along with their endpoints, so that no live relation
+refers to an archived node. Archived rows keep their IDs, therefore the
+references between them remain intact and a row can be restored.
+
+With sharding enabled, every shard has archive tables of its own (see
+`utils.sharding`). Compaction archives the rows of every shard, in a
+transaction per shard, and a row is restored within the shard of its ID.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+from sqlalchemy import and_, delete, insert, literal, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from models_sqla import db, Node, Relation, NodeArchive, RelationArchive
+from utils.sharding import shards
+from utils.changelog import (
+    log_bulk_change,
+    ENTITY_NODE,
+    ENTITY_RELATION,
+    OPERATION_ARCHIVE,
+    OPERATION_RESTORE,
+)
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+ARCHIVE_MODELS = {
+    ENTITY_NODE: (Node, NodeArchive),
+    ENTITY_RELATION: (Relation, RelationArchive),
+}
+
+###############################################################################
+
+
+def _column_names(model) -> List[str]:
+    return [column.name for column in model.__table__.columns]
+
+
+def _move_rows(source, target, conditions: list, extra: Dict = None) -> int:
+    """Move rows matching `conditions` from `source` to `target` table
+
+    `extra` provides constant values for the columns of `target` which do
+    not exist in `source` (e.g. `archived_at`).
+    """
+    if extra is None:
+        extra = {}
+
+    names = _column_names(source)
+    source_columns = [source.__table__.c[name] for name in names]
+    extra_names = list(extra)
+    extra_values = [
+        literal(value, target.__table__.c[name].type)
+        for name, value in extra.items()
+    ]
+
+    db.session.execute(
+        insert(target).from_select(
+            names + extra_names,
+            select(*source_columns, *extra_values).where(*conditions)
+        )
+    )
+    result = db.session.execute(
+        delete(source).where(*conditions).execution_options(
+            synchronize_session=False
+        )
+    )
+    return result.rowcount
+
+###############################################################################
+
+
+def compact_annotations(
+    older_than: timedelta = timedelta(days=30),
+    user_id: int = None,
+    dry_run: bool = False
+) -> Dict[str, int]:
+    """Move old soft-deleted annotations to the archive tables
+
+    The following rows are archived, in a single transaction per shard,
+    * nodes marked deleted and not updated within `older_than`,
+    * relations marked deleted and not updated within `older_than`,
+    * relations (deleted or not) having an endpoint among the archived nodes.
+
+    Parameters
+    ----------
+    older_than : timedelta, optional
+        Only rows which have not been updated for this long are archived.
+        The default is 30 days.
+    user_id : int, optional
+        ID of the user performing compaction, for the change log.
+        The default is None.
+    dry_run : bool, optional
+        If True, only count the rows which would be archived.
+        The default is False.
+
+    Returns
+    -------
+    Dict[str, int]
+        Number of archived nodes and relations
+    """
+    now = datetime.utcnow()
+    cutoff = now - older_than
+
+    counts = {"nodes": 0, "relations": 0}
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            shard_counts = _compact_shard(now, cutoff, user_id, dry_run)
+        for key, count in shard_counts.items():
+            counts[key] += count
+
+    if not dry_run:
+        LOGGER.info(
+            f"Archived {counts['nodes']} nodes and {counts['relations']} "
+            f"relations (not updated since {cutoff})."
+        )
+    return counts
+
+
+def _compact_shard(
+    now: datetime,
+    cutoff: datetime,
+    user_id: int = None,
+    dry_run: bool = False
+) -> Dict[str, int]:
+    """Archive the rows of the current shard (see `compact_annotations()`)"""
+    node_conditions = [
+        Node.is_deleted == True,  # noqa # uses partial index
+        Node.updated_at < cutoff
+    ]
+    archived_node_ids = select(Node.id).where(*node_conditions)
+    relation_conditions = [
+        or_(
+            and_(
+                Relation.is_deleted == True,  # noqa # uses partial index
+                Relation.updated_at < cutoff
+            ),
+            Relation.src_id.in_(archived_node_ids),
+            Relation.dst_id.in_(archived_node_ids),
+        )
+    ]
+
+    if dry_run:
+        return {
+            "nodes": Node.query.filter(*node_conditions).count(),
+            "relations": Relation.query.filter(*relation_conditions).count()
+        }
+
+    try:
+        # relations first, as they refer to the nodes being archived
+        log_bulk_change(
+            ENTITY_RELATION, OPERATION_ARCHIVE,
+            select(Relation.id).where(*relation_conditions),
+            user_id=user_id
+        )
+        relation_count = _move_rows(
+            Relation, RelationArchive, relation_conditions,
+            extra={"archived_at": now}
+        )
+        log_bulk_change(
+            ENTITY_NODE, OPERATION_ARCHIVE, archived_node_ids,
+            user_id=user_id
+        )
+        node_count = _move_rows(
+            Node, NodeArchive, node_conditions,
+            extra={"archived_at": now}
+        )
+    except Exception:
+        db.session.rollback()
+        raise
+    else:
+        db.session.commit()
+    return {"nodes": node_count, "relations": relation_count}
+
+
+def archive_nodes(node_ids: List[int], user_id: int = None) -> Dict[str, int]:
+    """Move nodes to the archive tables, along with their relations
+
+    Unlike `compact_annotations()`, this only adds the statements to the
+    current session, so that it can be a part of a larger transaction.
+    Committing is the responsibility of the caller.
+
+    Returns
+    -------
+    Dict[str, int]
+        Number of archived nodes and relations
+    """
+    if not node_ids:
+        return {"nodes": 0, "relations": 0}
+
+    now = datetime.utcnow()
+    node_conditions = [Node.id.in_(node_ids)]
+    relation_conditions = [
+        or_(Relation.src_id.in_(node_ids), Relation.dst_id.in_(node_ids))
+    ]
+
+    log_bulk_change(
+        ENTITY_RELATION, OPERATION_ARCHIVE,
+        select(Relation.id).where(*relation_conditions),
+        user_id=user_id
+    )
+    relation_count = _move_rows(
+        Relation, RelationArchive, relation_conditions,
+        extra={"archived_at": now}
+    )
+    log_bulk_change(
+        ENTITY_NODE, OPERATION_ARCHIVE,
+        select(Node.id).where(*node_conditions),
+        user_id=user_id
+    )
+    node_count = _move_rows(
+        Node, NodeArchive, node_conditions,
+        extra={"archived_at": now}
+    )
+    return {"nodes": node_count, "relations": relation_count}
+
+###############################################################################
+
+
+def _restore(entity_type: str, entity_ids: List[int], user_id: int = None):
+    model, archive_model = ARCHIVE_MODELS[entity_type]
+    names = _column_names(model)
+    conditions = [archive_model.id.in_(entity_ids)]
+
+    db.session.execute(
+        insert(model).from_select(
+            names,
+            select(
+                *[archive_model.__table__.c[name] for name in names]
+            ).where(*conditions)
+        )
+    )
+    log_bulk_change(
+        entity_type, OPERATION_RESTORE,
+        select(archive_model.id).where(*conditions),
+        user_id=user_id
+    )
+    db.session.execute(
+        delete(archive_model).where(*conditions).execution_options(
+            synchronize_session=False
+        )
+    )
+
+
+def restore_node(node_id: int, user_id: int = None) -> bool:
+    """Restore an archived node
+
+    Fails if a live node with the same line, annotator, lexicon and label
+    exists (unique index on `Node`).
+
+    Returns
+    -------
+    bool
+        True if the node was restored
+    """
+    with shards.use_shard(shards.shard_of(node_id)):
+        if NodeArchive.query.get(node_id) is None:
+            return False
+
+        try:
+            _restore(ENTITY_NODE, [node_id], user_id=user_id)
+        except IntegrityError as e:
+            LOGGER.warning(f"Could not restore node {node_id}. ({e.orig})")
+            db.session.rollback()
+            return False
+        else:
+            db.session.commit()
+    return True
+
+
+def restore_relation(relation_id: int, user_id: int = None) -> bool:
+    """Restore an archived relation
+
+    Endpoints of the relation which are archived are restored as well.
+    Fails if a restored row would violate a unique index.
+
+    Returns
+    -------
+    bool
+        True if the relation was restored
+    """
+    with shards.use_shard(shards.shard_of(relation_id)):
+        relation = RelationArchive.query.get(relation_id)
+        if relation is None:
+            return False
+
+        archived_node_ids = [
+            node_id
+            for node_id, in NodeArchive.query.filter(
+                NodeArchive.id.in_([relation.src_id, relation.dst_id])
+            ).with_entities(NodeArchive.id)
+        ]
+
+        try:
+            if archived_node_ids:
+                _restore(ENTITY_NODE, archived_node_ids, user_id=user_id)
+            _restore(ENTITY_RELATION, [relation_id], user_id=user_id)
+        except IntegrityError as e:
+            LOGGER.warning(
+                f"Could not restore relation {relation_id}. ({e.orig})"
+            )
+            db.session.rollback()
+            return False
+        else:
+            db.session.commit()
+    return True
+
+###############################################################################
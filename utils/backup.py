@@ -0,0 +1,452 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Backup and Restore
+
+Backup streams every table of the database as JSON-lines, one file per table,
+in primary key order. Each line is a JSON array of the column values, in the
+order listed in `manifest.json`.
+
+Restore creates the schema in an empty database and bulk-loads the tables in
+dependency order using `executemany`, after which the sequences are moved
+past the restored IDs (including the archived IDs of nodes and relations).
+
+With sharding enabled, every shard is backed up into a directory of its own
+(`shards/<corpus_id>`), listed in the `shards` of the main manifest, and
+restored into the (new, empty) shard of the corpus after the main database.
+Every database is backed up (from a single read-only snapshot) and restored
+in a transaction of its own, so the backup of a sharded database is not a
+single snapshot across the databases: it should be taken while annotations
+are not being changed (e.g. in maintenance mode).
+
+Layout of a backup directory,
+```
+backup/
+├── manifest.json
+├── user.jsonl.gz
+├── ...
+├── relation.jsonl.gz
+└── shards/
+    └── 1/
+        ├── manifest.json
+        ├── ...
+        └── relation.jsonl.gz
+```
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import gzip
+import json
+import logging
+import time
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, List
+
+from sqlalchemy import Date, DateTime, Integer, MetaData, func, select, text
+from sqlalchemy.engine import Engine
+
+from utils.sharding import shards, shard_metadata
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+BACKUP_FORMAT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+SHARDS_DIRECTORY = "shards"
+
+# Archive tables, whose IDs must not be reused by their live tables
+ARCHIVE_TABLES = {
+    "node": "node_archive",
+    "relation": "relation_archive",
+}
+
+###############################################################################
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, tuple)):
+        return list(value)
+    raise TypeError(f"Type '{type(value).__name__}' is not serializable.")
+
+
+def _open(path: Path, mode: str):
+    if path.suffix == ".gz":
+        return gzip.open(path, f"{mode}t", encoding="utf-8", compresslevel=1)
+    return open(path, mode, encoding="utf-8")
+
+
+def _column_converter(column) -> callable:
+    """Function to convert a JSON value back to the column type"""
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat
+    if isinstance(column.type, Date):
+        return date.fromisoformat
+    return None
+
+
+def _shard_path(base_path: Path, corpus_id: int) -> Path:
+    return base_path / SHARDS_DIRECTORY / str(corpus_id)
+
+###############################################################################
+
+
+def backup_database(
+    engine: Engine,
+    metadata: MetaData,
+    path: str or Path,
+    compress: bool = True,
+    batch_size: int = 10000,
+    include_shards: bool = False
+) -> Dict:
+    """Stream every table to JSON-lines files
+
+    Parameters
+    ----------
+    engine : Engine
+        Engine of the database to backup
+    metadata : MetaData
+        Metadata containing the tables to backup (usually `db.metadata`)
+    path : str or Path
+        Backup directory. It will be created if it does not exist.
+    compress : bool, optional
+        If True, the table files are gzip-compressed.
+        The default is True.
+    batch_size : int, optional
+        Number of rows fetched from the database at a time.
+        The default is 10000.
+    include_shards : bool, optional
+        If True, every shard is backed up as well (see `shards`).
+        The default is False.
+
+    Returns
+    -------
+    Dict
+        Manifest of the backup
+    """
+    base_path = Path(path)
+    base_path.mkdir(parents=True, exist_ok=True)
+    extension = "jsonl.gz" if compress else "jsonl"
+
+    manifest = {
+        "version": BACKUP_FORMAT_VERSION,
+        "created_at": datetime.utcnow().isoformat(),
+        "dialect": engine.dialect.name,
+        "tables": []
+    }
+
+    with engine.connect() as connection:
+        if engine.dialect.name == "postgresql":
+            connection = connection.execution_options(
+                isolation_level="REPEATABLE READ", postgresql_readonly=True
+            )
+        with connection.begin():
+            if engine.dialect.name == "sqlite":
+                # the driver does not begin a transaction for SELECT, and
+                # a deferred one reads a single snapshot (in WAL mode)
+                connection.exec_driver_sql("BEGIN")
+            _backup_tables(
+                connection, metadata, base_path, extension, batch_size,
+                manifest
+            )
+
+    if include_shards:
+        manifest["shards"] = []
+        for corpus_id in shards.corpus_ids():
+            backup_database(
+                shards.get_engine(corpus_id), shard_metadata(),
+                _shard_path(base_path, corpus_id),
+                compress=compress, batch_size=batch_size
+            )
+            manifest["shards"].append(corpus_id)
+            LOGGER.info(f"Backed up the shard of corpus {corpus_id}.")
+
+    with open(base_path / MANIFEST_FILE, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def _backup_tables(
+    connection,
+    metadata: MetaData,
+    base_path: Path,
+    extension: str,
+    batch_size: int,
+    manifest: Dict
+):
+    """Stream the tables to files (see `backup_database()`)"""
+    existing_tables = set(connection.dialect.get_table_names(connection))
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            LOGGER.info(f"Skipped missing table '{table.name}'.")
+            continue
+
+        start_time = time.perf_counter()
+        table_file = f"{table.name}.{extension}"
+        query = select(table).order_by(*table.primary_key.columns)
+        result = connection.execution_options(
+            stream_results=True
+        ).execute(query)
+
+        row_count = 0
+        with _open(base_path / table_file, "w") as f:
+            for rows in result.yield_per(batch_size).partitions():
+                f.writelines(
+                    json.dumps(
+                        list(row), ensure_ascii=False,
+                        default=_json_default
+                    ) + "\n"
+                    for row in rows
+                )
+                row_count += len(rows)
+
+        manifest["tables"].append({
+            "name": table.name,
+            "file": table_file,
+            "columns": [column.name for column in table.columns],
+            "rows": row_count
+        })
+        LOGGER.info(
+            f"Backed up {row_count} rows from '{table.name}' "
+            f"in {time.perf_counter() - start_time:.2f}s."
+        )
+
+###############################################################################
+
+
+def reset_sequences(connection, tables: List) -> None:
+    """Move sequences past the largest restored IDs
+
+    IDs of archived rows (`ARCHIVE_TABLES`) must not be reused either, so
+    the sequences of their live tables are moved past the archived IDs as
+    well. SQLite tracks explicitly inserted IDs on its own, hence only
+    these sequences are moved on SQLite.
+    """
+    backend = connection.dialect.name
+    if backend not in ("postgresql", "sqlite"):
+        return
+
+    tables_by_name = {table.name: table for table in tables}
+    preparer = connection.dialect.identifier_preparer
+    for table in tables:
+        pk_columns = list(table.primary_key.columns)
+        if len(pk_columns) != 1 or not isinstance(pk_columns[0].type, Integer):
+            continue
+        archive_table = tables_by_name.get(ARCHIVE_TABLES.get(table.name))
+        if backend == "sqlite" and (
+            archive_table is None or
+            not table.dialect_options["sqlite"]["autoincrement"]
+        ):
+            continue
+
+        pk = pk_columns[0]
+        max_ids = [connection.execute(select(func.max(pk))).scalar()]
+        if archive_table is not None:
+            max_ids.append(connection.execute(
+                select(func.max(archive_table.c.id))
+            ).scalar())
+        max_ids = [max_id for max_id in max_ids if max_id is not None]
+        if not max_ids:
+            # keep the start of the sequence (e.g. the ID range of a shard)
+            continue
+
+        if backend == "sqlite":
+            last_id = connection.execute(
+                text("SELECT seq FROM main.sqlite_sequence "
+                     "WHERE name = :name"),
+                {"name": table.name}
+            ).scalar()
+            connection.execute(
+                text("DELETE FROM main.sqlite_sequence WHERE name = :name"),
+                {"name": table.name}
+            )
+            connection.execute(
+                text("INSERT INTO main.sqlite_sequence (name, seq) "
+                     "VALUES (:name, :seq)"),
+                {"name": table.name, "seq": max(max_ids + [last_id or 0])}
+            )
+            continue
+
+        sequence = connection.execute(
+            text("SELECT pg_get_serial_sequence(:table, :column)"),
+            {"table": preparer.quote(table.name), "column": pk.name}
+        ).scalar()
+        if sequence is None:
+            continue
+        connection.execute(
+            text("SELECT setval(:sequence, :value)"),
+            {"sequence": sequence, "value": max(max_ids)}
+        )
+
+
+def restore_database(
+    engine: Engine,
+    metadata: MetaData,
+    path: str or Path,
+    batch_size: int = 5000,
+    include_shards: bool = False
+) -> Dict[str, int]:
+    """Restore a backup created by `backup_database()`
+
+    The tables are created if they do not exist, and must be empty.
+    All the tables are loaded in a single transaction.
+
+    Shards of the backup are restored (after the main database) into the
+    shards of the configured sharding, which are created if needed.
+    Restoring the main database alone (e.g. into another database) skips
+    them with a warning.
+
+    Parameters
+    ----------
+    engine : Engine
+        Engine of the database to restore into
+    metadata : MetaData
+        Metadata containing the tables (usually `db.metadata`)
+    path : str or Path
+        Backup directory
+    batch_size : int, optional
+        Number of rows inserted with a single `executemany`.
+        The default is 5000.
+    include_shards : bool, optional
+        If True, the shards of the backup are restored as well.
+        The default is False.
+
+    Returns
+    -------
+    Dict[str, int]
+        Number of rows restored, keyed by table name (prefixed with
+        `shards/<corpus_id>/` for the tables of a shard)
+    """
+    base_path = Path(path)
+    with open(base_path / MANIFEST_FILE, encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    if manifest.get("version") != BACKUP_FORMAT_VERSION:
+        raise ValueError(
+            f"Unsupported backup format version: {manifest.get('version')}"
+        )
+
+    backup_shards = manifest.get("shards", [])
+    if backup_shards and include_shards and not shards.enabled:
+        raise ValueError(
+            "Backup contains shards, but sharding is not enabled."
+        )
+
+    backup_tables = {table["name"]: table for table in manifest["tables"]}
+    metadata.create_all(engine)
+
+    restored = {}
+    with engine.connect() as connection:
+        synchronous = None
+        if connection.dialect.name == "sqlite":
+            # No syncs while loading, the transaction is atomic regardless.
+            # The pragma can not be changed inside a transaction, and is
+            # reset after it, since the connection returns to the pool.
+            synchronous = connection.exec_driver_sql(
+                "PRAGMA synchronous"
+            ).scalar()
+            connection.exec_driver_sql("PRAGMA synchronous=OFF")
+        try:
+            with connection.begin():
+                _load_tables(
+                    connection, metadata, base_path, backup_tables,
+                    batch_size, restored
+                )
+        finally:
+            if synchronous is not None:
+                connection.exec_driver_sql(
+                    f"PRAGMA synchronous={int(synchronous)}"
+                )
+
+    if backup_shards and not include_shards:
+        LOGGER.warning(
+            f"Skipped the shards of corpora {backup_shards}, restore into "
+            "the configured database to restore them."
+        )
+    elif backup_shards:
+        for corpus_id in backup_shards:
+            shard_engine = shards.create_shard(corpus_id)
+            shard_restored = restore_database(
+                shard_engine, shard_metadata(),
+                _shard_path(base_path, corpus_id), batch_size=batch_size
+            )
+            restored.update({
+                f"{SHARDS_DIRECTORY}/{corpus_id}/{table_name}": row_count
+                for table_name, row_count in shard_restored.items()
+            })
+    return restored
+
+
+def _load_tables(
+    connection,
+    metadata: MetaData,
+    base_path: Path,
+    backup_tables: Dict[str, Dict],
+    batch_size: int,
+    restored: Dict[str, int]
+):
+    """Bulk-load the tables of a backup (see `restore_database()`)"""
+    tables = [
+        table
+        for table in metadata.sorted_tables
+        if table.name in backup_tables
+    ]
+    for table in tables:
+        if connection.execute(select(table).limit(1)).first():
+            raise ValueError(f"Table '{table.name}' is not empty.")
+
+    for table in tables:
+        start_time = time.perf_counter()
+        table_info = backup_tables[table.name]
+        columns = [
+            column
+            for column in table_info["columns"]
+            if column in table.columns
+        ]
+        fields = [
+            (
+                column,
+                table_info["columns"].index(column),
+                _column_converter(table.columns[column])
+            )
+            for column in columns
+        ]
+
+        row_count = 0
+        batch = []
+        with _open(base_path / table_info["file"], "r") as f:
+            for line in f:
+                values = json.loads(line)
+                row = {}
+                for column, position, converter in fields:
+                    value = values[position]
+                    if value is not None and converter is not None:
+                        value = converter(value)
+                    row[column] = value
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    connection.execute(table.insert(), batch)
+                    row_count += len(batch)
+                    batch = []
+            if batch:
+                connection.execute(table.insert(), batch)
+                row_count += len(batch)
+
+        restored[table.name] = row_count
+        LOGGER.info(
+            f"Restored {row_count} rows into '{table.name}' "
+            f"in {time.perf_counter() - start_time:.2f}s."
+        )
+
+    reset_sequences(connection, tables)
+
+
+###############################################################################
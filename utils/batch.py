@@ -0,0 +1,591 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched Annotation Submission
+
+Applies the entity and relation changes of several lines at once, i.e. the
+equivalent of a sequence of `update_entity` and `update_relation` requests,
+```
+[
+    {
+        "line_id": 1,
+        "entity_add": "lemma$LABEL##...", "entity_delete": "...",
+        "relation_add": "src_id$label_id$dst_id$detail$src_lemma$src_label$"
+                        "relation_label$dst_lemma$dst_label##...",
+        "relation_delete": "..."
+    },
+    ...
+]
+```
+with the same encoding of entities and relations as the single-line
+actions. The node IDs of a relation may be left empty, if the endpoint is
+an entity on the same line (e.g. one being added in the same batch).
+
+All operations are validated before anything is written, using the
+annotations of the batch lines loaded with one query each. If any
+operation is invalid, nothing is changed. Otherwise, the changes are
+applied with bulk inserts (`executemany`) and set-based updates, and
+committed once for the whole batch.
+
+With sharding enabled, the batch is applied to the shard of its lines
+(see `utils.sharding`), hence all the lines must belong to the same shard.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import insert, or_, select, update
+
+from models_sqla import (db, Line, Lexicon, NodeLabel, RelationLabel, Node,
+                         Relation)
+from utils.bulk import chunks, fetch_in, resolve_lexicons
+from utils.changelog import (
+    log_bulk_change,
+    log_changes,
+    ENTITY_NODE,
+    ENTITY_RELATION,
+    OPERATION_INSERT,
+    OPERATION_UPDATE,
+)
+from utils.concordance import refresh_concordance
+from utils.labels import get_label_id
+from utils.sharding import shards
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+# Maximum number of lines in a batch
+MAX_BATCH_LINES = 500
+
+OPERATION_KEYS = [
+    "entity_add", "entity_delete", "relation_add", "relation_delete"
+]
+
+###############################################################################
+
+
+def _split(value: str) -> List[List[str]]:
+    """Parts of the `##` separated, `$` delimited items of an operation"""
+    return [
+        item.split('$')
+        for item in (value or '').split('##')
+        if '$' in item
+    ]
+
+
+def _to_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _new_line_result(line_id) -> Dict:
+    return {
+        "line_id": line_id,
+        "success": True,
+        "nodes": {"added": 0, "restored": 0, "deleted": 0},
+        "relations": {"added": 0, "restored": 0, "deleted": 0},
+        "errors": [],
+    }
+
+
+def _load_nodes(line_ids: List[int]) -> List[Tuple]:
+    """(id, line_id, annotator_id, lemma, label, is_deleted) of the lines"""
+    rows = []
+    for chunk in chunks(line_ids):
+        rows.extend(db.session.execute(
+            select(
+                Node.id, Node.line_id, Node.annotator_id,
+                Lexicon.lemma, NodeLabel.label, Node.is_deleted
+            ).join(
+                Lexicon, Lexicon.id == Node.lexicon_id
+            ).join(
+                NodeLabel, NodeLabel.id == Node.label_id
+            ).where(Node.line_id.in_(chunk)).order_by(Node.id)
+        ).all())
+    return rows
+
+
+def _load_relations(line_ids: List[int]) -> List[Tuple]:
+    """(id, line_id, annotator_id, src_id, dst_id, label_id, detail,
+    is_deleted) of the lines"""
+    rows = []
+    for chunk in chunks(line_ids):
+        rows.extend(db.session.execute(
+            select(
+                Relation.id, Relation.line_id, Relation.annotator_id,
+                Relation.src_id, Relation.dst_id, Relation.label_id,
+                Relation.detail, Relation.is_deleted
+            ).where(Relation.line_id.in_(chunk)).order_by(Relation.id)
+        ).all())
+    return rows
+
+
+def _set_deleted(model, entity_type: str, ids: List[int], is_deleted: bool,
+                 user_id: int = None):
+    for chunk in chunks(ids):
+        conditions = [model.id.in_(chunk)]
+        log_bulk_change(
+            entity_type, OPERATION_UPDATE,
+            select(model.id).where(*conditions),
+            after={"is_deleted": is_deleted}, user_id=user_id
+        )
+        db.session.execute(
+            update(model).where(*conditions).values(is_deleted=is_deleted)
+            .execution_options(synchronize_session=False)
+        )
+
+
+def _insert_returning_ids(model, rows: List[Dict]) -> List[int]:
+    """Insert rows, and return their IDs (in the order of the rows)
+
+    Uses a single `INSERT ... RETURNING` where the database supports it
+    with `executemany`, and inserts the rows one at a time otherwise.
+    The rows must be distinct, as the returned rows are matched by value.
+    """
+    if not rows:
+        return []
+    dialect = db.session().get_bind().dialect
+    if getattr(dialect, "insert_executemany_returning", False):
+        # match the rows by value, as the order of RETURNING is unspecified
+        columns = sorted(rows[0])
+        returned = {
+            tuple(row[1:]): row[0]
+            for row in db.session.execute(
+                insert(model).returning(
+                    model.id, *[model.__table__.c[c] for c in columns]
+                ),
+                rows
+            )
+        }
+        return [
+            returned[tuple(row[column] for column in columns)]
+            for row in rows
+        ]
+    return [
+        db.session.execute(
+            insert(model).values(**row)
+        ).inserted_primary_key[0]
+        for row in rows
+    ]
+
+###############################################################################
+
+
+def apply_batch(
+    operations: List[Dict],
+    annotator_id: int,
+    curate: bool = False,
+    make_transliteration: Callable[[str], str] = None
+) -> Dict:
+    """Validate and apply the annotation changes of several lines
+
+    Parameters
+    ----------
+    operations : List[Dict]
+        Per-line operations (see module docstring)
+    annotator_id : int
+        ID of the annotator submitting the batch
+    curate : bool, optional
+        If True, annotations by other annotators are matched as well
+        (same as `PERMISSION_CURATE` in the single-line actions).
+        The default is False.
+    make_transliteration : Callable[[str], str], optional
+        Function to compute `Lexicon.transliteration` of new lemmas.
+        The default is None.
+
+    Returns
+    -------
+    dict
+        `success`, and `lines`: per-line results with counts of `nodes`
+        and `relations` added, restored and deleted, and the `errors`
+        (if any, in which case no line was changed)
+    """
+    if not isinstance(operations, list) or not operations:
+        return {"success": False, "lines": [], "message": "Empty batch."}
+    if len(operations) > MAX_BATCH_LINES:
+        return {
+            "success": False, "lines": [],
+            "message": f"Batch exceeds {MAX_BATCH_LINES} lines."
+        }
+
+    results = []
+    line_ops = []
+    seen_line_ids = set()
+    for operation in operations:
+        if not isinstance(operation, dict):
+            operation = {}
+        line_id = _to_int(operation.get("line_id"))
+        result = _new_line_result(line_id or operation.get("line_id"))
+        results.append(result)
+        if line_id is None:
+            result["errors"].append("Invalid line.")
+        elif line_id in seen_line_ids:
+            result["errors"].append(f"Line {line_id} is repeated.")
+        seen_line_ids.add(line_id)
+        line_ops.append((line_id, result, {
+            key: _split(operation.get(key)) for key in OPERATION_KEYS
+        }))
+
+    # the batch is applied to the shard of its lines (the first shard, if
+    # they belong to several, in which case the batch is rejected)
+    partitions = shards.partition(sorted(seen_line_ids - {None}))
+    shard_id = next(iter(partitions), None)
+    for line_id, result, _ in line_ops:
+        if line_id is not None and shards.shard_of(line_id) != shard_id:
+            result["errors"].append(
+                f"Line {line_id} belongs to another corpus shard than "
+                f"line {partitions[shard_id][0]}."
+            )
+
+    with shards.use_shard(shard_id):
+        return _apply_batch(
+            line_ops, results, annotator_id,
+            curate=curate, make_transliteration=make_transliteration
+        )
+
+
+def _apply_batch(
+    line_ops: List[Tuple[int, Dict, Dict]],
+    results: List[Dict],
+    annotator_id: int,
+    curate: bool = False,
+    make_transliteration: Callable[[str], str] = None
+) -> Dict:
+    """Validate and apply the parsed operations of `apply_batch()`"""
+    lines = {
+        line_id: (chapter_id, corpus_id)
+        for line_id, chapter_id, corpus_id in fetch_in(
+            [Line.id, Line.chapter_id, Line.corpus_id],
+            {line_id for line_id, _, _ in line_ops} - {None}
+        )
+    }
+    # label -> label ID (None if invalid), from the label maps
+    node_labels = {}
+    relation_labels = {}
+
+    line_ids = sorted(lines)
+    node_rows = _load_nodes(line_ids)
+    relation_rows = _load_relations(line_ids)
+
+    # (line_id, lemma, label) -> node (own, else any annotator if curating)
+    nodes = {}
+    for node_id, line_id, _annotator_id, lemma, label, is_deleted in node_rows:
+        key = (line_id, lemma, label)
+        if _annotator_id == annotator_id:
+            if key not in nodes or nodes[key][1] != annotator_id:
+                nodes[key] = (node_id, _annotator_id, is_deleted)
+        elif curate and key not in nodes:
+            nodes[key] = (node_id, _annotator_id, is_deleted)
+
+    # (line_id, src_id, dst_id, label_id, detail) -> relation
+    relations = {}
+    for (relation_id, line_id, _annotator_id, src_id, dst_id, label_id,
+         detail, is_deleted) in relation_rows:
+        key = (line_id, src_id, dst_id, label_id, detail)
+        if _annotator_id == annotator_id:
+            if key not in relations or relations[key][1] != annotator_id:
+                relations[key] = (relation_id, _annotator_id, is_deleted)
+        elif curate and key not in relations:
+            relations[key] = (relation_id, _annotator_id, is_deleted)
+
+    # endpoints given by ID must be live nodes (of the same line)
+    endpoint_ids = {
+        _to_int(parts[idx])
+        for _, _, ops in line_ops
+        for parts in ops["relation_add"] + ops["relation_delete"]
+        for idx in [0, 2]
+        if idx < len(parts)
+    } - {None}
+    live_node_lines = dict(fetch_in(
+        [Node.id, Node.line_id], endpoint_ids, Node.is_deleted == False  # noqa
+    ))
+
+    # ----------------------------------------------------------------------- #
+    # Plan
+
+    new_nodes = []              # (line_id, lemma, label)
+    node_updates = {}           # node_id -> is_deleted
+    new_relations = []          # (line_id, src, dst, label_id, detail)
+    relation_updates = {}       # relation_id -> is_deleted
+    deleted_nodes = {}          # node_id -> (result, description)
+
+    for line_id, result, ops in line_ops:
+        if not result["errors"] and line_id not in lines:
+            result["errors"].append(f"Invalid line '{line_id}'.")
+        if result["errors"]:
+            continue
+
+        entity_add = [tuple(parts[:2]) for parts in ops["entity_add"]]
+        entity_del = [tuple(parts[:2]) for parts in ops["entity_delete"]]
+        for lemma, label in entity_add + entity_del:
+            if label not in node_labels:
+                node_labels[label] = get_label_id(NodeLabel, label)
+            if node_labels[label] is None:
+                result["errors"].append(f"Invalid node type '{label}'.")
+                continue
+            key = (line_id, lemma, label)
+            node = nodes.get(key)
+            if node is None:
+                if (lemma, label) in entity_add and key not in new_nodes:
+                    new_nodes.append(key)
+                    result["nodes"]["added"] += 1
+                continue
+
+            node_id, _, is_deleted = node
+            if (lemma, label) in entity_del:
+                if not is_deleted:
+                    node_updates[node_id] = True
+                    deleted_nodes[node_id] = (
+                        result, f"Node {node_id} ({lemma}::{label})"
+                    )
+                    result["nodes"]["deleted"] += 1
+            elif is_deleted:
+                node_updates[node_id] = False
+                result["nodes"]["restored"] += 1
+
+        relation_items = [
+            (parts, True) for parts in ops["relation_add"]
+        ] + [
+            (parts, False) for parts in ops["relation_delete"]
+        ]
+        for parts, is_add in relation_items:
+            (src_id, _, dst_id, detail, src_lemma, src_label,
+             relation_label, dst_lemma, dst_label) = (parts + [''] * 9)[:9]
+            detail = detail if detail.strip() else None
+
+            # endpoints, by ID, else by entity on the same line
+            endpoints = []
+            for node_id, lemma, label, role in [
+                (src_id, src_lemma, src_label, "Source"),
+                (dst_id, dst_lemma, dst_label, "Target")
+            ]:
+                node_id = _to_int(node_id)
+                if node_id is not None and node_id not in live_node_lines:
+                    node_id = None
+                elif node_id is not None and (
+                    live_node_lines[node_id] != line_id
+                ):
+                    result["errors"].append(
+                        f"{role} node {node_id} is not on line {line_id}."
+                    )
+                    endpoints.append(None)
+                    continue
+                elif node_id is None:
+                    # a relation may be deleted along with its endpoint
+                    key = (line_id, lemma, label)
+                    if key in nodes and (not is_add or not node_updates.get(
+                        nodes[key][0], nodes[key][2]
+                    )):
+                        node_id = nodes[key][0]
+                    elif key in new_nodes:
+                        node_id = key
+                if node_id is None:
+                    result["errors"].append(
+                        f"{role} node ({lemma}::{label}) does not exist."
+                    )
+                endpoints.append(node_id)
+
+            if relation_label not in relation_labels:
+                relation_labels[relation_label] = get_label_id(
+                    RelationLabel, relation_label
+                )
+            if relation_labels[relation_label] is None:
+                result["errors"].append(
+                    f"Invalid relation type '{relation_label}'."
+                )
+                continue
+            if None in endpoints:
+                continue
+
+            key = (line_id, *endpoints, relation_labels[relation_label],
+                   detail)
+            relation = relations.get(key)
+            if relation is None:
+                if is_add and key not in new_relations:
+                    new_relations.append(key)
+                    result["relations"]["added"] += 1
+                continue
+
+            relation_id, _, is_deleted = relation
+            if not is_add:
+                if not is_deleted:
+                    relation_updates[relation_id] = True
+                    result["relations"]["deleted"] += 1
+            elif is_deleted:
+                relation_updates[relation_id] = False
+                result["relations"]["restored"] += 1
+
+    # nodes can not be deleted while live relations refer to them
+    if deleted_nodes:
+        deleted_node_ids = list(deleted_nodes)
+        usage = {}
+        for chunk in chunks(deleted_node_ids):
+            for src_id, dst_id, relation_id in db.session.execute(
+                select(Relation.src_id, Relation.dst_id, Relation.id).where(
+                    or_(
+                        Relation.src_id.in_(chunk),
+                        Relation.dst_id.in_(chunk)
+                    ),
+                    Relation.is_deleted == False  # noqa
+                )
+            ):
+                if relation_updates.get(relation_id):
+                    continue
+                for node_id in {src_id, dst_id} & set(chunk):
+                    usage[node_id] = usage.get(node_id, 0) + 1
+        restored_relations = [
+            key
+            for key, (relation_id, _, _) in relations.items()
+            if relation_updates.get(relation_id) is False
+        ]
+        for key in new_relations + restored_relations:
+            for node_id in key[1:3]:
+                if node_id in deleted_nodes:
+                    usage[node_id] = usage.get(node_id, 0) + 1
+        for node_id, count in usage.items():
+            result, description = deleted_nodes[node_id]
+            result["errors"].append(
+                f"{description} used in {count} relations."
+            )
+
+    for result in results:
+        result["success"] = not result["errors"]
+    if not all(result["success"] for result in results):
+        return {
+            "success": False,
+            "lines": results,
+            "message": "No changes were made."
+        }
+
+    # ----------------------------------------------------------------------- #
+    # Apply
+
+    try:
+        _apply(
+            new_nodes, node_updates, new_relations, relation_updates,
+            lines, node_labels, annotator_id, make_transliteration
+        )
+    except Exception:
+        db.session.rollback()
+        raise
+    else:
+        db.session.commit()
+
+    return {"success": True, "lines": results}
+
+
+def _apply(
+    new_nodes: List[Tuple],
+    node_updates: Dict[int, bool],
+    new_relations: List[Tuple],
+    relation_updates: Dict[int, bool],
+    lines: Dict[int, Tuple[int, int]],
+    node_labels: Dict[str, int],
+    annotator_id: int,
+    make_transliteration: Callable[[str], str] = None
+):
+    """Write the planned changes of `apply_batch()`, without commit"""
+    lexicon_ids = resolve_lexicons(
+        (lemma for _, lemma, _ in new_nodes),
+        make_transliteration=make_transliteration,
+        user_id=annotator_id
+    )
+
+    # (line_id, lemma, label) of a new node -> its ID
+    node_ids = {}
+    if new_nodes:
+        node_keys = {
+            (line_id, annotator_id, lexicon_ids[lemma], node_labels[label]):
+            (line_id, lemma, label)
+            for line_id, lemma, label in new_nodes
+        }
+        node_columns = ["line_id", "annotator_id", "lexicon_id", "label_id"]
+        db.session.execute(insert(Node), [
+            {
+                **dict(zip(node_columns, key)),
+                "chapter_id": lines[key[0]][0],
+                "corpus_id": lines[key[0]][1],
+                "is_deleted": False
+            }
+            for key in node_keys
+        ])
+        created = fetch_in(
+            [Node.line_id, Node.annotator_id, Node.lexicon_id, Node.label_id,
+             Node.id],
+            list(node_keys)
+        )
+        node_ids = {node_keys[tuple(row[:4])]: row[4] for row in created}
+        log_changes(ENTITY_NODE, OPERATION_INSERT, (
+            (
+                row[4], None,
+                {**dict(zip(node_columns, row[:4])), "is_deleted": False}
+            )
+            for row in created
+        ), user_id=annotator_id)
+
+    for is_deleted in [True, False]:
+        _set_deleted(Node, ENTITY_NODE, [
+            node_id
+            for node_id, value in node_updates.items()
+            if value is is_deleted
+        ], is_deleted, user_id=annotator_id)
+
+    if new_relations:
+        relation_columns = [
+            "line_id", "src_id", "dst_id", "label_id", "detail"
+        ]
+        rows = []
+        for key in new_relations:
+            row = dict(zip(relation_columns, key))
+            for column in ["src_id", "dst_id"]:
+                if isinstance(row[column], tuple):
+                    row[column] = node_ids[row[column]]
+            rows.append({
+                **row,
+                "annotator_id": annotator_id,
+                "chapter_id": lines[row["line_id"]][0],
+                "corpus_id": lines[row["line_id"]][1],
+                "is_deleted": False
+            })
+
+        relation_ids = _insert_returning_ids(Relation, rows)
+        log_changes(ENTITY_RELATION, OPERATION_INSERT, (
+            (
+                relation_id, None,
+                {
+                    column: row[column]
+                    for column in relation_columns + [
+                        "annotator_id", "is_deleted"
+                    ]
+                }
+            )
+            for relation_id, row in zip(relation_ids, rows)
+        ), user_id=annotator_id)
+
+    for is_deleted in [True, False]:
+        _set_deleted(Relation, ENTITY_RELATION, [
+            relation_id
+            for relation_id, value in relation_updates.items()
+            if value is is_deleted
+        ], is_deleted, user_id=annotator_id)
+
+    # concordance of the (lexicon, line) pairs of the changed nodes
+    changed_node_ids = list(node_updates) + list(node_ids.values())
+    pairs = []
+    for chunk in chunks(changed_node_ids):
+        pairs.extend(db.session.execute(
+            select(Node.lexicon_id, Node.line_id).where(Node.id.in_(chunk))
+        ).all())
+    for chunk in chunks(pairs):
+        refresh_concordance(chunk)
+
+###############################################################################
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk Lookups
+
+Helpers shared by the bulk operations (import, batched submission, lexicon
+lookups), which resolve many keys with a few chunked `IN` queries instead of
+one query per key.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from sqlalchemy import insert, select, tuple_
+
+from models_sqla import db, Lexicon
+from utils.changelog import log_changes, ENTITY_LEXICON, OPERATION_INSERT
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+# Number of rows per bulk lookup (keeps tuple IN clauses within the
+# bound parameter limits of the database)
+CHUNK_SIZE = 200
+
+###############################################################################
+
+
+def chunks(items: Iterable, size: int = CHUNK_SIZE) -> Iterable[List]:
+    """Consecutive lists of (at most) `size` items"""
+    items = list(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def fetch_in(columns: List, keys: Iterable, *conditions) -> List[Tuple]:
+    """Rows of `columns` whose leading columns match one of `keys`
+
+    The number of leading columns is the length of the key tuples.
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+
+    key_length = len(keys[0]) if isinstance(keys[0], tuple) else 1
+    key_columns = columns[:key_length]
+    key_expression = (
+        tuple_(*key_columns) if key_length > 1 else key_columns[0]
+    )
+    rows = []
+    for chunk in chunks(keys):
+        rows.extend(db.session.execute(
+            select(*columns).where(key_expression.in_(chunk), *conditions)
+        ).all())
+    return rows
+
+
+def resolve_lexicons(
+    lemmas: Iterable[str],
+    make_transliteration: Callable[[str], str] = None,
+    user_id: int = None
+) -> Dict[str, int]:
+    """Lexicon IDs of lemmas, creating the missing entries"""
+    lemmas = set(lemmas)
+    lexicon_ids = dict(fetch_in([Lexicon.lemma, Lexicon.id], lemmas))
+    missing = sorted(lemmas - set(lexicon_ids))
+    if missing:
+        values = {}
+        for lemma in missing:
+            transliteration = None
+            if make_transliteration is not None:
+                transliteration = make_transliteration(lemma) or None
+            values[lemma] = {
+                "lemma": lemma,
+                "transliteration": transliteration
+            }
+        db.session.execute(insert(Lexicon), list(values.values()))
+        created = dict(fetch_in([Lexicon.lemma, Lexicon.id], missing))
+        log_changes(
+            ENTITY_LEXICON, OPERATION_INSERT,
+            (
+                (lexicon_id, None, values[lemma])
+                for lemma, lexicon_id in created.items()
+            ),
+            user_id=user_id
+        )
+        lexicon_ids.update(created)
+    return lexicon_ids
+
+###############################################################################
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Annotation Change Log
+
+Every annotation mutation appends a row to `ChangeLog` in the same
+transaction as the mutation itself. Consumers (graph rebuilds, statistics,
+exports, caches) remember the last sequence number they have processed and
+resume from there using `read_changes()`.
+
+Functions in this module only add rows to `db.session`.
+Committing (or rolling back) is the responsibility of the caller.
+
+Sequence numbers are allocated on insert, but become visible on commit.
+With concurrent writers (PostgreSQL, MySQL), a change could thus become
+visible after a consumer has moved past its sequence number, and be
+skipped for good. Every transaction appending to the log therefore holds
+the row lock of `ChangeLogLock` from its first entry until it ends, which
+makes the order of the sequence numbers the order of the commits.
+(SQLite serialises writers anyway.)
+
+A transaction spanning several databases (shards) collects its entries
+using `defer_changes()`, and adds them through the main database using
+`add_changes()`, so that the shared tables are written through a single
+connection.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import (Integer, JSON, DateTime, String, insert, literal,
+                        select, update)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import Select
+
+from models_sqla import db, ChangeLog, ChangeLogLock, Lexicon, Node, Relation
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+ENTITY_LEXICON = "lexicon"
+ENTITY_NODE = "node"
+ENTITY_RELATION = "relation"
+
+OPERATION_INSERT = "insert"
+OPERATION_UPDATE = "update"
+OPERATION_DELETE = "delete"
+OPERATION_ARCHIVE = "archive"
+OPERATION_RESTORE = "restore"
+
+ENTITY_MODELS = {
+    ENTITY_LEXICON: Lexicon,
+    ENTITY_NODE: Node,
+    ENTITY_RELATION: Relation,
+}
+
+CHANGE_LOG_LOCK_ID = 1
+
+_DEFERRED_CHANGES = ContextVar("deferred_changes", default=None)
+
+# Columns recorded in the payload
+# `updated_at` is deliberately left out, `ChangeLog.created_at` records it.
+TRACKED_COLUMNS = {
+    ENTITY_LEXICON: ("lemma", "transliteration"),
+    ENTITY_NODE: (
+        "line_id", "annotator_id", "lexicon_id", "label_id", "is_deleted"
+    ),
+    ENTITY_RELATION: (
+        "line_id", "annotator_id", "src_id", "dst_id", "label_id", "detail",
+        "is_deleted"
+    ),
+}
+
+###############################################################################
+
+
+def get_entity_type(obj) -> str:
+    """Entity type of an annotation object"""
+    for entity_type, model in ENTITY_MODELS.items():
+        if isinstance(obj, model):
+            return entity_type
+    raise TypeError(f"Changes to '{type(obj).__name__}' are not logged.")
+
+
+def snapshot(obj) -> Dict:
+    """Values of the tracked columns of an annotation object
+
+    Values are normalised to what the database would store, i.e.
+    scalar column defaults are filled in for unflushed objects and integer
+    columns set from (string) request parameters are converted to `int`.
+    """
+    entity_type = get_entity_type(obj)
+    table_columns = ENTITY_MODELS[entity_type].__table__.columns
+
+    values = {}
+    for column in TRACKED_COLUMNS[entity_type]:
+        value = getattr(obj, column)
+        table_column = table_columns[column]
+        if value is None:
+            default = table_column.default
+            if default is not None and default.is_scalar:
+                value = default.arg
+        elif isinstance(value, str) and isinstance(table_column.type, Integer):
+            value = int(value)
+        values[column] = value
+    return values
+
+
+def diff(before: Dict, after: Dict) -> Tuple[Dict, Dict]:
+    """Restrict two snapshots to the columns whose values differ"""
+    if before is None:
+        return None, after
+    if after is None:
+        return before, None
+    changed = [
+        column
+        for column in after
+        if before.get(column) != after.get(column)
+    ]
+    return (
+        {column: before.get(column) for column in changed},
+        {column: after.get(column) for column in changed}
+    )
+
+###############################################################################
+
+
+@contextmanager
+def defer_changes():
+    """Collect the change log entries of the block instead of adding them
+
+    Yields the list the entries (dictionaries of `ChangeLog` columns) are
+    collected into, in order, to be added later using `add_changes()`.
+    """
+    entries = []
+    token = _DEFERRED_CHANGES.set(entries)
+    try:
+        yield entries
+    finally:
+        _DEFERRED_CHANGES.reset(token)
+
+
+def add_changes(entries: List[Dict]) -> int:
+    """Add change log entries collected using `defer_changes()`
+
+    Returns
+    -------
+    int
+        Number of change log entries added
+    """
+    if entries:
+        lock_sequence()
+        db.session.execute(insert(ChangeLog), entries)
+    return len(entries)
+
+
+def lock_sequence():
+    """Lock the change log sequence until the end of the transaction
+
+    Called before the entries of a transaction are inserted, so that no
+    other transaction allocates sequence numbers until this one commits
+    (or rolls back). The lock is taken once per transaction and bind.
+    """
+    session = db.session()
+    transaction = session.get_transaction()
+    bind = session.get_bind()
+    locked = session.info.get("change_log_locked")
+    if locked is not None and locked[0] is transaction:
+        if bind in locked[1]:
+            return
+    else:
+        locked = (transaction, set())
+        session.info["change_log_locked"] = locked
+
+    lock_statement = update(ChangeLogLock).where(
+        ChangeLogLock.id == CHANGE_LOG_LOCK_ID
+    ).values(id=ChangeLogLock.id)
+    if db.session.execute(lock_statement).rowcount == 0:
+        # the lock row is missing, e.g. in a database created before it
+        try:
+            with db.session.begin_nested():
+                db.session.execute(
+                    insert(ChangeLogLock).values(id=CHANGE_LOG_LOCK_ID)
+                )
+        except IntegrityError:
+            # created concurrently
+            db.session.execute(lock_statement)
+    locked[1].add(bind)
+
+
+def log_change(
+    entity_type: str,
+    entity_id: int,
+    operation: str,
+    before: Dict = None,
+    after: Dict = None,
+    user_id: int = None
+) -> ChangeLog:
+    """Append a change log entry to the current session
+
+    Parameters
+    ----------
+    entity_type : str
+        One of `ENTITY_LEXICON`, `ENTITY_NODE`, `ENTITY_RELATION`
+    entity_id : int
+        ID of the changed entity
+    operation : str
+        One of `OPERATION_INSERT`, `OPERATION_UPDATE`, `OPERATION_DELETE`
+    before : Dict, optional
+        Values of the changed columns before the change.
+        The default is None.
+    after : Dict, optional
+        Values of the changed columns after the change.
+        The default is None.
+    user_id : int, optional
+        ID of the user making the change.
+        The default is None.
+
+    Returns
+    -------
+    ChangeLog
+        The change log entry (not committed, and not added to the session
+        if the entries are deferred)
+    """
+    entry = ChangeLog()
+    entry.entity_type = entity_type
+    entry.entity_id = entity_id
+    entry.operation = operation
+    entry.before = before
+    entry.after = after
+    entry.user_id = user_id
+    if _DEFERRED_CHANGES.get() is not None:
+        log_changes(
+            entity_type, operation, [(entity_id, before, after)],
+            user_id=user_id
+        )
+        return entry
+
+    lock_sequence()
+    db.session.add(entry)
+    return entry
+
+
+def log_object_change(
+    obj,
+    before: Dict = None,
+    user_id: int = None
+) -> ChangeLog or None:
+    """Log the change made to an annotation object
+
+    `before` should be the `snapshot()` of the object taken prior to the
+    change, or None if the object is newly created.
+    The object must have an ID, i.e. it must have been flushed.
+
+    Returns
+    -------
+    ChangeLog or None
+        The change log entry, or None if nothing changed
+    """
+    entity_type = get_entity_type(obj)
+    if obj.id is None:
+        raise ValueError(f"{entity_type} must be flushed before logging.")
+
+    _before, _after = diff(before, snapshot(obj))
+    if before is None:
+        operation = OPERATION_INSERT
+    elif not _after:
+        return None
+    else:
+        operation = OPERATION_UPDATE
+
+    return log_change(
+        entity_type, obj.id, operation,
+        before=_before, after=_after, user_id=user_id
+    )
+
+
+def log_object_changes(
+    changes: Iterable[Tuple[object, Dict]],
+    user_id: int = None
+) -> int:
+    """Log the changes made to several annotation objects
+
+    Batched counterpart of `log_object_change()`. Entries are grouped by
+    entity type and operation, and every group is written with a single
+    `log_changes()`.
+
+    Parameters
+    ----------
+    changes : Iterable[Tuple[object, Dict]]
+        Tuples of (object, before), where `before` is the `snapshot()` of
+        the object prior to the change, or None if it is newly created.
+        The objects must have been flushed.
+    user_id : int, optional
+        ID of the user making the changes.
+        The default is None.
+
+    Returns
+    -------
+    int
+        Number of change log entries added
+    """
+    groups = {}
+    for obj, before in changes:
+        entity_type = get_entity_type(obj)
+        if obj.id is None:
+            raise ValueError(f"{entity_type} must be flushed before logging.")
+
+        _before, _after = diff(before, snapshot(obj))
+        if before is None:
+            operation = OPERATION_INSERT
+        elif not _after:
+            continue
+        else:
+            operation = OPERATION_UPDATE
+        groups.setdefault((entity_type, operation), []).append(
+            (obj.id, _before, _after)
+        )
+
+    return sum(
+        log_changes(entity_type, operation, entries, user_id=user_id)
+        for (entity_type, operation), entries in groups.items()
+    )
+
+
+def log_changes(
+    entity_type: str,
+    operation: str,
+    changes: Iterable[Tuple[int, Dict, Dict]],
+    user_id: int = None
+) -> int:
+    """Log changes to several entities with a single `executemany`
+
+    Parameters
+    ----------
+    entity_type : str
+        Entity type of the changed entities
+    operation : str
+        Operation performed on the entities
+    changes : Iterable[Tuple[int, Dict, Dict]]
+        Tuples of (entity_id, before, after)
+    user_id : int, optional
+        ID of the user making the changes.
+        The default is None.
+
+    Returns
+    -------
+    int
+        Number of change log entries added
+    """
+    created_at = datetime.utcnow()
+    entries = [
+        {
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "operation": operation,
+            "before": before,
+            "after": after,
+            "user_id": user_id,
+            "created_at": created_at
+        }
+        for entity_id, before, after in changes
+    ]
+    deferred = _DEFERRED_CHANGES.get()
+    if deferred is not None:
+        deferred.extend(entries)
+    elif entries:
+        lock_sequence()
+        db.session.execute(insert(ChangeLog), entries)
+    return len(entries)
+
+
+def log_bulk_change(
+    entity_type: str,
+    operation: str,
+    id_select: Select,
+    after: Dict = None,
+    user_id: int = None
+) -> int:
+    """Log the same change for every entity ID returned by a SELECT
+
+    Set-based counterpart of `log_change()`, for mutations carried out
+    through `UPDATE ... WHERE` or `INSERT ... SELECT` statements.
+    It must be executed before the statement that makes the rows
+    unreachable by `id_select` (e.g. before the `DELETE`).
+
+    Parameters
+    ----------
+    entity_type : str
+        Entity type of the IDs
+    operation : str
+        Operation performed on the entities
+    id_select : Select
+        SELECT statement returning a single column of entity IDs
+    after : Dict, optional
+        Common payload describing the change.
+        The default is None.
+    user_id : int, optional
+        ID of the user making the change.
+        The default is None.
+
+    Returns
+    -------
+    int
+        Number of change log entries added
+    """
+    entity_ids = id_select.subquery()
+    entity_id = list(entity_ids.columns)[0]
+    if _DEFERRED_CHANGES.get() is not None:
+        return log_changes(
+            entity_type, operation,
+            (
+                (_entity_id, None, after)
+                for _entity_id, in db.session.execute(
+                    select(entity_id).order_by(entity_id)
+                )
+            ),
+            user_id=user_id
+        )
+
+    lock_sequence()
+    log_select = select(
+        literal(entity_type, String),
+        entity_id,
+        literal(operation, String),
+        literal(after, JSON),
+        literal(user_id, Integer),
+        literal(datetime.utcnow(), DateTime)
+    ).order_by(entity_id)
+    result = db.session.execute(
+        insert(ChangeLog).from_select(
+            ["entity_type", "entity_id", "operation", "after",
+             "user_id", "created_at"],
+            log_select
+        )
+    )
+    return result.rowcount
+
+###############################################################################
+
+
+def get_last_sequence() -> int:
+    """Sequence number of the most recent change (0 if there are none)
+
+    As sequence numbers are committed in order, every change up to it is
+    visible, i.e. it is safe to use as a high-water mark.
+    """
+    return db.session.query(db.func.max(ChangeLog.id)).scalar() or 0
+
+
+def read_changes(
+    since: int = 0,
+    limit: int = 1000,
+    entity_types: List[str] = None,
+) -> Dict:
+    """Read changes after a sequence number
+
+    Parameters
+    ----------
+    since : int, optional
+        Sequence number of the last change seen by the consumer.
+        The default is 0.
+    limit : int, optional
+        Maximum number of changes to return.
+        The default is 1000.
+    entity_types : List[str], optional
+        If provided, only changes to these entity types are returned.
+        The default is None.
+
+    Returns
+    -------
+    dict
+        `changes`: list of changes in sequence order,
+        `cursor`: sequence number to resume from,
+        `has_more`: True if there are more changes after `cursor`
+    """
+    conditions = [ChangeLog.id > since]
+    if entity_types:
+        conditions.append(ChangeLog.entity_type.in_(entity_types))
+
+    rows = db.session.query(
+        ChangeLog.id, ChangeLog.entity_type, ChangeLog.entity_id,
+        ChangeLog.operation, ChangeLog.before, ChangeLog.after,
+        ChangeLog.user_id, ChangeLog.created_at
+    ).filter(*conditions).order_by(ChangeLog.id).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    changes = [
+        {
+            "seq": seq,
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "operation": operation,
+            "before": before,
+            "after": after,
+            "user_id": user_id,
+            "created_at": (
+                created_at.isoformat()
+                if isinstance(created_at, datetime) else
+                created_at
+            )
+        }
+        for (seq, entity_type, entity_id, operation, before, after,
+             user_id, created_at) in rows
+    ]
+    return {
+        "changes": changes,
+        "cursor": changes[-1]["seq"] if changes else since,
+        "has_more": has_more
+    }
+
+###############################################################################
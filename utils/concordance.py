@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lemma Concordance (KWIC) Index
+
+`Concordance` maps a lexicon entry to every line in which it is annotated
+(by a live `Node`), along with the verse and chapter of the line and the
+character offsets of the lemma in `Line.text`. A line may contain several
+occurrences of the lemma, each having its own row. If the lemma can not be
+found in the text (e.g. due to sandhi or inflection), a single row without
+offsets is stored, so that the line is still listed.
+
+The index is built in bulk from `Node` using `build_concordance()` and kept
+up-to-date by the annotation write paths using `refresh_concordance()`.
+
+The index of a corpus stored in a shard (see `utils.sharding`) lives in the
+shard. `refresh_concordance()` works on the current shard (i.e. the one of
+the changed lines, selected by the caller), while `build_concordance()`,
+`refresh_lexicon_concordance()` and `get_concordance()` go through every
+shard.
+
+Functions in this module, except `build_concordance()`, only add statements
+to `db.session`. Committing is the responsibility of the caller.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import delete, insert, tuple_
+
+from models_sqla import db, Chapter, Concordance, Lexicon, Line, Node, Verse
+from utils.sharding import shards
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+
+def find_offsets(text: str, lemma: str) -> List[Tuple[int, int]]:
+    """Character offsets of non-overlapping occurrences of lemma in text"""
+    offsets = []
+    if not text or not lemma:
+        return offsets
+
+    start = text.find(lemma)
+    while start != -1:
+        end = start + len(lemma)
+        offsets.append((start, end))
+        start = text.find(lemma, end)
+    return offsets
+
+
+def _occurrence_query():
+    """Distinct (lexicon, line) pairs annotated by a live node"""
+    return db.session.query(
+        Node.lexicon_id, Node.line_id,
+        Line.verse_id, Verse.chapter_id,
+        Lexicon.lemma, Line.text
+    ).join(
+        Lexicon, Lexicon.id == Node.lexicon_id
+    ).join(
+        Line, Line.id == Node.line_id
+    ).join(
+        Verse, Verse.id == Line.verse_id
+    ).filter(
+        Node.is_deleted == False  # noqa
+    ).distinct()
+
+
+def _concordance_rows(
+    occurrences: Iterable[Tuple],
+    lemmas: Dict[int, str] = None
+) -> List[Dict]:
+    rows = []
+    for (lexicon_id, line_id, verse_id, chapter_id,
+         lemma, text) in occurrences:
+        if lemmas and lexicon_id in lemmas:
+            lemma = lemmas[lexicon_id]
+        row = {
+            "lexicon_id": lexicon_id,
+            "line_id": line_id,
+            "verse_id": verse_id,
+            "chapter_id": chapter_id
+        }
+        offsets = find_offsets(text, lemma) or [(None, None)]
+        rows.extend(
+            {**row, "start": start, "end": end}
+            for start, end in offsets
+        )
+    return rows
+
+###############################################################################
+
+
+def build_concordance(batch_size: int = 10000) -> int:
+    """(Re)build the complete concordance index from `Node`
+
+    The index of every shard is built (and committed) in turn.
+
+    Parameters
+    ----------
+    batch_size : int, optional
+        Number of rows inserted with a single `executemany`.
+        The default is 10000.
+
+    Returns
+    -------
+    int
+        Number of rows in the concordance index
+    """
+    row_count = 0
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            try:
+                db.session.execute(delete(Concordance))
+                occurrences = _occurrence_query().yield_per(batch_size)
+                batch = []
+                for occurrence in occurrences:
+                    batch.extend(_concordance_rows([occurrence]))
+                    if len(batch) >= batch_size:
+                        db.session.execute(insert(Concordance), batch)
+                        row_count += len(batch)
+                        batch = []
+                if batch:
+                    db.session.execute(insert(Concordance), batch)
+                    row_count += len(batch)
+            except Exception:
+                db.session.rollback()
+                raise
+            else:
+                db.session.commit()
+
+    LOGGER.info(f"Built concordance index with {row_count} rows.")
+    return row_count
+
+
+def refresh_concordance(
+    pairs: Iterable[Tuple[int, int]],
+    lemmas: Dict[int, str] = None
+) -> int:
+    """Recompute concordance rows for (lexicon_id, line_id) pairs
+
+    Called with the pairs affected by a change to `Node` (or `Lexicon`).
+    Pairs which are no longer annotated by a live node are removed.
+    Only the current shard is refreshed.
+
+    Parameters
+    ----------
+    pairs : Iterable[Tuple[int, int]]
+        (lexicon_id, line_id) pairs
+    lemmas : Dict[int, str], optional
+        Lemmas to use instead of the stored ones, keyed by lexicon ID.
+        A shard may not see an uncommitted lemma change made through
+        another connection (e.g. to the main database).
+        The default is None.
+
+    Returns
+    -------
+    int
+        Number of concordance rows written
+    """
+    pairs = {
+        (int(lexicon_id), int(line_id))
+        for lexicon_id, line_id in pairs
+    }
+    if not pairs:
+        return 0
+
+    db.session.execute(
+        delete(Concordance).where(
+            tuple_(Concordance.lexicon_id, Concordance.line_id).in_(pairs)
+        ).execution_options(synchronize_session=False)
+    )
+    occurrences = _occurrence_query().filter(
+        tuple_(Node.lexicon_id, Node.line_id).in_(pairs)
+    ).all()
+    rows = _concordance_rows(occurrences, lemmas=lemmas)
+    if rows:
+        db.session.execute(insert(Concordance), rows)
+    return len(rows)
+
+
+def refresh_lexicon_concordance(lexicon_id: int) -> int:
+    """Recompute concordance rows of a lexicon entry (e.g. on lemma change)"""
+    lemmas = dict(
+        db.session.query(Lexicon.id, Lexicon.lemma).filter(
+            Lexicon.id == lexicon_id
+        )
+    )
+    row_count = 0
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            line_ids = db.session.query(Concordance.line_id).filter(
+                Concordance.lexicon_id == lexicon_id
+            ).distinct().all()
+            row_count += refresh_concordance(
+                ((lexicon_id, line_id) for line_id, in line_ids),
+                lemmas=lemmas
+            )
+    return row_count
+
+###############################################################################
+
+
+def get_concordance(
+    lexicon_id: int,
+    page: int = 1,
+    per_page: int = 50,
+    width: int = 40
+) -> Dict:
+    """Key-Word-In-Context (KWIC) listing of a lexicon entry
+
+    Parameters
+    ----------
+    lexicon_id : int
+        ID of the lexicon entry
+    page : int, optional
+        Page number (1-indexed).
+        The default is 1.
+    per_page : int, optional
+        Number of occurrences per page.
+        The default is 50.
+    width : int, optional
+        Number of characters of context on either side of the lemma.
+        The default is 40.
+
+    Returns
+    -------
+    dict
+        `total`: number of occurrences,
+        `page`, `per_page`: pagination parameters,
+        `results`: list of occurrences, in corpus order (shard by shard),
+        with `left`, `keyword` and `right` context (`keyword` is None if
+        the lemma could not be located in the line, in which case `left`
+        contains the complete line)
+    """
+    page = max(page, 1)
+    total = 0
+    rows = []
+    offset = (page - 1) * per_page
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            query = db.session.query(
+                Concordance.line_id, Concordance.verse_id,
+                Concordance.chapter_id, Chapter.name,
+                Concordance.start, Concordance.end, Line.text
+            ).join(
+                Line, Line.id == Concordance.line_id
+            ).join(
+                Chapter, Chapter.id == Concordance.chapter_id
+            ).filter(
+                Concordance.lexicon_id == lexicon_id
+            )
+            shard_total = query.count()
+            total += shard_total
+            if offset >= shard_total:
+                offset -= shard_total
+                continue
+            if len(rows) < per_page:
+                rows.extend(query.order_by(
+                    Concordance.chapter_id, Concordance.verse_id,
+                    Concordance.line_id, Concordance.start
+                ).offset(offset).limit(per_page - len(rows)).all())
+                offset = 0
+
+    results = []
+    for (line_id, verse_id, chapter_id, chapter_name,
+         start, end, text) in rows:
+        if start is None:
+            left, keyword, right = text, None, ""
+        else:
+            left = text[max(start - width, 0):start]
+            keyword = text[start:end]
+            right = text[end:end + width]
+        results.append({
+            "line_id": line_id,
+            "verse_id": verse_id,
+            "chapter_id": chapter_id,
+            "chapter": chapter_name,
+            "start": start,
+            "end": end,
+            "left": left,
+            "keyword": keyword,
+            "right": right
+        })
+
+    return {
+        "total": total,
+        "page": page,
+        "per_page": per_page,
+        "results": results
+    }
+
+###############################################################################
@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Curation Operations
+
+Corpus-wide corrections of annotations, carried out with set-based
+`UPDATE ... WHERE` statements (instead of loading and rewriting one ORM
+object at a time) in a single transaction.
+
+Merging a node into another rewrites the `src_id` and `dst_id` of every
+relation referring to it. A rewritten relation may become a duplicate of a
+relation that already refers to the target node (same line, annotator,
+endpoints, label and detail), which would violate the unique index on
+`Relation`. Such relations are collapsed instead, i.e. they are left as
+they are and soft-deleted, and if the relation they duplicate was deleted
+while they were live, it is restored in their place.
+
+Merging lexicon entries (e.g. spelling variants) points their nodes to the
+target entry. Nodes which would then duplicate a node of the target entry
+are merged into it as above, and archived.
+
+Every change is recorded in the change log.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from typing import Dict, Iterable
+
+from sqlalchemy import and_, delete, select, update
+from sqlalchemy.orm import aliased
+
+from models_sqla import (db, Lexicon, Node, Relation, Action, NodeArchive,
+                         Concordance)
+from utils.archive import archive_nodes
+from utils.changelog import (
+    add_changes,
+    defer_changes,
+    log_bulk_change,
+    ENTITY_LEXICON,
+    ENTITY_NODE,
+    ENTITY_RELATION,
+    OPERATION_UPDATE,
+    OPERATION_DELETE,
+)
+from utils.concordance import refresh_concordance
+from utils.sharding import shards
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+
+def _update_relations(
+    conditions: list, values: Dict, user_id: int = None
+) -> int:
+    """Log and apply an `UPDATE relation SET values WHERE conditions`"""
+    log_bulk_change(
+        ENTITY_RELATION, OPERATION_UPDATE,
+        select(Relation.id).where(*conditions),
+        after=values, user_id=user_id
+    )
+    result = db.session.execute(
+        update(Relation).where(*conditions).values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    return result.rowcount
+
+
+def _repoint_relations(
+    column: str, old_node_id: int, new_node_id: int, user_id: int = None
+) -> Dict[str, int]:
+    """Point `column` (`src_id` or `dst_id`) of relations to another node
+
+    Relations which would duplicate an existing relation are collapsed
+    (see module docstring) instead of being rewritten.
+    """
+    other_column = "dst_id" if column == "src_id" else "src_id"
+    existing = aliased(Relation)
+    # relation (with `column` = old) which has a twin with `column` = new
+    has_duplicate = select(existing.id).where(
+        getattr(existing, column) == new_node_id,
+        existing.line_id == Relation.line_id,
+        existing.annotator_id == Relation.annotator_id,
+        getattr(existing, other_column) == getattr(Relation, other_column),
+        existing.label_id == Relation.label_id,
+        existing.detail.is_not_distinct_from(Relation.detail),
+    ).exists()
+
+    # restore the deleted twins of live duplicates
+    duplicate = aliased(Relation)
+    has_live_duplicate = select(duplicate.id).where(
+        getattr(duplicate, column) == old_node_id,
+        duplicate.is_deleted == False,  # noqa
+        duplicate.line_id == Relation.line_id,
+        duplicate.annotator_id == Relation.annotator_id,
+        getattr(duplicate, other_column) == getattr(Relation, other_column),
+        duplicate.label_id == Relation.label_id,
+        duplicate.detail.is_not_distinct_from(Relation.detail),
+    ).exists()
+    restored = _update_relations(
+        [
+            getattr(Relation, column) == new_node_id,
+            Relation.is_deleted == True,  # noqa
+            has_live_duplicate
+        ],
+        {"is_deleted": False},
+        user_id=user_id
+    )
+
+    collapsed = _update_relations(
+        [
+            getattr(Relation, column) == old_node_id,
+            Relation.is_deleted == False,  # noqa
+            has_duplicate
+        ],
+        {"is_deleted": True},
+        user_id=user_id
+    )
+
+    updated = _update_relations(
+        [getattr(Relation, column) == old_node_id, ~has_duplicate],
+        {column: new_node_id},
+        user_id=user_id
+    )
+    return {"updated": updated, "collapsed": collapsed, "restored": restored}
+
+
+def _merge_node(
+    old_node: Node,
+    new_node: Node,
+    delete_node: bool = True,
+    user_id: int = None
+) -> Dict[str, int]:
+    """Statements of `merge_nodes()`, without validation and commit"""
+    report = {
+        "relations_updated": 0,
+        "relations_collapsed": 0,
+        "relations_restored": 0,
+        "nodes_deleted": 0,
+    }
+    for column in ["src_id", "dst_id"]:
+        result = _repoint_relations(
+            column, old_node.id, new_node.id, user_id=user_id
+        )
+        for key, count in result.items():
+            report[f"relations_{key}"] += count
+
+    if delete_node and not old_node.is_deleted:
+        node_condition = [Node.id == old_node.id]
+        log_bulk_change(
+            ENTITY_NODE, OPERATION_UPDATE,
+            select(Node.id).where(*node_condition),
+            after={"is_deleted": True}, user_id=user_id
+        )
+        report["nodes_deleted"] = db.session.execute(
+            update(Node).where(*node_condition).values(is_deleted=True)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        refresh_concordance([(old_node.lexicon_id, old_node.line_id)])
+    return report
+
+
+def merge_nodes(
+    old_node_id: int,
+    new_node_id: int,
+    delete_node: bool = True,
+    user_id: int = None
+) -> Dict[str, int]:
+    """Merge a node into another node
+
+    Every relation referring to `old_node_id` (as source or target) is
+    pointed to `new_node_id`, duplicate relations are collapsed, and
+    `old_node_id` is soft-deleted, all in a single transaction.
+
+    Both nodes must belong to the same line, since a relation only refers
+    to nodes of its own line.
+
+    Parameters
+    ----------
+    old_node_id : int
+        ID of the node to merge (source)
+    new_node_id : int
+        ID of the node to merge into (target)
+    delete_node : bool, optional
+        If True, soft-delete the source node.
+        The default is True.
+    user_id : int, optional
+        ID of the user making the change (for the change log).
+        The default is None.
+
+    Returns
+    -------
+    dict
+        Number of affected rows,
+        `relations_updated`: relations pointed to the target node,
+        `relations_collapsed`: duplicate relations soft-deleted,
+        `relations_restored`: deleted relations restored in place of
+        collapsed live duplicates,
+        `nodes_deleted`: source nodes soft-deleted (0 or 1)
+
+    Raises
+    ------
+    ValueError
+        If either of the nodes does not exist, the nodes are the same or
+        belong to different lines, or the target node is deleted
+    """
+    old_node_id = int(old_node_id)
+    new_node_id = int(new_node_id)
+    if old_node_id == new_node_id:
+        raise ValueError("Cannot merge a node into itself.")
+
+    old_node = Node.query.get(old_node_id)
+    new_node = Node.query.get(new_node_id)
+    if old_node is None or new_node is None:
+        raise ValueError("Node does not exist.")
+    if old_node.line_id != new_node.line_id:
+        raise ValueError("Cannot merge nodes of different lines.")
+    if new_node.is_deleted:
+        raise ValueError(f"Node {new_node_id} is deleted.")
+
+    try:
+        report = _merge_node(
+            old_node, new_node, delete_node=delete_node, user_id=user_id
+        )
+    except Exception:
+        db.session.rollback()
+        raise
+    else:
+        db.session.commit()
+
+    LOGGER.info(f"Merged node {old_node_id} into {new_node_id}: {report}")
+    return report
+
+###############################################################################
+
+
+def _merge_lexicon_nodes(
+    source_id: int, target_id: int, user_id: int = None
+) -> Dict[str, int]:
+    """Point the nodes (and actions) of a lexicon entry to another entry
+
+    Statements of `merge_lexicons()` for a single source entry in the
+    current database (shard), without commit.
+    """
+    report = {
+        "nodes_updated": 0,
+        "nodes_merged": 0,
+        "nodes_restored": 0,
+        "nodes_archived": 0,
+        "relations_updated": 0,
+        "relations_collapsed": 0,
+        "relations_restored": 0,
+        "relations_archived": 0,
+        "actions_updated": 0,
+        "actions_deleted": 0,
+    }
+
+    # source nodes which would collide with a target node
+    twin = aliased(Node)
+    is_twin = [
+        twin.lexicon_id == target_id,
+        twin.line_id == Node.line_id,
+        twin.annotator_id == Node.annotator_id,
+        twin.label_id == Node.label_id,
+    ]
+    has_twin = select(twin.id).where(*is_twin).exists()
+    collisions = db.session.query(Node, twin).join(
+        twin, and_(*is_twin)
+    ).filter(Node.lexicon_id == source_id).all()
+
+    concordance_line_ids = {
+        line_id
+        for line_id, in db.session.query(Concordance.line_id).filter(
+            Concordance.lexicon_id == source_id
+        ).distinct()
+    }
+
+    if collisions:
+        # restore the deleted target nodes of live source nodes
+        source = aliased(Node)
+        has_live_source = select(source.id).where(
+            source.lexicon_id == source_id,
+            source.is_deleted == False,  # noqa
+            source.line_id == Node.line_id,
+            source.annotator_id == Node.annotator_id,
+            source.label_id == Node.label_id,
+        ).exists()
+        restore_conditions = [
+            Node.lexicon_id == target_id,
+            Node.is_deleted == True,  # noqa
+            has_live_source
+        ]
+        log_bulk_change(
+            ENTITY_NODE, OPERATION_UPDATE,
+            select(Node.id).where(*restore_conditions),
+            after={"is_deleted": False}, user_id=user_id
+        )
+        report["nodes_restored"] = db.session.execute(
+            update(Node).where(*restore_conditions).values(is_deleted=False)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+
+        for old_node, new_node in collisions:
+            result = _merge_node(
+                old_node, new_node, delete_node=False, user_id=user_id
+            )
+            for key, count in result.items():
+                if key in report:
+                    report[key] += count
+        report["nodes_merged"] = len(collisions)
+
+        # merged nodes (and collapsed relations) can not refer to the
+        # target, as they duplicate existing rows
+        archived = archive_nodes(
+            [old_node.id for old_node, _ in collisions], user_id=user_id
+        )
+        report["nodes_archived"] = archived["nodes"]
+        report["relations_archived"] = archived["relations"]
+
+    node_conditions = [Node.lexicon_id == source_id, ~has_twin]
+    log_bulk_change(
+        ENTITY_NODE, OPERATION_UPDATE,
+        select(Node.id).where(*node_conditions),
+        after={"lexicon_id": target_id}, user_id=user_id
+    )
+    report["nodes_updated"] = db.session.execute(
+        update(Node).where(*node_conditions).values(lexicon_id=target_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.execute(
+        update(NodeArchive).where(NodeArchive.lexicon_id == source_id)
+        .values(lexicon_id=target_id)
+        .execution_options(synchronize_session=False)
+    )
+
+    # actions (no change log), duplicates are removed
+    twin_action = aliased(Action)
+    has_twin_action = select(twin_action.id).where(
+        twin_action.actor_id == target_id,
+        twin_action.line_id == Action.line_id,
+        twin_action.annotator_id == Action.annotator_id,
+        twin_action.actor_label_id == Action.actor_label_id,
+        twin_action.label_id == Action.label_id,
+    ).exists()
+    report["actions_deleted"] = db.session.execute(
+        delete(Action).where(Action.actor_id == source_id, has_twin_action)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    report["actions_updated"] = db.session.execute(
+        update(Action).where(Action.actor_id == source_id)
+        .values(actor_id=target_id)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+    refresh_concordance(
+        (lexicon_id, line_id)
+        for line_id in concordance_line_ids
+        for lexicon_id in [source_id, target_id]
+    )
+    return report
+
+
+def merge_lexicons(
+    source_ids: Iterable[int],
+    target_id: int,
+    user_id: int = None
+) -> Dict[str, int]:
+    """Merge one or more lexicon entries into another entry
+
+    Every node of the source entries is pointed to the target entry.
+    A source node which would duplicate a node of the target entry (same
+    line, annotator and label) is merged into that node (see
+    `merge_nodes()`) and then archived along with the relations still
+    referring to it. Finally, the (orphaned) source entries are deleted.
+
+    All the changes are made in a single transaction of `db.session`, and
+    any error rolls all of them back. With sharding enabled, the transaction
+    spans the main database and every shard. Shards then only write their
+    own tables: the change log entries of their changes are collected (see
+    `utils.changelog.defer_changes()`) and added through the main database
+    along with the deletion of the source entries, since writing the shared
+    tables through several connections of one transaction would deadlock.
+    The databases are committed one after another at the end (there is no
+    two-phase commit), so only a failure of the commit itself can leave the
+    merge partially applied.
+
+    Parameters
+    ----------
+    source_ids : Iterable[int]
+        IDs of the lexicon entries to merge
+    target_id : int
+        ID of the lexicon entry to merge into
+    user_id : int, optional
+        ID of the user making the change (for the change log).
+        The default is None.
+
+    Returns
+    -------
+    dict
+        Number of affected rows, `nodes_updated` (pointed to the target),
+        `nodes_merged` (into a node of the target), `nodes_restored`
+        (deleted target nodes restored in place of live merged nodes),
+        `nodes_archived`, `relations_updated`, `relations_collapsed`,
+        `relations_restored`, `relations_archived`, `actions_updated`,
+        `actions_deleted` (duplicates) and `lexicons_deleted`
+
+    Raises
+    ------
+    ValueError
+        If any of the lexicon entries does not exist, or the target entry
+        is one of the source entries
+    """
+    source_ids = sorted({int(source_id) for source_id in source_ids})
+    target_id = int(target_id)
+    if not source_ids:
+        raise ValueError("No lexicon entries to merge.")
+    if target_id in source_ids:
+        raise ValueError("Cannot merge a lexicon entry into itself.")
+
+    lexicon_ids = {
+        lexicon_id
+        for lexicon_id, in db.session.query(Lexicon.id).filter(
+            Lexicon.id.in_(source_ids + [target_id])
+        )
+    }
+    missing = set(source_ids + [target_id]) - lexicon_ids
+    if missing:
+        raise ValueError(f"Lexicon entries do not exist: {sorted(missing)}")
+
+    report = {}
+    try:
+        with defer_changes() as changes:
+            for shard_id in shards.iter_shards():
+                with shards.use_shard(shard_id):
+                    for source_id in source_ids:
+                        result = _merge_lexicon_nodes(
+                            source_id, target_id, user_id=user_id
+                        )
+                        for key, count in result.items():
+                            report[key] = report.get(key, 0) + count
+
+        add_changes(changes)
+        lexicon_conditions = [Lexicon.id.in_(source_ids)]
+        log_bulk_change(
+            ENTITY_LEXICON, OPERATION_DELETE,
+            select(Lexicon.id).where(*lexicon_conditions),
+            user_id=user_id
+        )
+        report["lexicons_deleted"] = db.session.execute(
+            delete(Lexicon).where(*lexicon_conditions)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    except Exception:
+        db.session.rollback()
+        raise
+    else:
+        db.session.commit()
+
+    LOGGER.info(f"Merged lexicon {source_ids} into {target_id}: {report}")
+    return report
+
+###############################################################################
@@ -0,0 +1,1468 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Embedded Cypher Engine
+
+Runs the read-only subset of Cypher generated by the query templates and
+the query builder against an in-memory `PropertyGraph`, for deployments
+without a Neo4j server. Results are in the format of `Graph.run_query()`,
+i.e. a triple of (matches, nodes, edges).
+
+Supported subset,
+* MATCH (one or more clauses) with comma separated patterns, path
+  variables (`p = ...`), node labels and property maps, relationship types
+  (`[r:A|B]`), directions and variable length (`*`, `*2`, `*1..3`, `*..3`)
+* WHERE with AND, OR, XOR, NOT, comparisons (`=`, `<>`, `<`, `<=`, `>`,
+  `>=`), regular expressions (`=~`), IN, STARTS WITH, ENDS WITH, CONTAINS,
+  IS [NOT] NULL and label predicates (`n:Label`)
+* RETURN [DISTINCT] `*` or expressions (with AS), using the functions
+  id(), labels(), type(), length(), nodes(), relationships(), size(),
+  toLower(), toUpper() and the aggregates count(), collect(), min(),
+  max(), sum(), avg()
+* ORDER BY (ASC, DESC), SKIP and LIMIT
+Anything else raises `CypherError`.
+
+Matching follows Cypher semantics, i.e. a relationship is used at most once
+per MATCH clause, and undirected patterns match in both directions.
+Nodes keep their `PropertyGraph` IDs as identity, relationships are
+numbered in the order of the graph edges.
+
+Labels and relationship types are indexed, and so are property values
+(on first use of a property in an equality condition). Every pattern is
+matched starting from its most selective node, and the conditions of
+WHERE are checked as soon as their variables are bound.
+
+A query may be given a `threading.Event`, which is checked while matching;
+once it is set, the query stops with `CypherCancelled` (e.g. when its
+query job is cancelled or times out).
+
+`EmbeddedGraph` keeps an engine over a JSONL snapshot of the graph (or
+over a graph built from the annotations) and reloads it when the source
+changes.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import os
+import re
+import time
+import logging
+import itertools
+import threading
+from collections import namedtuple
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+
+from utils.property_graph import PropertyGraph
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+PREFIX_N = "N:"
+PREFIX_R = "R:"
+
+TOKEN_PATTERN = re.compile(
+    r"""
+    (?P<space>\s+|//[^\n]*|/\*.*?\*/)
+    | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+    | (?P<number>\d+\.\d+|\d+)
+    | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    | (?P<quoted>`(?:[^`]|``)*`)
+    | (?P<symbol><-|->|<>|<=|>=|=~|\.\.|[-=<>()\[\]{}:,.*|])
+    """,
+    re.VERBOSE | re.DOTALL
+)
+STRING_ESCAPES = {
+    "\\": "\\", "'": "'", '"': '"', "n": "\n", "t": "\t", "r": "\r",
+}
+
+AGGREGATE_FUNCTIONS = ["count", "collect", "min", "max", "sum", "avg"]
+COMPARISON_OPERATORS = ["=", "<>", "<", "<=", ">", ">=", "=~"]
+
+# Prefix of the names given to anonymous pattern elements
+ANONYMOUS = " "
+
+DEFAULT_REFRESH_INTERVAL = 300
+
+###############################################################################
+
+
+class CypherError(Exception):
+    """Query is invalid or outside of the supported subset"""
+
+
+class CypherCancelled(CypherError):
+    """Query was cancelled while running"""
+
+
+Token = namedtuple("Token", ["kind", "value", "start", "end"])
+NodePattern = namedtuple("NodePattern", ["var", "labels", "properties"])
+RelationPattern = namedtuple(
+    "RelationPattern",
+    ["var", "types", "direction", "min_hops", "max_hops", "properties"]
+)
+Pattern = namedtuple("Pattern", ["path", "nodes", "relations"])
+ReturnItem = namedtuple("ReturnItem", ["expression", "name"])
+OrderItem = namedtuple("OrderItem", ["expression", "text", "descending"])
+
+###############################################################################
+# Graph Entities
+
+
+class _Node:
+    __slots__ = ("id", "labels", "properties", "outgoing", "incoming")
+
+    def __init__(self, node_id, labels, properties):
+        self.id = node_id
+        self.labels = labels
+        self.properties = properties
+        # relationship type -> relationships
+        self.outgoing = {}
+        self.incoming = {}
+
+
+class _Relationship:
+    __slots__ = ("id", "type", "start", "end", "properties")
+
+    def __init__(self, relationship_id, relationship_type, start, end,
+                 properties):
+        self.id = relationship_id
+        self.type = relationship_type
+        self.start = start
+        self.end = end
+        self.properties = properties
+
+
+class _Path:
+    __slots__ = ("nodes", "relationships")
+
+    def __init__(self, nodes, relationships):
+        self.nodes = nodes
+        self.relationships = relationships
+
+###############################################################################
+# Parser
+
+
+def tokenize(query: str) -> List[Token]:
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if match is None:
+            raise CypherError(
+                f"Invalid input '{query[position:position + 10]}'."
+            )
+        kind = match.lastgroup
+        if kind != "space":
+            tokens.append(
+                Token(kind, match.group(kind), match.start(), match.end())
+            )
+        position = match.end()
+    return tokens
+
+
+def _unquote_string(text: str) -> str:
+    chars = []
+    body = iter(text[1:-1])
+    for char in body:
+        if char == "\\":
+            escaped = next(body, "")
+            # unknown escapes are kept as they are (e.g. in regexes)
+            chars.append(STRING_ESCAPES.get(escaped, "\\" + escaped))
+        else:
+            chars.append(char)
+    return "".join(chars)
+
+
+class _Parser:
+    """Recursive descent parser for the supported subset"""
+
+    def __init__(self, query: str):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.position = 0
+        self.anonymous_count = 0
+
+    # ----------------------------------------------------------------------- #
+
+    def peek(self, offset: int = 0) -> Token:
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def at(self, *values: str, offset: int = 0) -> bool:
+        """Is the next token one of the symbols or keywords"""
+        token = self.peek(offset)
+        if token is None or token.kind not in ("symbol", "name"):
+            return False
+        value = token.value.upper() if token.kind == "name" else token.value
+        return value in values
+
+    def accept(self, *values: str) -> Token:
+        if self.at(*values):
+            self.position += 1
+            return self.tokens[self.position - 1]
+        return None
+
+    def expect(self, *values: str) -> Token:
+        token = self.accept(*values)
+        if token is None:
+            found = self.peek()
+            found = f"'{found.value}'" if found else "end of query"
+            raise CypherError(f"Expected {' or '.join(values)}, "
+                              f"found {found}.")
+        return token
+
+    def identifier(self) -> str:
+        token = self.peek()
+        if token is None or token.kind not in ("name", "quoted"):
+            raise CypherError("Expected a name.")
+        self.position += 1
+        if token.kind == "quoted":
+            return token.value[1:-1].replace("``", "`")
+        return token.value
+
+    def anonymous(self) -> str:
+        self.anonymous_count += 1
+        return f"{ANONYMOUS}{self.anonymous_count}"
+
+    # ----------------------------------------------------------------------- #
+
+    def parse(self) -> Dict:
+        matches = []
+        while self.accept("MATCH"):
+            patterns = [self.pattern()]
+            while self.accept(","):
+                patterns.append(self.pattern())
+            where = self.expression() if self.accept("WHERE") else None
+            matches.append((patterns, where))
+
+        if not matches:
+            raise CypherError("Query must start with MATCH.")
+        if self.at("OPTIONAL", "WITH", "UNWIND", "CALL", "UNION"):
+            raise CypherError(f"{self.peek().value.upper()} is not "
+                              "supported by the embedded graph engine.")
+        self.expect("RETURN")
+        query = {"matches": matches}
+        query.update(self.return_clause())
+        if self.peek() is not None:
+            raise CypherError(f"Unexpected '{self.peek().value}'.")
+        return query
+
+    def return_clause(self) -> Dict:
+        distinct = bool(self.accept("DISTINCT"))
+        items = None
+        if not self.accept("*"):
+            items = [self.return_item()]
+            while self.accept(","):
+                items.append(self.return_item())
+
+        order = []
+        if self.accept("ORDER"):
+            self.expect("BY")
+            while True:
+                start = self.peek()
+                expression = self.expression()
+                text = self.text_since(start)
+                descending = bool(self.accept("DESC", "DESCENDING"))
+                if not descending:
+                    self.accept("ASC", "ASCENDING")
+                order.append(OrderItem(expression, text, descending))
+                if not self.accept(","):
+                    break
+
+        skip = self.integer() if self.accept("SKIP") else 0
+        limit = self.integer() if self.accept("LIMIT") else None
+        return {
+            "distinct": distinct,
+            "items": items,
+            "order": order,
+            "skip": skip,
+            "limit": limit,
+        }
+
+    def return_item(self) -> ReturnItem:
+        start = self.peek()
+        expression = self.expression()
+        name = self.text_since(start)
+        if self.accept("AS"):
+            name = self.identifier()
+        return ReturnItem(expression, name)
+
+    def text_since(self, start: Token) -> str:
+        end = self.tokens[self.position - 1]
+        return self.query[start.start:end.end]
+
+    def integer(self) -> int:
+        token = self.peek()
+        if token is None or token.kind != "number" or "." in token.value:
+            raise CypherError("Expected an integer.")
+        self.position += 1
+        return int(token.value)
+
+    # ----------------------------------------------------------------------- #
+    # Patterns
+
+    def pattern(self) -> Pattern:
+        path = None
+        token = self.peek(1)
+        if token is not None and token.value == "=" and not self.at("("):
+            path = self.identifier()
+            self.expect("=")
+
+        nodes = [self.node_pattern()]
+        relations = []
+        while self.at("-", "<-"):
+            relations.append(self.relation_pattern())
+            nodes.append(self.node_pattern())
+        return Pattern(path, nodes, relations)
+
+    def node_pattern(self) -> NodePattern:
+        self.expect("(")
+        var = self.anonymous()
+        if not self.at(":", "{", ")"):
+            var = self.identifier()
+        labels = []
+        while self.accept(":"):
+            labels.append(self.identifier())
+        properties = self.property_map() if self.at("{") else {}
+        self.expect(")")
+        return NodePattern(var, tuple(labels), properties)
+
+    def relation_pattern(self) -> RelationPattern:
+        incoming = bool(self.accept("<-"))
+        if not incoming:
+            self.expect("-")
+
+        var = None
+        types = []
+        min_hops = max_hops = 1
+        variable_length = False
+        properties = {}
+        if self.accept("["):
+            if not self.at(":", "*", "{", "]"):
+                var = self.identifier()
+            if self.accept(":"):
+                types.append(self.identifier())
+                while self.accept("|"):
+                    self.accept(":")
+                    types.append(self.identifier())
+            if self.accept("*"):
+                variable_length = True
+                min_hops, max_hops = 1, None
+                if self.peek() and self.peek().kind == "number":
+                    min_hops = max_hops = self.integer()
+                if self.accept(".."):
+                    max_hops = None
+                    if self.peek() and self.peek().kind == "number":
+                        max_hops = self.integer()
+            if self.at("{"):
+                properties = self.property_map()
+            self.expect("]")
+
+        outgoing = bool(self.accept("->"))
+        if not outgoing:
+            self.expect("-")
+
+        if incoming and not outgoing:
+            direction = "in"
+        elif outgoing and not incoming:
+            direction = "out"
+        else:
+            direction = "both"
+        # single relationships have no hop range (and bind no list)
+        if (min_hops, max_hops) == (1, 1) and not variable_length:
+            min_hops = max_hops = None
+        return RelationPattern(
+            var or self.anonymous(), tuple(types), direction,
+            min_hops, max_hops, properties
+        )
+
+    def property_map(self) -> Dict:
+        self.expect("{")
+        properties = {}
+        if not self.at("}"):
+            while True:
+                key = self.identifier()
+                self.expect(":")
+                value = self.expression()
+                if value[0] != "literal":
+                    raise CypherError("Property values must be literals.")
+                properties[key] = value[1]
+                if not self.accept(","):
+                    break
+        self.expect("}")
+        return properties
+
+    # ----------------------------------------------------------------------- #
+    # Expressions
+
+    def expression(self) -> Tuple:
+        left = self.xor_expression()
+        while self.accept("OR"):
+            left = ("or", left, self.xor_expression())
+        return left
+
+    def xor_expression(self) -> Tuple:
+        left = self.and_expression()
+        while self.accept("XOR"):
+            left = ("xor", left, self.and_expression())
+        return left
+
+    def and_expression(self) -> Tuple:
+        left = self.not_expression()
+        while self.accept("AND"):
+            left = ("and", left, self.not_expression())
+        return left
+
+    def not_expression(self) -> Tuple:
+        if self.accept("NOT"):
+            return ("not", self.not_expression())
+        return self.comparison()
+
+    def comparison(self) -> Tuple:
+        left = self.postfix()
+        while True:
+            if self.at(*COMPARISON_OPERATORS):
+                operator = self.peek().value
+                self.position += 1
+                left = ("compare", operator, left, self.postfix())
+            elif self.accept("IN"):
+                left = ("compare", "IN", left, self.postfix())
+            elif self.at("STARTS", "ENDS"):
+                operator = self.identifier().upper()
+                self.expect("WITH")
+                left = ("compare", operator, left, self.postfix())
+            elif self.accept("CONTAINS"):
+                left = ("compare", "CONTAINS", left, self.postfix())
+            elif self.accept("IS"):
+                negate = bool(self.accept("NOT"))
+                self.expect("NULL")
+                left = ("is_null", left, negate)
+            else:
+                return left
+
+    def postfix(self) -> Tuple:
+        expression = self.atom()
+        while True:
+            if self.accept("."):
+                expression = ("property", expression, self.identifier())
+            elif self.at(":") and expression[0] == "var":
+                labels = []
+                while self.accept(":"):
+                    labels.append(self.identifier())
+                expression = ("has_labels", expression, tuple(labels))
+            else:
+                return expression
+
+    def atom(self) -> Tuple:
+        token = self.peek()
+        if token is None:
+            raise CypherError("Unexpected end of query.")
+
+        if token.kind == "string":
+            self.position += 1
+            return ("literal", _unquote_string(token.value))
+        if token.kind == "number":
+            self.position += 1
+            value = token.value
+            return ("literal", float(value) if "." in value else int(value))
+        if self.accept("-"):
+            number = self.atom()
+            if number[0] != "literal" or isinstance(number[1], str):
+                raise CypherError("Expected a number after '-'.")
+            return ("literal", -number[1])
+        if self.accept("("):
+            expression = self.expression()
+            self.expect(")")
+            return expression
+        if self.accept("["):
+            items = []
+            if not self.at("]"):
+                items.append(self.expression())
+                while self.accept(","):
+                    items.append(self.expression())
+            self.expect("]")
+            return ("list", items)
+        if self.at("TRUE", "FALSE", "NULL") and not self.at("(", offset=1):
+            value = self.identifier().upper()
+            return ("literal", {"TRUE": True, "FALSE": False}.get(value))
+
+        name = self.identifier()
+        if self.accept("("):
+            function = name.lower()
+            distinct = bool(self.accept("DISTINCT"))
+            arguments = []
+            if self.accept("*"):
+                if function != "count":
+                    raise CypherError("Only count(*) accepts '*'.")
+                arguments = None
+            elif not self.at(")"):
+                arguments.append(self.expression())
+                while self.accept(","):
+                    arguments.append(self.expression())
+            self.expect(")")
+            return ("call", function, distinct, arguments)
+        return ("var", name)
+
+
+def parse_query(query: str) -> Dict:
+    """Parse a query of the supported subset"""
+    return _Parser(query).parse()
+
+###############################################################################
+# Values
+
+
+def _variables(expression: Tuple) -> set:
+    """Variables referred to by an expression"""
+    kind = expression[0]
+    if kind == "var":
+        return {expression[1]}
+    if kind == "literal":
+        return set()
+    if kind == "list":
+        return set().union(*map(_variables, expression[1]))
+    if kind == "call":
+        return set().union(*map(_variables, expression[3] or []))
+    if kind == "compare":
+        return _variables(expression[2]) | _variables(expression[3])
+    if kind in ("and", "or", "xor"):
+        return _variables(expression[1]) | _variables(expression[2])
+    # not, property, has_labels, is_null
+    return _variables(expression[1])
+
+
+def _conjuncts(expression: Tuple) -> List[Tuple]:
+    """Top level AND conditions of an expression"""
+    if expression is None:
+        return []
+    if expression[0] == "and":
+        return _conjuncts(expression[1]) + _conjuncts(expression[2])
+    return [expression]
+
+
+def _is_aggregate(expression: Tuple) -> bool:
+    return (
+        expression[0] == "call" and expression[1] in AGGREGATE_FUNCTIONS
+    )
+
+
+def _hashable(value: Any) -> Any:
+    """Hashable key of a value, e.g. for DISTINCT and grouping"""
+    if isinstance(value, _Node):
+        return ("node", value.id)
+    if isinstance(value, _Relationship):
+        return ("relationship", value.id)
+    if isinstance(value, _Path):
+        return (
+            "path",
+            tuple(node.id for node in value.nodes),
+            tuple(relationship.id for relationship in value.relationships)
+        )
+    if isinstance(value, (list, tuple)):
+        return ("list", tuple(_hashable(item) for item in value))
+    if isinstance(value, dict):
+        return ("map", tuple(
+            (key, _hashable(item)) for key, item in sorted(value.items())
+        ))
+    return (type(value).__name__, value)
+
+
+def _index_key(value: Any) -> Tuple:
+    """Key of a scalar property value in the property index (1 = 1.0)"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return ("number", value)
+    return _hashable(value)
+
+
+def _sort_key(value: Any) -> Tuple:
+    """Sort key following the Cypher ordering of values (null last)"""
+    if value is None:
+        return (9,)
+    if isinstance(value, bool):
+        return (6, value)
+    if isinstance(value, (int, float)):
+        return (7, value)
+    if isinstance(value, str):
+        return (5, value)
+    if isinstance(value, (list, tuple)):
+        return (3, tuple(_sort_key(item) for item in value))
+    if isinstance(value, _Path):
+        return (4, _hashable(value))
+    if isinstance(value, _Relationship):
+        return (2, str(value.id))
+    if isinstance(value, _Node):
+        return (1, str(value.id))
+    return (0, str(value))
+
+
+def _check_cancelled(context: Dict):
+    cancelled = context["cancelled"]
+    if cancelled is not None and cancelled.is_set():
+        raise CypherCancelled("Query was cancelled.")
+
+
+def _equals(left: Any, right: Any) -> bool:
+    if left is None or right is None:
+        return None
+    if isinstance(left, (list, tuple)) and isinstance(right, (list, tuple)):
+        if len(left) != len(right):
+            return False
+        results = [_equals(a, b) for a, b in zip(left, right)]
+        if False in results:
+            return False
+        return None if None in results else True
+    if isinstance(left, bool) != isinstance(right, bool):
+        return False
+    return _hashable(left) == _hashable(right) or (
+        isinstance(left, (int, float)) and
+        isinstance(right, (int, float)) and
+        left == right
+    )
+
+###############################################################################
+# Engine
+
+
+class CypherEngine:
+    """Executor of the supported Cypher subset over a `PropertyGraph`"""
+
+    def __init__(self, graph: PropertyGraph, version: str = None):
+        self.version = version
+        self.nodes = {}
+        self.all_nodes = []
+        self.relationships = []
+        self.label_index = {}
+        self.property_index = {}
+        self._regex_cache = {}
+
+        for node_id, node in graph.nodes.items():
+            _node = _Node(node_id, list(node.labels), dict(node.properties))
+            self.nodes[node_id] = _node
+            self.all_nodes.append(_node)
+            for label in _node.labels:
+                self.label_index.setdefault(label, []).append(_node)
+
+        for (src_id, label, dst_id), edge in graph.edges.items():
+            start = self.nodes[src_id]
+            end = self.nodes[dst_id]
+            relationship = _Relationship(
+                len(self.relationships), label, start, end,
+                dict(edge.properties)
+            )
+            self.relationships.append(relationship)
+            start.outgoing.setdefault(label, []).append(relationship)
+            end.incoming.setdefault(label, []).append(relationship)
+
+        self._index_lock = threading.Lock()
+
+    # ----------------------------------------------------------------------- #
+
+    def run_query(self, query: str, cancelled: threading.Event = None):
+        """Execute a query (see `Graph.run_query()`)
+
+        Raises
+        ------
+        CypherError
+            If the query is invalid, or outside of the supported subset
+        CypherCancelled
+            If `cancelled` is set while the query is running
+        """
+        return self.convert_result(self.execute(query, cancelled=cancelled))
+
+    def execute(
+        self,
+        query: str,
+        cancelled: threading.Event = None
+    ) -> List[Dict[str, Any]]:
+        """Rows of the result of a query, with entities as objects"""
+        parsed = parse_query(query)
+
+        rows = iter([{}])
+        bound = set()
+        for patterns, where in parsed["matches"]:
+            rows = self._match_clause(
+                patterns, where, rows, set(bound), cancelled
+            )
+            for pattern in patterns:
+                bound.update(node.var for node in pattern.nodes)
+                bound.update(
+                    relation.var for relation in pattern.relations
+                )
+                if pattern.path:
+                    bound.add(pattern.path)
+        return self._project(parsed, rows, bound)
+
+    # ----------------------------------------------------------------------- #
+    # Matching
+
+    def _match_clause(
+        self,
+        patterns: List[Pattern],
+        where: Tuple,
+        rows: Iterator[Dict],
+        bound: set,
+        cancelled: threading.Event = None
+    ) -> Iterator[Dict]:
+        clause_vars = set(bound)
+        for pattern in patterns:
+            clause_vars.update(node.var for node in pattern.nodes)
+            clause_vars.update(relation.var for relation in pattern.relations)
+            if pattern.path:
+                clause_vars.add(pattern.path)
+
+        # conditions are checked as soon as their variables are bound
+        checks = {}
+        initial_checks = []
+        hints = {}
+        for condition in _conjuncts(where):
+            variables = _variables(condition)
+            undefined = variables - clause_vars
+            if undefined:
+                raise CypherError(
+                    f"Variable `{sorted(undefined)[0]}` not defined."
+                )
+            if not variables - bound:
+                initial_checks.append(condition)
+            for var in variables - bound:
+                checks.setdefault(var, []).append((condition, variables))
+            self._add_hint(hints, condition)
+
+        context = {"checks": checks, "hints": hints, "cancelled": cancelled}
+        for row in rows:
+            if all(self._test(condition, row) for condition in initial_checks):
+                yield from self._match_patterns(
+                    patterns, 0, row, frozenset(), context
+                )
+
+    def _add_hint(self, hints: Dict, condition: Tuple):
+        """Record label and property equality conditions on variables"""
+        if condition[0] == "has_labels":
+            var = condition[1][1]
+            hints.setdefault(var, ((), {}))
+            labels, properties = hints[var]
+            hints[var] = (labels + condition[2], properties)
+        elif condition[0] == "compare" and condition[1] == "=":
+            left, right = condition[2], condition[3]
+            if left[0] == "literal":
+                left, right = right, left
+            if (
+                left[0] == "property" and left[1][0] == "var" and
+                right[0] == "literal"
+            ):
+                var = left[1][1]
+                hints.setdefault(var, ((), {}))
+                hints[var][1].setdefault(left[2], right[1])
+
+    def _bind(self, row: Dict, var: str, value: Any, context: Dict) -> Dict:
+        """Row with the variable bound, or None if a condition fails"""
+        row = {**row, var: value}
+        for condition, variables in context["checks"].get(var, []):
+            if variables <= row.keys() and not self._test(condition, row):
+                return None
+        return row
+
+    def _match_patterns(
+        self,
+        patterns: List[Pattern],
+        index: int,
+        row: Dict,
+        used: frozenset,
+        context: Dict
+    ) -> Iterator[Dict]:
+        if index == len(patterns):
+            yield row
+            return
+        for _row, _used in self._match_pattern(
+            patterns[index], row, used, context
+        ):
+            yield from self._match_patterns(
+                patterns, index + 1, _row, _used, context
+            )
+
+    def _match_pattern(
+        self,
+        pattern: Pattern,
+        row: Dict,
+        used: frozenset,
+        context: Dict
+    ) -> Iterator[Tuple[Dict, frozenset]]:
+        # start from the most selective node
+        candidates = [
+            self._candidates(node, row, context) for node in pattern.nodes
+        ]
+        start = min(range(len(candidates)), key=lambda i: len(candidates[i]))
+        steps = [
+            (index, True) for index in range(start, len(pattern.relations))
+        ]
+        steps += [(index, False) for index in reversed(range(start))]
+
+        start_pattern = pattern.nodes[start]
+        for node in candidates[start]:
+            _check_cancelled(context)
+            if not self._node_matches(node, start_pattern, row, context):
+                continue
+            _row = row
+            if start_pattern.var not in row:
+                _row = self._bind(row, start_pattern.var, node, context)
+                if _row is None:
+                    continue
+            yield from self._match_steps(
+                pattern, steps, 0, _row, used, {}, context
+            )
+
+    def _match_steps(
+        self,
+        pattern: Pattern,
+        steps: List[Tuple[int, bool]],
+        step: int,
+        row: Dict,
+        used: frozenset,
+        segments: Dict,
+        context: Dict
+    ) -> Iterator[Tuple[Dict, frozenset]]:
+        if step == len(steps):
+            if pattern.path:
+                path = self._build_path(pattern, row, segments)
+                row = self._bind(row, pattern.path, path, context)
+                if row is None:
+                    return
+            yield row, used
+            return
+
+        index, forward = steps[step]
+        relation = pattern.relations[index]
+        source = pattern.nodes[index] if forward else pattern.nodes[index + 1]
+        target = pattern.nodes[index + 1] if forward else pattern.nodes[index]
+
+        for relationships, nodes in self._traverse(
+            row[source.var], relation, forward, used, context
+        ):
+            node = nodes[-1]
+            if not self._node_matches(node, target, row, context):
+                continue
+            if not forward:
+                relationships = relationships[::-1]
+                nodes = nodes[::-1]
+
+            _row = row
+            if target.var not in row:
+                _row = self._bind(_row, target.var, node, context)
+                if _row is None:
+                    continue
+            value = (
+                relationships[0] if relation.min_hops is None
+                else list(relationships)
+            )
+            if relation.var in _row:
+                if _hashable(_row[relation.var]) != _hashable(value):
+                    continue
+            else:
+                _row = self._bind(_row, relation.var, value, context)
+                if _row is None:
+                    continue
+
+            yield from self._match_steps(
+                pattern, steps, step + 1, _row,
+                used.union(r.id for r in relationships),
+                {**segments, index: (relationships, nodes)},
+                context
+            )
+
+    def _traverse(
+        self,
+        node: _Node,
+        relation: RelationPattern,
+        forward: bool,
+        used: frozenset,
+        context: Dict
+    ) -> Iterator[Tuple[Tuple[_Relationship], Tuple[_Node]]]:
+        """Relationship sequences from a node matching a relation pattern
+
+        Yields (relationships, nodes), in the order of traversal, where
+        `nodes` includes the starting node.
+        """
+        if relation.min_hops is None:
+            min_hops = max_hops = 1
+        else:
+            min_hops, max_hops = relation.min_hops, relation.max_hops
+
+        # (current node, relationships, nodes)
+        stack = [(node, (), (node,))]
+        while stack:
+            _check_cancelled(context)
+            current, relationships, nodes = stack.pop()
+            hops = len(relationships)
+            if hops >= min_hops:
+                yield relationships, nodes
+            if max_hops is not None and hops >= max_hops:
+                continue
+            for relationship, neighbour in self._neighbours(
+                current, relation, forward
+            ):
+                if relationship.id in used or relationship in relationships:
+                    continue
+                stack.append((
+                    neighbour,
+                    relationships + (relationship,),
+                    nodes + (neighbour,)
+                ))
+
+    def _neighbours(
+        self,
+        node: _Node,
+        relation: RelationPattern,
+        forward: bool
+    ) -> Iterator[Tuple[_Relationship, _Node]]:
+        direction = relation.direction
+        if not forward and direction != "both":
+            direction = "in" if direction == "out" else "out"
+
+        adjacency = []
+        if direction in ("out", "both"):
+            adjacency.append((node.outgoing, "end"))
+        if direction in ("in", "both"):
+            adjacency.append((node.incoming, "start"))
+
+        for relationships_by_type, other in adjacency:
+            if relation.types:
+                relationships = itertools.chain.from_iterable(
+                    relationships_by_type.get(relationship_type, [])
+                    for relationship_type in relation.types
+                )
+            else:
+                relationships = itertools.chain.from_iterable(
+                    relationships_by_type.values()
+                )
+            for relationship in relationships:
+                if all(
+                    _equals(relationship.properties.get(key), value)
+                    for key, value in relation.properties.items()
+                ):
+                    yield relationship, getattr(relationship, other)
+
+    def _build_path(self, pattern: Pattern, row: Dict, segments: Dict):
+        nodes = [row[pattern.nodes[0].var]]
+        relationships = []
+        for index in range(len(pattern.relations)):
+            _relationships, _nodes = segments[index]
+            relationships.extend(_relationships)
+            nodes.extend(_nodes[1:])
+        return _Path(tuple(nodes), tuple(relationships))
+
+    def _candidates(self, pattern: NodePattern, row: Dict, context: Dict):
+        """Candidate nodes for a node pattern, using the indexes"""
+        if pattern.var in row:
+            value = row[pattern.var]
+            return [value] if isinstance(value, _Node) else []
+
+        hint_labels, hint_properties = context["hints"].get(
+            pattern.var, ((), {})
+        )
+        candidates = None
+        for label in pattern.labels + hint_labels:
+            nodes = self.label_index.get(label, [])
+            if candidates is None or len(nodes) < len(candidates):
+                candidates = nodes
+        for key, value in {**hint_properties, **pattern.properties}.items():
+            nodes = self._property_nodes(key, value)
+            if nodes is not None and (
+                candidates is None or len(nodes) < len(candidates)
+            ):
+                candidates = nodes
+        if candidates is None:
+            candidates = self.all_nodes
+        return candidates
+
+    def _property_nodes(self, key: str, value: Any) -> List[_Node]:
+        """Nodes with a property value (None if the value is not indexed)"""
+        if isinstance(value, (list, dict)) or value is None:
+            return None
+        with self._index_lock:
+            index = self.property_index.get(key)
+            if index is None:
+                index = {}
+                for node in self.nodes.values():
+                    _value = node.properties.get(key)
+                    if _value is not None and not isinstance(_value, list):
+                        index.setdefault(_index_key(_value), []).append(node)
+                self.property_index[key] = index
+        return index.get(_index_key(value), [])
+
+    def _node_matches(
+        self,
+        node: _Node,
+        pattern: NodePattern,
+        row: Dict,
+        context: Dict
+    ) -> bool:
+        if pattern.var in row and row[pattern.var] is not node:
+            return False
+        if any(label not in node.labels for label in pattern.labels):
+            return False
+        return all(
+            _equals(node.properties.get(key), value)
+            for key, value in pattern.properties.items()
+        )
+
+    # ----------------------------------------------------------------------- #
+    # Expressions
+
+    def _test(self, expression: Tuple, row: Dict) -> bool:
+        return self._evaluate(expression, row) is True
+
+    def _evaluate(self, expression: Tuple, row: Dict) -> Any:
+        kind = expression[0]
+        if kind == "literal":
+            return expression[1]
+        if kind == "var":
+            if expression[1] not in row:
+                raise CypherError(
+                    f"Variable `{expression[1]}` not defined."
+                )
+            return row[expression[1]]
+        if kind == "list":
+            return [self._evaluate(item, row) for item in expression[1]]
+        if kind == "property":
+            value = self._evaluate(expression[1], row)
+            if value is None:
+                return None
+            if isinstance(value, (_Node, _Relationship)):
+                return value.properties.get(expression[2])
+            if isinstance(value, dict):
+                return value.get(expression[2])
+            raise CypherError(f"Can not get property '{expression[2]}' of "
+                              f"a {type(value).__name__}.")
+        if kind == "has_labels":
+            value = self._evaluate(expression[1], row)
+            if value is None:
+                return None
+            if not isinstance(value, _Node):
+                raise CypherError("Label predicates apply to nodes only.")
+            return all(label in value.labels for label in expression[2])
+        if kind == "is_null":
+            value = self._evaluate(expression[1], row)
+            return (value is not None) if expression[2] else (value is None)
+        if kind == "not":
+            value = self._evaluate(expression[1], row)
+            return None if value is None else not value
+        if kind in ("and", "or", "xor"):
+            return self._logical(kind, expression, row)
+        if kind == "compare":
+            return self._compare(
+                expression[1],
+                self._evaluate(expression[2], row),
+                self._evaluate(expression[3], row)
+            )
+        if kind == "call":
+            if _is_aggregate(expression):
+                raise CypherError(f"{expression[1]}() is only allowed "
+                                  "as a RETURN item.")
+            return self._call(
+                expression[1],
+                [self._evaluate(argument, row) for argument in expression[3]]
+            )
+        raise CypherError(f"Unsupported expression '{kind}'.")
+
+    def _logical(self, kind: str, expression: Tuple, row: Dict) -> Any:
+        left = self._evaluate(expression[1], row)
+        if kind == "and" and left is False:
+            return False
+        if kind == "or" and left is True:
+            return True
+        right = self._evaluate(expression[2], row)
+        if kind == "and":
+            if right is False:
+                return False
+            return None if None in (left, right) else True
+        if kind == "or":
+            if right is True:
+                return True
+            return None if None in (left, right) else False
+        return None if None in (left, right) else (bool(left) != bool(right))
+
+    def _compare(self, operator: str, left: Any, right: Any) -> Any:
+        if operator == "IN":
+            if right is None:
+                return None
+            if not isinstance(right, list):
+                raise CypherError("IN requires a list.")
+            results = [_equals(left, item) for item in right]
+            if True in results:
+                return True
+            return None if (left is None or None in results) else False
+
+        if left is None or right is None:
+            return None
+        if operator == "=":
+            return _equals(left, right)
+        if operator == "<>":
+            equal = _equals(left, right)
+            return None if equal is None else not equal
+
+        strings = isinstance(left, str) and isinstance(right, str)
+        if operator == "=~":
+            if not strings:
+                return None
+            return self._regex(right).fullmatch(left) is not None
+        if operator == "STARTS":
+            return left.startswith(right) if strings else None
+        if operator == "ENDS":
+            return left.endswith(right) if strings else None
+        if operator == "CONTAINS":
+            return (right in left) if strings else None
+
+        numbers = all(
+            isinstance(value, (int, float)) and not isinstance(value, bool)
+            for value in (left, right)
+        )
+        if not (strings or numbers):
+            return None
+        if operator == "<":
+            return left < right
+        if operator == "<=":
+            return left <= right
+        if operator == ">":
+            return left > right
+        return left >= right
+
+    def _regex(self, pattern: str):
+        regex = self._regex_cache.get(pattern)
+        if regex is None:
+            try:
+                regex = re.compile(pattern)
+            except re.error as e:
+                raise CypherError(f"Invalid regular expression: {e}")
+            self._regex_cache[pattern] = regex
+        return regex
+
+    def _call(self, function: str, arguments: List[Any]) -> Any:
+        if len(arguments) != 1:
+            raise CypherError(f"{function}() takes exactly one argument.")
+        value = arguments[0]
+        if value is None:
+            return None
+        if function == "id" and isinstance(value, (_Node, _Relationship)):
+            return value.id
+        if function == "labels" and isinstance(value, _Node):
+            return list(value.labels)
+        if function == "type" and isinstance(value, _Relationship):
+            return value.type
+        if function == "length" and isinstance(value, _Path):
+            return len(value.relationships)
+        if function == "nodes" and isinstance(value, _Path):
+            return list(value.nodes)
+        if function == "relationships" and isinstance(value, _Path):
+            return list(value.relationships)
+        if function == "size" and isinstance(value, (list, str)):
+            return len(value)
+        if function in ("tolower", "toupper") and isinstance(value, str):
+            return value.lower() if function == "tolower" else value.upper()
+        raise CypherError(f"Unsupported function {function}() for "
+                          f"a {type(value).__name__}.")
+
+    def _aggregate(self, expression: Tuple, rows: List[Dict]) -> Any:
+        function, distinct, arguments = expression[1:]
+        if arguments is None:
+            return len(rows)
+        if len(arguments) != 1:
+            raise CypherError(f"{function}() takes exactly one argument.")
+        values = [
+            value
+            for value in (self._evaluate(arguments[0], row) for row in rows)
+            if value is not None
+        ]
+        if distinct:
+            values = list({_hashable(v): v for v in values}.values())
+        if function == "count":
+            return len(values)
+        if function == "collect":
+            return values
+        if not values:
+            return None
+        if function == "min":
+            return min(values, key=_sort_key)
+        if function == "max":
+            return max(values, key=_sort_key)
+        if not all(
+            isinstance(value, (int, float)) and not isinstance(value, bool)
+            for value in values
+        ):
+            raise CypherError(f"{function}() requires numbers.")
+        if function == "sum":
+            return sum(values)
+        return sum(values) / len(values)
+
+    # ----------------------------------------------------------------------- #
+    # Projection
+
+    def _project(
+        self,
+        query: Dict,
+        rows: Iterator[Dict],
+        bound: set
+    ) -> List[Dict[str, Any]]:
+        items = query["items"]
+        if items is None:
+            names = sorted(
+                var for var in bound if not var.startswith(ANONYMOUS)
+            )
+            if not names:
+                raise CypherError("RETURN * requires named variables.")
+            items = [ReturnItem(("var", name), name) for name in names]
+
+        # every row is (projected row, source row)
+        if any(_is_aggregate(item.expression) for item in items):
+            results = self._project_groups(items, rows)
+        else:
+            for item in items:
+                undefined = _variables(item.expression) - bound
+                if undefined:
+                    raise CypherError(
+                        f"Variable `{sorted(undefined)[0]}` not defined."
+                    )
+            results = (
+                ({
+                    item.name: self._evaluate(item.expression, row)
+                    for item in items
+                }, row)
+                for row in rows
+            )
+
+        if query["distinct"]:
+            results = self._distinct(results)
+
+        order = query["order"]
+        if order:
+            results = list(results)
+            for item in reversed(order):
+                results.sort(
+                    key=lambda result: _sort_key(
+                        self._order_value(item, *result)
+                    ),
+                    reverse=item.descending
+                )
+
+        start = query["skip"]
+        stop = None if query["limit"] is None else start + query["limit"]
+        return [
+            projected
+            for projected, _ in itertools.islice(results, start, stop)
+        ]
+
+    def _project_groups(self, items: List[ReturnItem], rows: Iterator[Dict]):
+        keys = [item for item in items if not _is_aggregate(item.expression)]
+        groups = {}
+        for row in rows:
+            values = {
+                item.name: self._evaluate(item.expression, row)
+                for item in keys
+            }
+            group_key = tuple(_hashable(value) for value in values.values())
+            groups.setdefault(group_key, (values, []))[1].append(row)
+
+        if not groups and not keys:
+            groups[()] = ({}, [])
+        for values, group_rows in groups.values():
+            projected = {
+                item.name: (
+                    self._aggregate(item.expression, group_rows)
+                    if _is_aggregate(item.expression)
+                    else values[item.name]
+                )
+                for item in items
+            }
+            yield projected, (group_rows[0] if group_rows else {})
+
+    @staticmethod
+    def _distinct(results):
+        seen = set()
+        for projected, row in results:
+            key = tuple(_hashable(value) for value in projected.values())
+            if key not in seen:
+                seen.add(key)
+                yield projected, row
+
+    def _order_value(self, item: OrderItem, projected: Dict, row: Dict):
+        if item.text in projected:
+            return projected[item.text]
+        return self._evaluate(item.expression, {**row, **projected})
+
+    # ----------------------------------------------------------------------- #
+    # Result
+
+    def convert_result(self, rows: List[Dict[str, Any]]):
+        """Convert result rows into matches, nodes and edges
+
+        Returns
+        -------
+        final_matches : list
+            Rows with entities replaced by their representation
+        final_nodes : dict
+            Formatted nodes, keyed by their representation
+        final_edges : dict
+            Formatted relationships, keyed by their representation
+        """
+        final_nodes = {}
+        final_edges = {}
+        stack = [iter(row.values()) for row in rows]
+        while stack:
+            for value in stack[-1]:
+                if isinstance(value, _Node):
+                    key = self.repr_entity(value)
+                    if key not in final_nodes:
+                        final_nodes[key] = self.format_node(value)
+                elif isinstance(value, _Relationship):
+                    key = self.repr_entity(value)
+                    if key not in final_edges:
+                        final_edges[key] = self.format_edge(value)
+                elif isinstance(value, (list, tuple)):
+                    stack.append(iter(value))
+                    break
+                elif isinstance(value, _Path):
+                    stack.append(
+                        itertools.chain(value.nodes, value.relationships)
+                    )
+                    break
+            else:
+                stack.pop()
+
+        final_matches = [
+            {name: self.repr_entity(value) for name, value in row.items()}
+            for row in rows
+        ]
+        return final_matches, final_nodes, final_edges
+
+    def repr_entity(self, entity):
+        """Representation of a value, as in `Graph.repr_entity()`"""
+        if isinstance(entity, _Node):
+            return f"{PREFIX_N}{entity.id}"
+        if isinstance(entity, _Relationship):
+            return f"{PREFIX_R}{entity.id}"
+        if isinstance(entity, _Path):
+            return (self.repr_entity(entity.nodes[0]),
+                    self.repr_entity(list(entity.relationships)),
+                    self.repr_entity(entity.nodes[-1]))
+        if isinstance(entity, (list, tuple)):
+            return [self.repr_entity(e) for e in entity]
+        if isinstance(entity, dict):
+            return {k: self.repr_entity(v) for k, v in entity.items()}
+        return entity
+
+    def format_node(self, node: _Node) -> Dict:
+        return {
+            'id': self.repr_entity(node),
+            'type': 'node',
+            'labels': list(node.labels),
+            'properties': dict(node.properties)
+        }
+
+    def format_edge(self, edge: _Relationship) -> Dict:
+        return {
+            'id': self.repr_entity(edge),
+            'type': 'relationship',
+            'label': edge.type,
+            'start': {
+                'id': self.repr_entity(edge.start)
+            },
+            'end': {
+                'id': self.repr_entity(edge.end)
+            },
+            'properties': dict(edge.properties)
+        }
+
+###############################################################################
+
+
+class EmbeddedGraph:
+    """Embedded graph engine, for use when Neo4j is not connected
+
+    Parameters (`init_app()` config)
+    --------------------------------
+    enabled : bool
+        If False, no embedded engine is used
+    path : str, optional
+        JSONL snapshot of the graph (see `PropertyGraph.to_jsonl()`).
+        If empty, the graph is built from the annotations.
+    refresh_interval : float, optional
+        Minimum number of seconds between two checks for changes of the
+        snapshot (or the annotations)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.refresh_interval = DEFAULT_REFRESH_INTERVAL
+
+        self._build = None
+        self._get_version = None
+        self._engine = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def init_app(
+        self,
+        webapp,
+        config: dict,
+        build: Callable[[], PropertyGraph] = None,
+        get_version: Callable[[], Any] = None
+    ):
+        """Configure the engine
+
+        `build` and `get_version` build the graph from the annotations and
+        identify its state (e.g. the last change log sequence number), for
+        use when no snapshot is configured.
+        """
+        self.enabled = config.get("enabled", False)
+        self.path = config.get("path") or None
+        self.refresh_interval = config.get(
+            "refresh_interval", DEFAULT_REFRESH_INTERVAL
+        )
+        self._build = build
+        self._get_version = get_version
+        webapp.extensions["embedded_graph"] = self
+
+    def get_version(self) -> str:
+        """Token identifying the state of the source graph"""
+        if self.path:
+            stat = os.stat(self.path)
+            return f"file:{stat.st_mtime_ns}:{stat.st_size}"
+        return f"annotations:{self._get_version()}"
+
+    def get_engine(self) -> CypherEngine:
+        """Engine over the current graph, (re)loaded if the source changed
+
+        The source is checked at most once every `refresh_interval` seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._engine is not None and (
+                now - self._checked_at < self.refresh_interval
+            ):
+                return self._engine
+            self._checked_at = now
+
+            version = self.get_version()
+            if self._engine is None or self._engine.version != version:
+                start_time = time.perf_counter()
+                if self.path:
+                    graph = PropertyGraph.from_jsonl(self.path)
+                else:
+                    graph = self._build()
+                self._engine = CypherEngine(graph, version=version)
+                LOGGER.info(
+                    f"Loaded embedded graph ({len(self._engine.nodes)} "
+                    f"nodes, {len(self._engine.relationships)} relationships) "
+                    f"in {time.perf_counter() - start_time:.2f} seconds."
+                )
+            return self._engine
+
+
+embedded_graph = EmbeddedGraph()
+
+###############################################################################
@@ -7,8 +7,10 @@ Database Utility Functions
 ###############################################################################
 
 import logging
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict
 
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
 from sqlalchemy.orm.properties import ColumnProperty
 from sqlalchemy.orm.relationships import RelationshipProperty
 from sqlalchemy.sql import func
@@ -20,6 +22,7 @@ from models_sqla import ActionLabel, ActorLabel, Action
 
 from constants import PERMISSION_ANNOTATE, PERMISSION_CURATE, ROLE_ADMIN
 from utils.property_graph import PropertyGraph
+from utils.sharding import shards
 
 ###############################################################################
 
@@ -319,13 +322,6 @@ def get_chapter_data(chapter_id: int, user: User) -> dict:
     dict
         Line data, keyed by line IDs
     """
-    chapter = Chapter.query.get(chapter_id)
-
-    line_ids = [
-        line.id
-        for verse in chapter.verses
-        for line in verse.lines
-    ]
     annotator_ids = []
     fetch_nodes = False
     fetch_relations = False
@@ -341,7 +337,7 @@ def get_chapter_data(chapter_id: int, user: User) -> dict:
         fetch_relations = True
         # fetch_actions = True
     return get_line_data(
-        line_ids,
+        chapter_id=chapter_id,
         annotator_ids=annotator_ids,
         fetch_nodes=fetch_nodes,
         fetch_relations=fetch_relations,
@@ -350,11 +346,12 @@ def get_chapter_data(chapter_id: int, user: User) -> dict:
 
 
 def get_line_data(
-    line_ids: List[int],
+    line_ids: List[int] = None,
     annotator_ids: List[int] = None,
     fetch_nodes: bool = False,
     fetch_relations: bool = False,
     # fetch_actions: bool = False,
+    chapter_id: int = None,
 ) -> dict:
     """Get Line Data
 
@@ -377,13 +374,27 @@ def get_line_data(
     fetch_actions : bool, optional
         Fetch action annotations
         The default is False.
+    chapter_id : int, optional
+        Chapter ID
+        If specified, data for all the lines of the chapter is fetched
+        (using the denormalised `chapter_id`) instead of `line_ids`.
+        The default is None.
 
     Returns
     -------
     dict
         Line data, keyed by line IDs
     """
-    line_object_query = Line.query.filter(Line.id.in_(line_ids))
+    if chapter_id is not None:
+        line_condition = Line.chapter_id == chapter_id
+        node_condition = Node.chapter_id == chapter_id
+        relation_condition = Relation.chapter_id == chapter_id
+    else:
+        line_condition = Line.id.in_(line_ids)
+        node_condition = Node.line_id.in_(line_ids)
+        relation_condition = Relation.line_id.in_(line_ids)
+
+    line_object_query = Line.query.filter(line_condition)
     data = {
         line.id: {
             'line_id': line.id,
@@ -401,21 +412,21 @@ def get_line_data(
 
     if annotator_ids is None:
         node_query = Node.query.filter(
-            Node.line_id.in_(line_ids)
+            node_condition
         )
         relation_query = Relation.query.filter(
-            Relation.line_id.in_(line_ids)
+            relation_condition
         )
         # action_query = Action.query.filter(
         #     Action.line_id.in_(line_ids)
         # )
     else:
         node_query = Node.query.filter(
-            Node.line_id.in_(line_ids),
+            node_condition,
             Node.annotator_id.in_(annotator_ids)
         )
         relation_query = Relation.query.filter(
-            Relation.line_id.in_(line_ids),
+            relation_condition,
             Relation.annotator_id.in_(annotator_ids)
         )
         # action_query = Action.query.filter(
@@ -493,86 +504,112 @@ def build_graph(
     graph: PropertyGraph = None,
     line_ids: List[int] = None,
     annotator_ids: List[int] = None,
-) -> Tuple[PropertyGraph, List[Dict[str, Any]]]:
+    chapter_ids: List[int] = None,
+) -> PropertyGraph:
+    """Build a property graph of the live annotations
+
+    Relations with a deleted endpoint are left out. Such relations are
+    reported by the integrity sweeper (see utils/integrity.py).
+    """
     if graph is None:
         graph = PropertyGraph()
 
-    errors = []
+    # Restrict to lines or chapters, partitioned by shard
+    shard_ids = {shard_id: None for shard_id in shards.iter_shards()}
+    if line_ids is not None:
+        shard_ids = shards.partition(line_ids)
+    elif chapter_ids is not None:
+        shard_ids = shards.partition(chapter_ids)
+
+    for shard_id, _ids in shard_ids.items():
+        _line_ids = _ids if line_ids is not None else None
+        _chapter_ids = _ids if chapter_ids is not None else None
+        with shards.use_shard(shard_id):
+            graph = _build_graph(
+                graph, _line_ids, annotator_ids, _chapter_ids
+            )
+    return graph
+
 
+def _build_graph(
+    graph: PropertyGraph,
+    line_ids: List[int] = None,
+    annotator_ids: List[int] = None,
+    chapter_ids: List[int] = None,
+) -> PropertyGraph:
+    """Build graph from the annotations in the current database
+
+    Relations with a deleted endpoint are left out by the query itself.
+    """
     node_conditions = [Node.is_deleted.is_(False)]
     relation_conditions = [Relation.is_deleted.is_(False)]
     if line_ids is not None:
         node_conditions.append(Node.line_id.in_(line_ids))
         relation_conditions.append(Relation.line_id.in_(line_ids))
+    if chapter_ids is not None:
+        node_conditions.append(Node.chapter_id.in_(chapter_ids))
+        relation_conditions.append(Relation.chapter_id.in_(chapter_ids))
 
     if annotator_ids is not None:
         node_conditions.append(Node.annotator_id.in_(annotator_ids))
         relation_conditions.append(Relation.annotator_id.in_(annotator_ids))
 
+    # Semi-join on the live endpoints
+    src_node = aliased(Node)
+    dst_node = aliased(Node)
     node_query = Node.query.filter(*node_conditions)
-    relation_query = Relation.query.filter(*relation_conditions)
+    relation_query = Relation.query.join(
+        src_node, and_(
+            src_node.id == Relation.src_id,
+            src_node.is_deleted.is_(False)
+        )
+    ).join(
+        dst_node, and_(
+            dst_node.id == Relation.dst_id,
+            dst_node.is_deleted.is_(False)
+        )
+    ).filter(*relation_conditions)
     LOGGER.debug(node_query)
     LOGGER.debug(relation_query)
     nodes = node_query.all()
     relationships = relation_query.all()
     for node in nodes:
-        node_id = node.id
-        labels = [node.label.label]
-        properties = {
-            'lemma': node.lemma.lemma,
-            'annotator': node.annotator.id,
-            'line_id': node.line_id,
-            'line_text': node.line.text,
-        }
-        graph.add_node(node_id=node_id, labels=labels, properties=properties)
+        add_graph_node(graph, node)
 
     for relationship in relationships:
-        label = relationship.label.label
-        properties = {
-            'annotator': relationship.annotator.id,
-            'line_id': relationship.line_id,
-            'line_text': relationship.line.text,
-        }
-        if relationship.detail:
-            properties['detail'] = relationship.detail
-
-        src_id = relationship.src_id
-        dst_id = relationship.dst_id
-        src_node = relationship.src_node
-        dst_node = relationship.dst_node
-        if src_node.is_deleted or dst_node.is_deleted:
-            error_message = (
-                f"Line: {relationship.line_id}):: "
-                f"(Relationship {relationship.id}):\n"
-                f"\t(Node {src_id}) ({src_node.lemma.lemma}:{src_node.label.label}) "
-                f"(src_node.is_deleted: {src_node.is_deleted}, src_node.line_id = {src_node.line_id})\n"
-                f"\t-[{label}]-> \n"
-                f"\t(Node {dst_id}) ({dst_node.lemma.lemma}:{dst_node.label.label}) "
-                f"(dst_node.is_deleted: {dst_node.is_deleted}, dst_node.line_id = {dst_node.line_id})\n\n"
-            )
-            error = {
-                "relation.id": relationship.id,
-                "relation.line_id": relationship.line_id,
-                "relation.src_id": src_id,
-                "relation.src_node.line_id": src_node.line_id,
-                "relation.src_node.lemma.lemma": src_node.lemma.lemma,
-                "relation.src_node.label.label": src_node.label.label,
-                "relation.src_node.ist_deleted": src_node.is_deleted,
-                "relation.label.label": label,
-                "relation.dst_id": dst_id,
-                "relation.dst_node.line_id": dst_node.line_id,
-                "relation.dst_node.lemma.lemma": dst_node.lemma.lemma,
-                "relation.dst_node.label.label": dst_node.label.label,
-                "relation.dst_node.ist_deleted": dst_node.is_deleted,
-            }
-            errors.append(error)
-            continue
-
-        graph.add_edge(src_id, label, dst_id, properties=properties)
-
-    return graph, errors
+        add_graph_edge(graph, relationship)
+
+    return graph
 
 
+def add_graph_node(graph: PropertyGraph, node: Node):
+    """Add a node annotation to a property graph"""
+    labels = [node.label.label]
+    properties = {
+        'lemma': node.lemma.lemma,
+        'annotator': node.annotator_id,
+        'line_id': node.line_id,
+        'line_text': node.line.text,
+    }
+    graph.add_node(node_id=node.id, labels=labels, properties=properties)
+
+
+def add_graph_edge(graph: PropertyGraph, relationship: Relation):
+    """Add a relation annotation to a property graph"""
+    label = relationship.label.label
+    properties = {
+        'annotator': relationship.annotator_id,
+        'line_id': relationship.line_id,
+        'line_text': relationship.line.text,
+    }
+    if relationship.detail:
+        properties['detail'] = relationship.detail
+
+    graph.add_edge(
+        relationship.src_id, label, relationship.dst_id,
+        properties=properties
+    )
+
 
 ###############################################################################
 
@@ -596,21 +633,22 @@ def get_progress(
 
     filters = []
     if chapter_ids:
-        filters.append(Chapter.id.in_(chapter_ids))
+        filters.append(Relation.chapter_id.in_(chapter_ids))
     if annotator_ids:
-        filters.append(User.id.in_(annotator_ids))
+        filters.append(Relation.annotator_id.in_(annotator_ids))
 
     verse_annotation_query = (
-        Relation.query.join(Line).join(Verse).join(Chapter)
+        Relation.query.join(Line)
+        .join(Chapter, Chapter.id == Relation.chapter_id)
         .filter(*filters)
         .with_entities(
             Chapter.id.label("chapter_id"),
             Chapter.name.label("chapter_name"),
-            Verse.id.label("verse_id"),
+            Line.verse_id.label("verse_id"),
             func.MIN(func.DATE(Relation.updated_at)).label("start_date"),
             func.MAX(func.DATE(Relation.updated_at)).label("end_date"),
         )
-        .group_by(Verse.id)
+        .group_by(Line.verse_id)
     )
     verse_annotation_log = verse_annotation_query.all()
     va_subquery = verse_annotation_query.subquery("verse_annotation")
@@ -6,12 +6,28 @@ Connection to Neo4j Graph Database
 A thin wrapper on top of py2neo.Graph object.
 py2neo Reference: https://py2neo.org/2021.1/workflow.html#py2neo.Graph
 
+`GraphConnectionManager` shares a `Graph` between the threads of a worker,
+* a bounded number of sessions (concurrent queries) use the connection,
+  matching the size of the py2neo connection pool, and a request waits
+  a limited time for a free session,
+* the connection is checked (`RETURN 1`) before use, at most once every
+  `check_interval` seconds,
+* a failed connection is dropped and re-established in a background
+  thread, with exponential backoff,
+* while the database is down, sessions fail immediately with
+  `GraphUnavailable`.
+
 @author: Hrishikesh Terdalkar
 """
 
 import json
+import time
+import itertools
+import threading
 import py2neo
 import logging
+from contextlib import contextmanager
+from typing import Callable
 
 ###############################################################################
 
@@ -22,14 +38,26 @@ PREFIX_R = "R:"
 
 
 def find_entity_type(entities, entity_type):
-    for entity in entities:
-        if isinstance(entity, entity_type):
-            yield entity
-        elif isinstance(entity, (list, tuple, set)):
-            yield from find_entity_type(entity, entity_type)
-        elif isinstance(entity, py2neo.data.Path):
-            yield from find_entity_type(entity.nodes, entity_type)
-            yield from find_entity_type(entity.relationships, entity_type)
+    """Entities of `entity_type` in (nested) lists, tuples, sets and paths
+
+    Values are walked depth-first with an explicit stack of iterators, so
+    deeply nested values do not run into the recursion limit.
+    """
+    stack = [iter(entities)]
+    while stack:
+        for entity in stack[-1]:
+            if isinstance(entity, entity_type):
+                yield entity
+            elif isinstance(entity, (list, tuple, set)):
+                stack.append(iter(entity))
+                break
+            elif isinstance(entity, py2neo.data.Path):
+                stack.append(
+                    itertools.chain(entity.nodes, entity.relationships)
+                )
+                break
+        else:
+            stack.pop()
 
 ###############################################################################
 
@@ -37,19 +65,81 @@ def find_entity_type(entities, entity_type):
 class Graph:
     """Connection to Neo4j Graph Database"""
 
-    def __init__(self, server, username, password):
+    def __init__(self, server, username, password, **settings):
         self.__username = username
         self.__password = password
         self.__server = server
         self.graph = py2neo.Graph(
             self.__server,
             user=self.__username,
-            password=self.__password
+            password=self.__password,
+            **settings
         )
         self.__logger = logging.getLogger(self.__class__.__name__)
+        # incremented whenever the graph is changed through this object
+        # (per process, hence not a part of `get_version()`)
+        self.generation = 0
+
+    def get_version(self):
+        """
+        Token identifying the current state of the graph
+
+        Changes when the graph is cleared or (re)loaded, either through
+        this object or externally (numbers of nodes and relationships,
+        which Neo4j answers from its count store). The token is the same
+        across processes; changes made through this object are also
+        counted by `generation`.
+        """
+        node_count = self.graph.evaluate("MATCH (n) RETURN count(n)")
+        edge_count = self.graph.evaluate("MATCH ()-[r]->() RETURN count(r)")
+        return f"{node_count}:{edge_count}"
+
+    def terminate_queries(self, marker):
+        """
+        Terminate the running queries whose text contains `marker`
+
+        Uses `SHOW TRANSACTIONS` and `TERMINATE TRANSACTIONS` (Neo4j 4.4+),
+        or `dbms.listQueries()` and `dbms.killQuery()` on older versions.
+
+        Returns
+        -------
+        int
+            Number of queries terminated
+        """
+        try:
+            transaction_ids = [
+                record["transactionId"]
+                for record in self.graph.run(
+                    "SHOW TRANSACTIONS YIELD transactionId, currentQuery "
+                    "WHERE currentQuery CONTAINS $marker "
+                    "RETURN transactionId",
+                    marker=marker
+                ).data()
+            ]
+            if transaction_ids:
+                self.graph.run(
+                    "TERMINATE TRANSACTIONS $ids", ids=transaction_ids
+                )
+            return len(transaction_ids)
+        except py2neo.errors.ClientError:
+            pass
+
+        query_ids = [
+            record["queryId"]
+            for record in self.graph.run(
+                "CALL dbms.listQueries() YIELD queryId, query "
+                "WHERE query CONTAINS $marker "
+                "RETURN queryId",
+                marker=marker
+            ).data()
+        ]
+        for query_id in query_ids:
+            self.graph.run("CALL dbms.killQuery($id)", id=query_id)
+        return len(query_ids)
 
     def clear_graph(self):
         result = self.graph.run("MATCH (n) DETACH DELETE (n)")
+        self.generation += 1
         print(result)
         return result
 
@@ -62,6 +152,7 @@ class Graph:
             );
             """
         )
+        self.generation += 1
         print(result)
         return result
 
@@ -70,23 +161,37 @@ class Graph:
         # py2neo.run() - Read/Write Query
         # py2neo.query() - Read-only Query
         result = self.graph.query(query)
-        matches = result.data()
-        nodes = set()
-        edges = set()
+        return self.convert_result(result.data())
+
+    def convert_result(self, matches):
+        """
+        Convert query result rows into matches, nodes and edges
+
+        Every node and relationship found in the rows (including the ones
+        nested in lists and paths) is formatted once, in a single pass.
+
+        Returns
+        -------
+        final_matches : list
+            Rows with entities replaced by their representation
+        final_nodes : dict
+            Formatted nodes, keyed by their representation
+        final_edges : dict
+            Formatted relationships, keyed by their representation
+        """
+        entity_types = (py2neo.data.Node, py2neo.data.Relationship)
+        final_nodes = {}
+        final_edges = {}
         for match in matches:
-            nodes = nodes.union(
-                find_entity_type(match.values(), py2neo.data.Node)
-            )
-            edges = edges.union(
-                find_entity_type(match.values(), py2neo.data.Relationship)
-            )
+            for entity in find_entity_type(match.values(), entity_types):
+                key = self.repr_entity(entity)
+                if isinstance(entity, py2neo.data.Node):
+                    if key not in final_nodes:
+                        final_nodes[key] = self.format_node(entity)
+                else:
+                    if key not in final_edges:
+                        final_edges[key] = self.format_edge(entity)
 
-        final_nodes = {
-            self.repr_entity(node): self.format_node(node) for node in nodes
-        }
-        final_edges = {
-            self.repr_entity(edge): self.format_edge(edge) for edge in edges
-        }
         final_matches = [
             {
                 self.repr_entity(k): self.repr_entity(v)
@@ -154,3 +259,197 @@ class Graph:
             if jsonify else
             edge_dict
         )
+
+
+###############################################################################
+
+# Errors which indicate a failed connection (rather than a failed query)
+CONNECTION_ERRORS = (
+    py2neo.errors.ConnectionUnavailable,
+    py2neo.errors.ConnectionBroken,
+    py2neo.errors.ServiceUnavailable,
+    py2neo.errors.ProtocolError,
+    OSError,
+)
+
+###############################################################################
+
+
+class GraphUnavailable(Exception):
+    """Graph database is down, or all sessions are busy"""
+
+
+class GraphConnectionManager:
+    """Thread-safe access to a (reconnecting) Graph Database connection
+
+    Parameters
+    ----------
+    connect : Callable[[], Graph]
+        Function to establish a new connection
+    pool_size : int, optional
+        Maximum number of simultaneous sessions.
+        The default is 8.
+    acquire_timeout : float, optional
+        Number of seconds to wait for a free session.
+        The default is 5.
+    check_interval : float, optional
+        Minimum number of seconds between two liveness checks.
+        The default is 30.
+    min_backoff : float, optional
+        Delay (in seconds) before the first reconnection attempt,
+        doubled after every failed attempt.
+        The default is 1.
+    max_backoff : float, optional
+        Maximum delay (in seconds) between reconnection attempts.
+        The default is 60.
+    """
+
+    def __init__(
+        self,
+        connect: Callable[[], Graph],
+        pool_size: int = 8,
+        acquire_timeout: float = 5,
+        check_interval: float = 30,
+        min_backoff: float = 1,
+        max_backoff: float = 60
+    ):
+        self.connect = connect
+        self.pool_size = pool_size
+        self.acquire_timeout = acquire_timeout
+        self.check_interval = check_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+        self.last_error = None
+        self._graph = None
+        self._sessions = threading.BoundedSemaphore(pool_size)
+        self._lock = threading.Lock()
+        self._check_lock = threading.Lock()
+        self._checked_at = None
+        self._reconnect_thread = None
+        self._stop = threading.Event()
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def available(self) -> bool:
+        return self._graph is not None
+
+    def start(self):
+        """Connect, or start reconnecting in the background"""
+        if not self._try_connect():
+            self._start_reconnecting()
+
+    def close(self):
+        """Stop reconnecting and drop the connection"""
+        self._stop.set()
+        with self._lock:
+            self._graph = None
+
+    @contextmanager
+    def session(self):
+        """Graph to run queries on, for the duration of the block
+
+        Raises
+        ------
+        GraphUnavailable
+            If the database is down, or no session is free within
+            `acquire_timeout` seconds. The connection is dropped (and
+            re-established in the background) if it fails in the block.
+        """
+        if self._graph is None:
+            raise GraphUnavailable(self._unavailable_message())
+        if not self._sessions.acquire(timeout=self.acquire_timeout):
+            raise GraphUnavailable("All graph database sessions are busy.")
+        try:
+            graph = self._graph
+            if graph is None or not self._is_alive(graph):
+                raise GraphUnavailable(self._unavailable_message())
+            try:
+                yield graph
+            except CONNECTION_ERRORS as e:
+                self._mark_down(graph, e)
+                raise GraphUnavailable(self._unavailable_message()) from e
+        finally:
+            self._sessions.release()
+
+    # ----------------------------------------------------------------------- #
+
+    def _unavailable_message(self) -> str:
+        message = "Graph Database is not connected."
+        if self.last_error is not None:
+            message = f"{message} ({self.last_error})"
+        return message
+
+    def _is_alive(self, graph: Graph) -> bool:
+        """Check the connection, unless checked recently (or being checked)"""
+        now = time.monotonic()
+        if (
+            self._checked_at is not None and
+            now - self._checked_at < self.check_interval
+        ):
+            return True
+        if not self._check_lock.acquire(blocking=False):
+            return True
+        try:
+            graph.graph.evaluate("RETURN 1")
+        except Exception as e:
+            self._mark_down(graph, e)
+            return False
+        else:
+            self._checked_at = now
+            return True
+        finally:
+            self._check_lock.release()
+
+    def _mark_down(self, graph: Graph, error: Exception):
+        with self._lock:
+            if self._graph is not graph:
+                return
+            self._graph = None
+            self._checked_at = None
+            self.last_error = str(error) or type(error).__name__
+        self._logger.error(f"Graph Database connection lost. ({error})")
+        self._start_reconnecting()
+
+    def _try_connect(self) -> bool:
+        try:
+            graph = self.connect()
+            graph.graph.evaluate("RETURN 1")
+        except Exception as e:
+            self.last_error = str(e) or type(e).__name__
+            self._logger.debug(f"Graph Database connection failed. ({e})")
+            return False
+
+        with self._lock:
+            self._graph = graph
+            self._checked_at = time.monotonic()
+            self.last_error = None
+        self._logger.info("Graph Database connected.")
+        return True
+
+    def _start_reconnecting(self):
+        with self._lock:
+            if self._stop.is_set() or (
+                self._reconnect_thread is not None and
+                self._reconnect_thread.is_alive()
+            ):
+                return
+            self._reconnect_thread = threading.Thread(
+                target=self._reconnect,
+                name="graph-reconnect",
+                daemon=True
+            )
+            self._reconnect_thread.start()
+
+    def _reconnect(self):
+        delay = self.min_backoff
+        self._logger.warning(
+            f"Graph Database is not connected. ({self.last_error}) "
+            "Reconnecting in the background."
+        )
+        while not self._stop.wait(delay):
+            if self._try_connect():
+                return
+            delay = min(delay * 2, self.max_backoff)
+
+###############################################################################
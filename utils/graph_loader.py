@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batched Graph Loader
+
+Loads a property graph into Neo4j using plain parameterised Cypher
+(`UNWIND $rows ... MERGE`), i.e. without the APOC plugin and without
+access to the file system of the Neo4j server, which `Graph.load_graph()`
+requires.
+
+Input is a `PropertyGraph`, or a JSONL file as written by
+`PropertyGraph.to_jsonl()`, which is streamed (only the labels of the
+nodes are kept in memory).
+
+* A uniqueness constraint on the node ID (`neo4jImportId`, the property
+  written by `apoc.import.json()`) is created for every node label, before
+  the first node with that label is written.
+* Nodes are written in batches of `batch_size` rows, grouped by labels,
+  with up to `workers` batches running concurrently (each in a session
+  of its own).
+* Relationships are written after all the nodes, one batch at a time,
+  since concurrent batches would contend for the locks of shared nodes.
+* Every batch is a transaction of its own. Loading is idempotent (MERGE),
+  so an interrupted load can simply be run again.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Dict, Iterable, Iterator, Tuple
+
+from py2neo.errors import ClientError
+
+from utils.property_graph import PropertyGraph
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+ID_PROPERTY = "neo4jImportId"
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_WORKERS = 4
+
+# Batches between two progress messages
+PROGRESS_INTERVAL = 50
+
+###############################################################################
+
+
+def escape_name(name: str) -> str:
+    """Escaped label or relationship type"""
+    return "`" + name.replace("`", "``") + "`"
+
+
+def _labels_pattern(labels: Iterable[str]) -> str:
+    return "".join(f":{escape_name(label)}" for label in labels)
+
+
+def node_merge_query(labels: Tuple[str, ...]) -> str:
+    """Query merging nodes with the given labels
+
+    Rows: {"id": node ID, "properties": properties (including the ID)}
+    """
+    return (
+        f"UNWIND $rows AS row "
+        f"MERGE (n{_labels_pattern(labels)} {{{ID_PROPERTY}: row.id}}) "
+        f"SET n = row.properties"
+    )
+
+
+def edge_merge_query(
+    src_labels: Tuple[str, ...],
+    label: str,
+    dst_labels: Tuple[str, ...]
+) -> str:
+    """Query merging relationships of a type between labelled nodes
+
+    Rows: {"src": source ID, "dst": target ID, "properties": properties}
+    """
+    return (
+        f"UNWIND $rows AS row "
+        f"MATCH (a{_labels_pattern(src_labels[:1])} "
+        f"{{{ID_PROPERTY}: row.src}}) "
+        f"MATCH (b{_labels_pattern(dst_labels[:1])} "
+        f"{{{ID_PROPERTY}: row.dst}}) "
+        f"MERGE (a)-[r:{escape_name(label)}]->(b) "
+        f"SET r = row.properties"
+    )
+
+
+def create_constraints(graph, labels: Iterable[str]) -> int:
+    """Create uniqueness constraints on the node ID for the labels
+
+    Uses the `REQUIRE` syntax (Neo4j 4.4+), or the `ASSERT` syntax on older
+    versions. Labels whose constraint can not be created (e.g. because
+    of an existing index) are logged and skipped.
+
+    Returns
+    -------
+    int
+        Number of labels processed successfully
+    """
+    count = 0
+    for label in labels:
+        queries = [
+            f"CREATE CONSTRAINT IF NOT EXISTS "
+            f"FOR (n:{escape_name(label)}) REQUIRE n.{ID_PROPERTY} IS UNIQUE",
+            f"CREATE CONSTRAINT IF NOT EXISTS "
+            f"ON (n:{escape_name(label)}) ASSERT n.{ID_PROPERTY} IS UNIQUE",
+        ]
+        for query in queries:
+            try:
+                graph.graph.run(query)
+            except ClientError as e:
+                error = e
+                continue
+            count += 1
+            break
+        else:
+            LOGGER.warning(f"Could not create constraint for '{label}': "
+                           f"{error}")
+    return count
+
+###############################################################################
+
+
+def iter_graph_records(graph: PropertyGraph) -> Iterator[Dict]:
+    """Records of a property graph (as in its JSONL), nodes first"""
+    for node_id, node in graph.nodes.items():
+        yield {
+            "type": "node",
+            "id": node_id,
+            "labels": node.labels,
+            "properties": node.properties
+        }
+    for (src_id, label, dst_id), edge in graph.edges.items():
+        yield {
+            "type": "relationship",
+            "label": label,
+            "start": {"id": src_id},
+            "end": {"id": dst_id},
+            "properties": edge.properties
+        }
+
+
+def iter_jsonl_records(path: str) -> Iterator[Dict]:
+    """Records of a JSONL graph file, one line at a time"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+###############################################################################
+
+
+def load_graph_records(
+    graph,
+    records: Iterable[Dict],
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: int = DEFAULT_WORKERS
+) -> Dict:
+    """Load graph records (nodes first, then relationships) into Neo4j
+
+    Parameters
+    ----------
+    graph : Graph
+        Neo4j graph (see utils/graph.py). Its connection pool must allow
+        at least `workers` connections.
+    records : Iterable[Dict]
+        Node and relationship records, in the format of
+        `PropertyGraph.to_jsonl()`. Relationships must follow the nodes
+        they connect.
+    batch_size : int, optional
+        Number of rows per statement.
+        The default is DEFAULT_BATCH_SIZE.
+    workers : int, optional
+        Number of node batches written concurrently.
+        The default is DEFAULT_WORKERS.
+
+    Returns
+    -------
+    Dict
+        Numbers of nodes, relationships (and those skipped, for want of an
+        endpoint) and batches written, time taken and throughput
+    """
+    report = {
+        "nodes": 0,
+        "edges": 0,
+        "skipped_edges": 0,
+        "batches": 0,
+    }
+    node_labels = {}
+    constrained_labels = set()
+    node_buffers = {}
+    edge_buffers = {}
+    pending = set()
+    start_time = time.perf_counter()
+
+    def run_batch(query: str, rows: list):
+        graph.graph.run(query, {"rows": rows})
+
+    def collect(futures):
+        for future in futures:
+            future.result()
+
+    def log_progress():
+        report["batches"] += 1
+        if report["batches"] % PROGRESS_INTERVAL == 0:
+            LOGGER.info(
+                f"Loaded {report['nodes']} nodes and {report['edges']} "
+                f"relationships ({report['batches']} batches)."
+            )
+
+    def submit_nodes(labels: Tuple[str, ...], rows: list):
+        # keep memory bounded: at most 2 batches per worker in flight
+        while len(pending) >= 2 * workers:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pending.difference_update(done)
+            collect(done)
+        pending.add(executor.submit(run_batch, node_merge_query(labels), rows))
+        report["nodes"] += len(rows)
+        log_progress()
+
+    def flush_nodes():
+        for labels, rows in node_buffers.items():
+            if rows:
+                submit_nodes(labels, rows)
+        node_buffers.clear()
+        collect(pending)
+        pending.clear()
+
+    def write_edges(key: Tuple, rows: list):
+        run_batch(edge_merge_query(*key), rows)
+        report["edges"] += len(rows)
+        log_progress()
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="graph-load"
+    ) as executor:
+        for record in records:
+            if record.get("type") == "node":
+                node_id = record["id"]
+                labels = tuple(record.get("labels") or ())
+                new_labels = set(labels) - constrained_labels
+                if new_labels:
+                    create_constraints(graph, sorted(new_labels))
+                    constrained_labels.update(new_labels)
+
+                node_labels[node_id] = labels
+                rows = node_buffers.setdefault(labels, [])
+                rows.append({
+                    "id": node_id,
+                    "properties": {
+                        **record.get("properties", {}), ID_PROPERTY: node_id
+                    }
+                })
+                if len(rows) >= batch_size:
+                    submit_nodes(labels, rows)
+                    node_buffers[labels] = []
+                continue
+
+            # relationships: all the nodes must be written first
+            if node_buffers or pending:
+                flush_nodes()
+
+            src_id = record["start"]["id"]
+            dst_id = record["end"]["id"]
+            if src_id not in node_labels or dst_id not in node_labels:
+                report["skipped_edges"] += 1
+                continue
+
+            key = (node_labels[src_id], record["label"], node_labels[dst_id])
+            rows = edge_buffers.setdefault(key, [])
+            rows.append({
+                "src": src_id,
+                "dst": dst_id,
+                "properties": record.get("properties", {})
+            })
+            if len(rows) >= batch_size:
+                write_edges(key, rows)
+                edge_buffers[key] = []
+
+        flush_nodes()
+        for key, rows in edge_buffers.items():
+            if rows:
+                write_edges(key, rows)
+
+    elapsed = max(time.perf_counter() - start_time, 1e-6)
+    report["seconds"] = round(elapsed, 3)
+    report["nodes_per_second"] = round(report["nodes"] / elapsed, 1)
+    report["edges_per_second"] = round(report["edges"] / elapsed, 1)
+    if report["skipped_edges"]:
+        LOGGER.warning(f"Skipped {report['skipped_edges']} relationships "
+                       "with an unknown endpoint.")
+    LOGGER.info(f"Graph loaded ({report}).")
+    return report
+
+
+def load_property_graph(
+    graph,
+    property_graph: PropertyGraph,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    workers: int = DEFAULT_WORKERS
+) -> Dict:
+    """Load a `PropertyGraph` into Neo4j (see `load_graph_records()`)"""
+    return load_graph_records(
+        graph, iter_graph_records(property_graph),
+        batch_size=batch_size, workers=workers
+    )
+
+###############################################################################
@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental Graph Synchronisation
+
+Brings the Neo4j graph up to date with the annotations in the database,
+without clearing and reloading it.
+
+The change log (see utils/changelog.py) is the source of changes. The
+sequence number of the last change applied to the graph (high-water mark)
+is kept in a state file, and a synchronisation applies the changes logged
+since then. The change log, rather than `updated_at` and `is_deleted`,
+is used because it also records the rows which no longer exist in the
+live tables (archived annotations) and the changes to lexicon entries,
+which alter the `lemma` property of the nodes. (Changes to the other
+columns of lexicon entries, e.g. `transliteration`, are not a part of the
+graph, and are skipped.)
+
+The mark can not skip a change: sequence numbers are made visible in
+order, as every transaction appending to the change log holds the change
+log lock until it commits (see utils/changelog.py).
+
+A synchronisation
+* replaces the changed nodes (MERGE on the node ID),
+* deletes the nodes which are deleted, archived or have changed label,
+* replaces the relationships of the changed nodes and of the endpoints
+  (current and previous) of the changed relations.
+Nodes and relationships are written as they are by `build_graph()`,
+i.e. relations between the same pair of nodes with the same label form a
+single relationship.
+
+All statements are batched (`UNWIND $rows`) and run in a single Neo4j
+transaction, so that readers see either the old or the new graph, never a
+partially loaded one. The state file is written only after the
+transaction has committed. A failed synchronisation leaves the graph and
+the mark unchanged, and applying the same changes again is harmless.
+
+Graph nodes are identified by the `neo4jImportId` property (the property
+written by `apoc.import.json()`), which is unique for every node label
+(see utils/graph_loader.py).
+A full synchronisation (`full=True`, also done when there is no state
+file yet) replaces every synchronised node and relationship. It is
+required after changes which are not logged, i.e. renaming labels or
+editing the text of lines.
+
+A full synchronisation deletes and re-creates the whole graph in a single
+transaction, which Neo4j holds in memory until it commits. This is meant
+for small graphs only; a large graph should instead be cleared and loaded
+again with the `graph-load` command (see utils/graph_loader.py), which
+loads in batches (hence readers see a partially loaded graph meanwhile)
+and sets the synchronisation state when loading into an empty graph.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import os
+import json
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+
+from models_sqla import (db, ChangeLog, Node, Relation, NodeLabel,
+                         RelationArchive)
+from utils.changelog import (
+    get_last_sequence,
+    ENTITY_LEXICON,
+    ENTITY_NODE,
+    ENTITY_RELATION,
+)
+from utils.database import build_graph, add_graph_node, add_graph_edge
+from utils.graph_loader import (
+    create_constraints,
+    escape_name,
+    node_merge_query,
+    edge_merge_query,
+    ID_PROPERTY,
+)
+from utils.property_graph import PropertyGraph
+from utils.sharding import shards
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Bound on the number of IDs in a single SQL `IN` clause
+CHUNK_SIZE = 500
+
+###############################################################################
+
+
+def load_sync_state(path: str) -> Dict:
+    """Saved synchronisation state, or None"""
+    if path is None or not os.path.isfile(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        LOGGER.warning(f"Ignoring unreadable graph sync state: {e}")
+        return None
+
+
+def save_sync_state(path: str, state: Dict):
+    if path is None:
+        return
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temp_path, path)
+
+
+def get_synced_sequence(path: str) -> int:
+    """Sequence number of the last change applied to the graph (or 0)"""
+    state = load_sync_state(path)
+    return state.get("sequence", 0) if state else 0
+
+###############################################################################
+
+
+def _chunks(items: Iterable, size: int) -> Iterable[List]:
+    items = list(items)
+    for idx in range(0, len(items), size):
+        yield items[idx:idx + size]
+
+
+def get_changed_node_ids(since: int, until: int) -> Tuple[Set[int], Set[int]]:
+    """Nodes affected by the changes in the sequence range (since, until]
+
+    Returns
+    -------
+    node_ids : Set[int]
+        Nodes to be replaced (changed nodes and nodes of changed lexicons)
+    endpoint_ids : Set[int]
+        Nodes whose relationships are to be replaced, which includes
+        `node_ids` and the endpoints of changed relations
+    """
+    rows = db.session.execute(
+        select(
+            ChangeLog.entity_type, ChangeLog.entity_id,
+            ChangeLog.before, ChangeLog.after
+        )
+        .where(ChangeLog.id > since, ChangeLog.id <= until)
+    ).all()
+
+    node_ids = set()
+    lexicon_ids = set()
+    relation_ids = set()
+    endpoint_ids = set()
+    for entity_type, entity_id, before, after in rows:
+        if entity_type == ENTITY_NODE:
+            node_ids.add(entity_id)
+        elif entity_type == ENTITY_LEXICON:
+            # only the lemma is a property of the graph nodes
+            if any(payload and "lemma" in payload
+                   for payload in (before, after)):
+                lexicon_ids.add(entity_id)
+        elif entity_type == ENTITY_RELATION:
+            relation_ids.add(entity_id)
+            # previous endpoints of repointed relations
+            for payload in (before, after):
+                for key in ("src_id", "dst_id"):
+                    if payload and payload.get(key) is not None:
+                        endpoint_ids.add(int(payload[key]))
+
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            for chunk in _chunks(lexicon_ids, CHUNK_SIZE):
+                node_ids.update(db.session.execute(
+                    select(Node.id).where(Node.lexicon_id.in_(chunk))
+                ).scalars())
+
+    for shard_id, _relation_ids in shards.partition(relation_ids).items():
+        with shards.use_shard(shard_id):
+            for model in (Relation, RelationArchive):
+                for chunk in _chunks(_relation_ids, CHUNK_SIZE):
+                    for src_id, dst_id in db.session.execute(
+                        select(model.src_id, model.dst_id)
+                        .where(model.id.in_(chunk))
+                    ):
+                        endpoint_ids.update((src_id, dst_id))
+
+    endpoint_ids.update(node_ids)
+    return node_ids, endpoint_ids
+
+
+def build_partial_graph(endpoint_ids: Set[int]) -> PropertyGraph:
+    """Graph of the live relations incident on the given nodes
+
+    Holds the live nodes among `endpoint_ids`, every live relation with an
+    endpoint among them (and a live other endpoint), and the other
+    endpoints.
+    """
+    graph = PropertyGraph()
+    node_options = (
+        joinedload(Node.label), joinedload(Node.lemma), joinedload(Node.line)
+    )
+    for shard_id, _node_ids in shards.partition(endpoint_ids).items():
+        with shards.use_shard(shard_id):
+            relations = []
+            for chunk in _chunks(_node_ids, CHUNK_SIZE):
+                for node in Node.query.options(*node_options).filter(
+                    Node.id.in_(chunk), Node.is_deleted.is_(False)
+                ):
+                    add_graph_node(graph, node)
+                relations.extend(
+                    Relation.query.options(
+                        joinedload(Relation.label), joinedload(Relation.line)
+                    ).filter(
+                        (Relation.src_id.in_(chunk) |
+                         Relation.dst_id.in_(chunk)),
+                        Relation.is_deleted.is_(False)
+                    )
+                )
+
+            # other endpoints
+            other_ids = {
+                node_id
+                for relation in relations
+                for node_id in (relation.src_id, relation.dst_id)
+                if node_id not in graph.nodes
+            } - endpoint_ids
+            for chunk in _chunks(other_ids, CHUNK_SIZE):
+                for node in Node.query.options(*node_options).filter(
+                    Node.id.in_(chunk), Node.is_deleted.is_(False)
+                ):
+                    add_graph_node(graph, node)
+
+            unique_relations = {
+                relation.id: relation for relation in relations
+            }
+            for relation in unique_relations.values():
+                if (
+                    relation.src_id in graph.nodes and
+                    relation.dst_id in graph.nodes
+                ):
+                    add_graph_edge(graph, relation)
+    return graph
+
+###############################################################################
+
+
+def _node_statements(
+    graph: PropertyGraph,
+    node_ids: Iterable[int],
+    batch_size: int
+) -> List[Tuple[str, Dict]]:
+    """MERGE the given nodes of the graph"""
+    rows_by_label = {}
+    for node_id in node_ids:
+        node = graph.nodes.get(node_id)
+        if node is None:
+            continue
+        rows_by_label.setdefault(node.labels[0], []).append({
+            "id": node_id,
+            "properties": {**node.properties, ID_PROPERTY: node_id}
+        })
+
+    statements = []
+    for label, rows in rows_by_label.items():
+        query = node_merge_query((label,))
+        statements.extend(
+            (query, {"rows": batch}) for batch in _chunks(rows, batch_size)
+        )
+    return statements
+
+
+def _edge_statements(
+    graph: PropertyGraph,
+    batch_size: int
+) -> List[Tuple[str, Dict]]:
+    """MERGE every edge of the graph"""
+    rows_by_type = {}
+    for (src_id, label, dst_id), edge in graph.edges.items():
+        key = (
+            graph.nodes[src_id].labels[0], label, graph.nodes[dst_id].labels[0]
+        )
+        rows_by_type.setdefault(key, []).append({
+            "src": src_id, "dst": dst_id, "properties": edge.properties
+        })
+
+    statements = []
+    for (src_label, label, dst_label), rows in rows_by_type.items():
+        query = edge_merge_query((src_label,), label, (dst_label,))
+        statements.extend(
+            (query, {"rows": batch}) for batch in _chunks(rows, batch_size)
+        )
+    return statements
+
+
+def _delete_statements(
+    graph: PropertyGraph,
+    node_ids: Set[int],
+    endpoint_ids: Set[int],
+    labels: List[str],
+    batch_size: int
+) -> List[Tuple[str, Dict]]:
+    """Delete stale nodes, and the relationships of the endpoints"""
+    statements = []
+    for label in labels:
+        # nodes no longer live with this label
+        stale_ids = [
+            node_id for node_id in node_ids
+            if (
+                node_id not in graph.nodes or
+                graph.nodes[node_id].labels[0] != label
+            )
+        ]
+        query = (
+            f"MATCH (n:{escape_name(label)}) "
+            f"WHERE n.{ID_PROPERTY} IN $ids "
+            f"DETACH DELETE n"
+        )
+        statements.extend(
+            (query, {"ids": batch})
+            for batch in _chunks(sorted(stale_ids), batch_size)
+        )
+
+    live_ids_by_label = {}
+    for node_id in endpoint_ids:
+        if node_id in graph.nodes:
+            live_ids_by_label.setdefault(
+                graph.nodes[node_id].labels[0], []
+            ).append(node_id)
+    for label, live_ids in live_ids_by_label.items():
+        query = (
+            f"MATCH (n:{escape_name(label)})-[r]-() "
+            f"WHERE n.{ID_PROPERTY} IN $ids "
+            f"WITH DISTINCT r DELETE r"
+        )
+        statements.extend(
+            (query, {"ids": batch})
+            for batch in _chunks(sorted(live_ids), batch_size)
+        )
+    return statements
+
+
+def _run_in_transaction(graph, statements: List[Tuple[str, Dict]]):
+    """Run the statements in a single Neo4j transaction"""
+    tx = graph.graph.begin()
+    try:
+        for query, parameters in statements:
+            tx.run(query, parameters)
+    except Exception:
+        graph.graph.rollback(tx)
+        raise
+    graph.graph.commit(tx)
+
+###############################################################################
+
+
+def sync_graph(
+    graph,
+    state_path: str = None,
+    full: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> Dict:
+    """Apply the annotation changes since the last synchronisation
+
+    Parameters
+    ----------
+    graph : Graph
+        Neo4j graph (see utils/graph.py)
+    state_path : str, optional
+        File holding the synchronisation state (high-water mark).
+        If None, every synchronisation is a full one.
+    full : bool, optional
+        If True, replace every synchronised node and relationship,
+        regardless of the state, in a single transaction (small graphs
+        only, see the module documentation).
+        The default is False.
+    batch_size : int, optional
+        Number of rows per statement.
+        The default is DEFAULT_BATCH_SIZE.
+
+    Returns
+    -------
+    Dict
+        Report with the sequence range applied, the numbers of nodes and
+        relationships written and the number of statements run
+    """
+    state = load_sync_state(state_path)
+    since = state.get("sequence", 0) if state else 0
+    full = full or state is None
+    until = get_last_sequence()
+
+    report = {
+        "full": full,
+        "since": since,
+        "until": until,
+        "nodes": 0,
+        "edges": 0,
+        "statements": 0,
+    }
+    if not full and until <= since:
+        return report
+
+    labels = [label for label, in db.session.query(NodeLabel.label)]
+    # schema changes can not share a transaction with data changes
+    create_constraints(graph, labels)
+
+    if full:
+        partial_graph = build_graph()
+        node_ids = set(partial_graph.nodes)
+        statements = [(
+            f"MATCH (n) WHERE n.{ID_PROPERTY} IS NOT NULL DETACH DELETE n",
+            {}
+        )]
+    else:
+        node_ids, endpoint_ids = get_changed_node_ids(since, until)
+        partial_graph = build_partial_graph(endpoint_ids)
+        statements = _delete_statements(
+            partial_graph, node_ids, endpoint_ids, labels, batch_size
+        )
+
+    statements.extend(
+        _node_statements(partial_graph, sorted(node_ids), batch_size)
+    )
+    statements.extend(_edge_statements(partial_graph, batch_size))
+
+    _run_in_transaction(graph, statements)
+    graph.generation += 1
+
+    save_sync_state(state_path, {
+        "sequence": until,
+        "synced_at": datetime.utcnow().isoformat(),
+        "full": full,
+    })
+
+    report["nodes"] = sum(
+        1 for node_id in node_ids if node_id in partial_graph.nodes
+    )
+    report["edges"] = len(partial_graph.edges)
+    report["statements"] = len(statements)
+    LOGGER.info(f"Graph synchronised up to change {until} ({report}).")
+    return report
+
+###############################################################################
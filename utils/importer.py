@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk Annotation Import
+
+Inverse of the `annotation_download` action. Accepts the same JSON,
+```
+{
+    "nodes": [
+        {"line_id", "annotator_id", "lemma", "label"}, ...
+    ],
+    "relations": [
+        {"line_id", "annotator_id", "source", "relation", "detail", "target"},
+        ...
+    ]
+}
+```
+or an equivalent CSV, with a `type` column (`node` or `relation`) and the
+union of the above columns.
+
+Optionally, `annotator` (username) may be given instead of `annotator_id`,
+and `source_label`, `target_label` may be given for a relation, to pick the
+endpoint when the same lemma is annotated with several labels on a line.
+
+Lexicon entries, labels, annotators, lines and existing annotations are
+resolved in bulk, and new rows are inserted with batched `executemany`.
+Rows already present (as per the unique indexes on `Node` and `Relation`)
+are skipped, and deleted rows are restored. Rows which can not be imported
+are reported along with the reason.
+
+With sharding enabled, rows are grouped by the shard of their line (see
+`utils.sharding`), and every shard is imported in a transaction of its own.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import csv
+import logging
+from typing import Callable, Dict, List, Tuple
+
+from sqlalchemy import insert, select, update
+
+from models_sqla import db, User, Line, Lexicon, NodeLabel, RelationLabel
+from models_sqla import Node, Relation
+from utils.bulk import chunks, fetch_in, resolve_lexicons
+from utils.changelog import (
+    log_bulk_change,
+    log_changes,
+    ENTITY_NODE,
+    ENTITY_RELATION,
+    OPERATION_INSERT,
+    OPERATION_UPDATE,
+)
+from utils.concordance import refresh_concordance
+from utils.sharding import shards
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+ROW_TYPE_NODE = "node"
+ROW_TYPE_RELATION = "relation"
+
+###############################################################################
+
+
+def _to_int(value) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+###############################################################################
+
+
+def read_annotations_csv(content: str) -> Dict[str, List[Dict]]:
+    """Read CSV annotations into the `annotation_download` format"""
+    annotations = {"nodes": [], "relations": []}
+    for row in csv.DictReader(content.splitlines()):
+        row_type = (row.pop("type", None) or "").strip().lower()
+        row = {k: v for k, v in row.items() if v not in [None, ""]}
+        if row_type == ROW_TYPE_NODE:
+            annotations["nodes"].append(row)
+        elif row_type == ROW_TYPE_RELATION:
+            annotations["relations"].append(row)
+        else:
+            # keep the row, so that it appears in the error report
+            annotations.setdefault("invalid", []).append(
+                {**row, "type": row_type}
+            )
+    return annotations
+
+###############################################################################
+
+
+def _resolve_annotators(rows: List[Dict]) -> Dict:
+    usernames = {row["annotator"] for row in rows if row.get("annotator")}
+    annotator_ids = {
+        _to_int(row["annotator_id"])
+        for row in rows if row.get("annotator_id") is not None
+    }
+    by_username = dict(fetch_in(
+        [User.username, User.id], usernames
+    ))
+    valid_ids = {
+        user_id for user_id, in fetch_in([User.id], annotator_ids)
+    }
+    return {"usernames": by_username, "ids": valid_ids}
+
+
+def _row_annotator(row: Dict, annotators: Dict, default: int = None) -> int:
+    if row.get("annotator"):
+        return annotators["usernames"].get(row["annotator"])
+    if row.get("annotator_id") is not None:
+        annotator_id = _to_int(row["annotator_id"])
+        if annotator_id in annotators["ids"]:
+            return annotator_id
+        return None
+    return default
+
+
+def _labels(model) -> Dict[str, int]:
+    return {
+        label: label_id
+        for label_id, label in db.session.query(model.id, model.label).filter(
+            model.is_deleted == False  # noqa
+        )
+    }
+
+###############################################################################
+
+
+def _import_nodes(
+    rows: List[Tuple[int, Dict]],
+    annotators: Dict,
+    lines: Dict[int, Tuple[int, int]],
+    default_annotator_id: int = None,
+    make_transliteration: Callable[[str], str] = None,
+    user_id: int = None
+) -> Tuple[Dict[str, int], List[Dict]]:
+    counts = {"added": 0, "restored": 0, "existing": 0, "duplicate": 0}
+    errors = []
+    node_labels = _labels(NodeLabel)
+
+    valid_rows = []
+    for idx, row in rows:
+        line_id = _to_int(row.get("line_id"))
+        annotator_id = _row_annotator(row, annotators, default_annotator_id)
+        lemma = (row.get("lemma") or "").strip()
+        label = row.get("label")
+
+        error = None
+        if line_id not in lines:
+            error = f"Invalid line '{row.get('line_id')}'."
+        elif annotator_id is None:
+            error = "Invalid annotator."
+        elif not lemma:
+            error = "Missing lemma."
+        elif label not in node_labels:
+            error = f"Invalid node type '{label}'."
+
+        if error:
+            errors.append({"type": ROW_TYPE_NODE, "row": idx, "error": error})
+        else:
+            valid_rows.append((line_id, annotator_id, lemma, label))
+
+    lexicon_ids = resolve_lexicons(
+        (lemma for _, _, lemma, _ in valid_rows),
+        make_transliteration=make_transliteration,
+        user_id=user_id
+    )
+
+    keys = []
+    seen = set()
+    for line_id, annotator_id, lemma, label in valid_rows:
+        key = (line_id, annotator_id, lexicon_ids[lemma], node_labels[label])
+        if key in seen:
+            counts["duplicate"] += 1
+            continue
+        seen.add(key)
+        keys.append(key)
+
+    existing = {
+        tuple(row[:4]): (row[4], row[5])
+        for row in fetch_in(
+            [Node.line_id, Node.annotator_id, Node.lexicon_id, Node.label_id,
+             Node.id, Node.is_deleted],
+            keys
+        )
+    }
+    new_keys = [key for key in keys if key not in existing]
+    restored_ids = [
+        node_id
+        for key, (node_id, is_deleted) in existing.items()
+        if is_deleted
+    ]
+    counts["existing"] = len(existing) - len(restored_ids)
+
+    node_columns = ["line_id", "annotator_id", "lexicon_id", "label_id"]
+    if new_keys:
+        db.session.execute(insert(Node), [
+            {
+                **dict(zip(node_columns, key)),
+                "chapter_id": lines[key[0]][0],
+                "corpus_id": lines[key[0]][1],
+                "is_deleted": False
+            }
+            for key in new_keys
+        ])
+        created = fetch_in(
+            [Node.line_id, Node.annotator_id, Node.lexicon_id, Node.label_id,
+             Node.id],
+            new_keys
+        )
+        log_changes(
+            ENTITY_NODE, OPERATION_INSERT,
+            (
+                (
+                    row[4], None,
+                    {
+                        **dict(zip(node_columns, row[:4])),
+                        "is_deleted": False
+                    }
+                )
+                for row in created
+            ),
+            user_id=user_id
+        )
+        counts["added"] = len(created)
+
+    for chunk in chunks(restored_ids):
+        log_bulk_change(
+            ENTITY_NODE, OPERATION_UPDATE,
+            select(Node.id).where(Node.id.in_(chunk)),
+            after={"is_deleted": False},
+            user_id=user_id
+        )
+        db.session.execute(
+            update(Node).where(Node.id.in_(chunk)).values(
+                is_deleted=False
+            ).execution_options(synchronize_session=False)
+        )
+    counts["restored"] = len(restored_ids)
+
+    affected = [
+        (key[2], key[0])
+        for key in new_keys + [
+            key for key, (_, is_deleted) in existing.items() if is_deleted
+        ]
+    ]
+    for chunk in chunks(affected):
+        refresh_concordance(chunk)
+
+    return counts, errors
+
+
+def _import_relations(
+    rows: List[Tuple[int, Dict]],
+    annotators: Dict,
+    lines: Dict[int, Tuple[int, int]],
+    default_annotator_id: int = None,
+    user_id: int = None
+) -> Tuple[Dict[str, int], List[Dict]]:
+    counts = {"added": 0, "restored": 0, "existing": 0, "duplicate": 0}
+    errors = []
+    node_labels = _labels(NodeLabel)
+    relation_labels = _labels(RelationLabel)
+
+    parsed_rows = []
+    for idx, row in rows:
+        line_id = _to_int(row.get("line_id"))
+        annotator_id = _row_annotator(row, annotators, default_annotator_id)
+        label = row.get("relation")
+
+        error = None
+        if line_id not in lines:
+            error = f"Invalid line '{row.get('line_id')}'."
+        elif annotator_id is None:
+            error = "Invalid annotator."
+        elif not row.get("source") or not row.get("target"):
+            error = "Missing source or target."
+        elif label not in relation_labels:
+            error = f"Invalid relation type '{label}'."
+
+        if error:
+            errors.append({
+                "type": ROW_TYPE_RELATION, "row": idx, "error": error
+            })
+        else:
+            parsed_rows.append((idx, line_id, annotator_id, row))
+
+    # Live nodes of the (line, annotator) pairs, keyed by lemma
+    line_annotators = {(row[1], row[2]) for row in parsed_rows}
+    candidates = {}
+    for (line_id, annotator_id, lemma, label_id,
+         node_id) in fetch_in(
+        [Node.line_id, Node.annotator_id, Lexicon.lemma, Node.label_id,
+         Node.id],
+        line_annotators,
+        Node.lexicon_id == Lexicon.id,
+        Node.is_deleted == False  # noqa
+    ):
+        candidates.setdefault(
+            (line_id, annotator_id, lemma), []
+        ).append((label_id, node_id))
+
+    def resolve_node(line_id, annotator_id, lemma, label):
+        nodes = candidates.get((line_id, annotator_id, lemma), [])
+        if label:
+            nodes = [
+                node for node in nodes if node[0] == node_labels.get(label)
+            ]
+        if not nodes:
+            return None, f"Node '{lemma}' does not exist."
+        if len(nodes) > 1:
+            return None, (
+                f"Node '{lemma}' has multiple types, specify its label."
+            )
+        return nodes[0][1], None
+
+    keys = []
+    seen = set()
+    for idx, line_id, annotator_id, row in parsed_rows:
+        src_id, src_error = resolve_node(
+            line_id, annotator_id, row["source"], row.get("source_label")
+        )
+        dst_id, dst_error = resolve_node(
+            line_id, annotator_id, row["target"], row.get("target_label")
+        )
+        if src_error or dst_error:
+            errors.append({
+                "type": ROW_TYPE_RELATION, "row": idx,
+                "error": src_error or dst_error
+            })
+            continue
+
+        detail = row.get("detail")
+        detail = detail if detail and detail.strip() else None
+        key = (
+            line_id, annotator_id, src_id, dst_id,
+            relation_labels[row["relation"]], detail
+        )
+        if key in seen:
+            counts["duplicate"] += 1
+            continue
+        seen.add(key)
+        keys.append(key)
+
+    # NOTE: `detail` is nullable, and NULL never matches in an IN clause,
+    # so existing relations are looked up without it
+    existing = {
+        tuple(row[:6]): (row[6], row[7])
+        for row in fetch_in(
+            [Relation.line_id, Relation.annotator_id, Relation.src_id,
+             Relation.dst_id, Relation.label_id, Relation.detail,
+             Relation.id, Relation.is_deleted],
+            {key[:5] for key in keys}
+        )
+    }
+    existing = {key: existing[key] for key in keys if key in existing}
+    new_keys = [key for key in keys if key not in existing]
+    restored_ids = [
+        relation_id
+        for relation_id, is_deleted in existing.values()
+        if is_deleted
+    ]
+    counts["existing"] = len(existing) - len(restored_ids)
+
+    relation_columns = [
+        "line_id", "annotator_id", "src_id", "dst_id", "label_id", "detail"
+    ]
+    if new_keys:
+        db.session.execute(insert(Relation), [
+            {
+                **dict(zip(relation_columns, key)),
+                "chapter_id": lines[key[0]][0],
+                "corpus_id": lines[key[0]][1],
+                "is_deleted": False
+            }
+            for key in new_keys
+        ])
+        new_keys_set = set(new_keys)
+        created = [
+            row
+            for row in fetch_in(
+                [Relation.line_id, Relation.annotator_id, Relation.src_id,
+                 Relation.dst_id, Relation.label_id, Relation.detail,
+                 Relation.id],
+                {key[:5] for key in new_keys}
+            )
+            if tuple(row[:6]) in new_keys_set
+        ]
+        log_changes(
+            ENTITY_RELATION, OPERATION_INSERT,
+            (
+                (
+                    row[6], None,
+                    {
+                        **dict(zip(relation_columns, row[:6])),
+                        "is_deleted": False
+                    }
+                )
+                for row in created
+            ),
+            user_id=user_id
+        )
+        counts["added"] = len(created)
+
+    for chunk in chunks(restored_ids):
+        log_bulk_change(
+            ENTITY_RELATION, OPERATION_UPDATE,
+            select(Relation.id).where(Relation.id.in_(chunk)),
+            after={"is_deleted": False},
+            user_id=user_id
+        )
+        db.session.execute(
+            update(Relation).where(Relation.id.in_(chunk)).values(
+                is_deleted=False
+            ).execution_options(synchronize_session=False)
+        )
+    counts["restored"] = len(restored_ids)
+
+    return counts, errors
+
+###############################################################################
+
+
+def import_annotations(
+    annotations: Dict[str, List[Dict]],
+    default_annotator_id: int = None,
+    make_transliteration: Callable[[str], str] = None,
+    user_id: int = None,
+    dry_run: bool = False
+) -> Dict:
+    """Import annotations in the `annotation_download` format
+
+    Nodes are imported before relations, so that relations may refer to
+    nodes from the same file. Everything is imported in a single
+    transaction (one per shard, if the lines belong to several shards);
+    rows with errors are skipped.
+
+    Parameters
+    ----------
+    annotations : Dict[str, List[Dict]]
+        Annotations with `nodes` and `relations`
+    default_annotator_id : int, optional
+        Annotator for rows without `annotator_id` and `annotator`.
+        The default is None.
+    make_transliteration : Callable[[str], str], optional
+        Function to compute `Lexicon.transliteration` of new lemmas.
+        The default is None.
+    user_id : int, optional
+        ID of the user performing the import, for the change log.
+        The default is None.
+    dry_run : bool, optional
+        If True, the transaction is rolled back after computing the report.
+        The default is False.
+
+    Returns
+    -------
+    dict
+        `nodes`, `relations`: counts of added, restored, existing and
+        duplicate rows, `errors`: list of (type, row, error) of the rows
+        which could not be imported (row numbers are 1-indexed per type)
+    """
+    if not isinstance(annotations, dict):
+        raise ValueError("Annotations must have 'nodes' and 'relations'.")
+
+    node_rows = annotations.get("nodes") or []
+    relation_rows = annotations.get("relations") or []
+    errors = [
+        {
+            "type": row.get("type"),
+            "row": idx,
+            "error": f"Invalid row type '{row.get('type')}'."
+        }
+        for idx, row in enumerate(annotations.get("invalid") or [], start=1)
+    ]
+
+    all_rows = node_rows + relation_rows
+    annotators = _resolve_annotators(all_rows)
+
+    # rows (numbered per type) grouped by the shard of their line
+    shard_rows = {}
+    for row_type, rows in [("nodes", node_rows), ("relations", relation_rows)]:
+        for idx, row in enumerate(rows, start=1):
+            shard_id = shards.shard_of(_to_int(row.get("line_id")))
+            shard_rows.setdefault(
+                shard_id, {"nodes": [], "relations": []}
+            )[row_type].append((idx, row))
+
+    node_counts = {"added": 0, "restored": 0, "existing": 0, "duplicate": 0}
+    relation_counts = dict(node_counts)
+    row_errors = []
+    for shard_id in sorted(shard_rows, key=lambda _id: _id or 0):
+        rows = shard_rows[shard_id]
+        with shards.use_shard(shard_id):
+            lines = {
+                line_id: (chapter_id, corpus_id)
+                for line_id, chapter_id, corpus_id in fetch_in(
+                    [Line.id, Line.chapter_id, Line.corpus_id],
+                    {
+                        _to_int(row.get("line_id"))
+                        for _, row in rows["nodes"] + rows["relations"]
+                    } - {None}
+                )
+            }
+            try:
+                _node_counts, node_errors = _import_nodes(
+                    rows["nodes"], annotators, lines,
+                    default_annotator_id=default_annotator_id,
+                    make_transliteration=make_transliteration,
+                    user_id=user_id
+                )
+                _relation_counts, relation_errors = _import_relations(
+                    rows["relations"], annotators, lines,
+                    default_annotator_id=default_annotator_id,
+                    user_id=user_id
+                )
+            except Exception:
+                db.session.rollback()
+                raise
+            else:
+                if dry_run:
+                    db.session.rollback()
+                else:
+                    db.session.commit()
+
+        for key in node_counts:
+            node_counts[key] += _node_counts[key]
+            relation_counts[key] += _relation_counts[key]
+        row_errors.extend(node_errors + relation_errors)
+
+    report = {
+        "nodes": node_counts,
+        "relations": relation_counts,
+        "errors": errors + sorted(
+            row_errors, key=lambda error: (error["type"], error["row"])
+        )
+    }
+    LOGGER.info(
+        f"Imported annotations: nodes {node_counts}, "
+        f"relations {relation_counts}, {len(report['errors'])} errors."
+    )
+    return report
+
+###############################################################################
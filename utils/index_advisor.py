@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index Advisor
+
+Runs `EXPLAIN QUERY PLAN` (SQLite) on the main queries of the application
+and reports the full table scans, i.e. the filters without an index.
+
+A step `SCAN <table>` reads every row of the table, while
+`SCAN <table> USING [COVERING] INDEX` reads the whole index (cheaper, but
+still proportional to the table). Both are reported; the latter is flagged
+as an index scan.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from typing import Dict, List
+
+from sqlalchemy import func, or_, select
+
+from models_sqla import (db, Chapter, Verse, Line, Lexicon, NodeLabel, Node,
+                         Relation, ChangeLog, Concordance)
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+
+def advisor_queries() -> Dict[str, object]:
+    """Representative statements of the hot paths, keyed by description"""
+    sample_ids = [1, 2, 3]
+    return {
+        "chapter lines (get_chapter_data)": select(Line.id).join(
+            Verse, Verse.id == Line.verse_id
+        ).where(Verse.chapter_id == 1),
+        "chapters of corpus (corpus list)": select(Chapter.id).where(
+            Chapter.corpus_id == 1
+        ),
+        "nodes of lines (get_line_data)": select(Node.id).where(
+            Node.line_id.in_(sample_ids), Node.is_deleted == False  # noqa
+        ),
+        "relations of lines (get_line_data)": select(Relation.id).where(
+            Relation.line_id.in_(sample_ids),
+            Relation.is_deleted == False  # noqa
+        ),
+        "relations from node (update_node_id_in_relations)": select(
+            Relation.id
+        ).where(Relation.src_id == 1),
+        "relations to node (update_node_id_in_relations)": select(
+            Relation.id
+        ).where(Relation.dst_id == 1),
+        "relations of deleted nodes (update_entity)": select(
+            Relation.id
+        ).where(or_(
+            Relation.src_id.in_(sample_ids), Relation.dst_id.in_(sample_ids)
+        )),
+        "nodes of lexicon (concordance, lexicon update)": select(
+            Node.id
+        ).where(Node.lexicon_id == 1),
+        "nodes with label (label update)": select(Node.id).where(
+            Node.label_id == 1
+        ),
+        "relations with label (label update)": select(Relation.id).where(
+            Relation.label_id == 1
+        ),
+        "node suggestions (suggest-node)": select(
+            func.min(Node.id), Lexicon.lemma, NodeLabel.label
+        ).join(
+            Lexicon, Lexicon.id == Node.lexicon_id
+        ).join(
+            NodeLabel, NodeLabel.id == Node.label_id
+        ).where(
+            Lexicon.lemma.startswith("ra"), Node.is_deleted == False  # noqa
+        ).group_by(Node.lexicon_id, Node.label_id),
+        "lexicon lookup (get_lexicon)": select(Lexicon.id).where(
+            Lexicon.lemma == "rama"
+        ),
+        "deleted nodes (compaction)": select(Node.id).where(
+            Node.is_deleted == True, Node.updated_at < func.now()  # noqa
+        ),
+        "deleted relations (compaction)": select(Relation.id).where(
+            Relation.is_deleted == True,  # noqa
+            Relation.updated_at < func.now()
+        ),
+        "concordance of lexicon (/api/concordance)": select(
+            Concordance.id
+        ).where(Concordance.lexicon_id == 1),
+        "change log since (/api/changes)": select(ChangeLog.id).where(
+            ChangeLog.id > 1
+        ).order_by(ChangeLog.id),
+    }
+
+###############################################################################
+
+
+def explain_query_plan(connection, statement) -> List[str]:
+    """Steps of the SQLite query plan of a statement"""
+    compiled = statement.compile(
+        dialect=connection.dialect,
+        compile_kwargs={"render_postcompile": True}
+    )
+    params = compiled.construct_params()
+    parameters = tuple(params[name] for name in compiled.positiontup)
+    rows = connection.exec_driver_sql(
+        f"EXPLAIN QUERY PLAN {compiled}", parameters
+    )
+    return [row[-1] for row in rows]
+
+
+def full_scans(plan: List[str]) -> List[str]:
+    """Steps of a query plan which scan an entire table"""
+    return [
+        step for step in plan
+        if step.startswith("SCAN") and "SUBQUERY" not in step
+    ]
+
+
+def advise_indexes(engine=None) -> List[Dict]:
+    """Query plans of `advisor_queries()` with their full scans
+
+    Returns
+    -------
+    list
+        Dictionaries with `name`, `plan` (list of steps) and `scans`
+        (the full scan steps, if any)
+    """
+    if engine is None:
+        engine = db.engine
+    if engine.url.get_backend_name() != "sqlite":
+        raise ValueError("Index advisor supports only SQLite databases.")
+
+    result = []
+    with engine.connect() as connection:
+        for name, statement in advisor_queries().items():
+            plan = explain_query_plan(connection, statement)
+            result.append({
+                "name": name,
+                "plan": plan,
+                "scans": full_scans(plan),
+            })
+    return result
+
+###############################################################################
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Referential Integrity Sweeper
+
+Finds inconsistent annotations with set-based queries and writes them to
+the `IntegrityIssue` report table (`INSERT ... SELECT`, nothing is loaded
+into Python),
+* dangling relations: live relations having an endpoint which is deleted
+  (or missing), found with an anti-join on the live nodes,
+* cross-line relations: live relations having an endpoint on a different
+  line than the relation,
+* duplicate nodes: live nodes annotating the same lemma on the same line
+  by the same annotator (under different labels) as a node with a
+  smaller ID.
+
+Optionally, dangling relations are soft-deleted.
+
+The report is replaced on every sweep. With sharding enabled, every shard
+holds the report of its own annotations, and is swept in its own
+transaction.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+from datetime import datetime
+from typing import Dict, List
+
+from sqlalchemy import (DateTime, String, and_, delete, func, insert, literal,
+                        select, update)
+from sqlalchemy.orm import aliased
+
+from models_sqla import db, IntegrityIssue, Node, Relation
+from utils.changelog import (
+    log_bulk_change,
+    ENTITY_NODE,
+    ENTITY_RELATION,
+    OPERATION_UPDATE,
+)
+from utils.sharding import shards
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+KIND_DANGLING_RELATION = "dangling_relation"
+KIND_CROSS_LINE_RELATION = "cross_line_relation"
+KIND_DUPLICATE_NODE = "duplicate_node"
+
+ISSUE_KINDS = [
+    KIND_DANGLING_RELATION,
+    KIND_CROSS_LINE_RELATION,
+    KIND_DUPLICATE_NODE,
+]
+
+REPORT_COLUMNS = [
+    "kind", "entity_type", "entity_id", "line_id", "related_id",
+    "detected_at"
+]
+
+###############################################################################
+
+
+def _dangling_relations(endpoint: str, detected_at: datetime):
+    """Live relations whose `endpoint` (`src_id` or `dst_id`) is not live"""
+    endpoint_id = getattr(Relation, endpoint)
+    node = aliased(Node)
+    return select(
+        literal(KIND_DANGLING_RELATION, String),
+        literal(ENTITY_RELATION, String),
+        Relation.id,
+        Relation.line_id,
+        endpoint_id,
+        literal(detected_at, DateTime),
+    ).outerjoin(
+        node, and_(node.id == endpoint_id, node.is_deleted == False)  # noqa
+    ).where(
+        Relation.is_deleted == False,  # noqa
+        node.id.is_(None)
+    )
+
+
+def _cross_line_relations(endpoint: str, detected_at: datetime):
+    """Live relations whose `endpoint` is on a different line"""
+    endpoint_id = getattr(Relation, endpoint)
+    node = aliased(Node)
+    return select(
+        literal(KIND_CROSS_LINE_RELATION, String),
+        literal(ENTITY_RELATION, String),
+        Relation.id,
+        Relation.line_id,
+        endpoint_id,
+        literal(detected_at, DateTime),
+    ).join(
+        node, node.id == endpoint_id
+    ).where(
+        Relation.is_deleted == False,  # noqa
+        node.line_id != Relation.line_id
+    )
+
+
+def _duplicate_nodes(detected_at: datetime):
+    """Live nodes with the same line, annotator and lemma as another node"""
+    original = aliased(Node)
+    return select(
+        literal(KIND_DUPLICATE_NODE, String),
+        literal(ENTITY_NODE, String),
+        Node.id,
+        Node.line_id,
+        func.min(original.id),
+        literal(detected_at, DateTime),
+    ).join(
+        original, and_(
+            original.line_id == Node.line_id,
+            original.annotator_id == Node.annotator_id,
+            original.lexicon_id == Node.lexicon_id,
+            original.id < Node.id,
+            original.is_deleted == False  # noqa
+        )
+    ).where(
+        Node.is_deleted == False  # noqa
+    ).group_by(Node.id, Node.line_id)
+
+###############################################################################
+
+
+def _sweep(fix: bool = False, user_id: int = None) -> Dict[str, int]:
+    """Sweep the current database (shard), without commit"""
+    detected_at = datetime.utcnow()
+    db.session.execute(delete(IntegrityIssue))
+
+    statements = [
+        _dangling_relations("src_id", detected_at),
+        _dangling_relations("dst_id", detected_at),
+        _cross_line_relations("src_id", detected_at),
+        _cross_line_relations("dst_id", detected_at),
+        _duplicate_nodes(detected_at),
+    ]
+    for statement in statements:
+        db.session.execute(
+            insert(IntegrityIssue).from_select(REPORT_COLUMNS, statement)
+        )
+
+    counts = dict(
+        db.session.query(
+            IntegrityIssue.kind, func.count(IntegrityIssue.id)
+        ).group_by(IntegrityIssue.kind)
+    )
+    result = {kind: counts.get(kind, 0) for kind in ISSUE_KINDS}
+    result["fixed"] = 0
+
+    if fix and result[KIND_DANGLING_RELATION]:
+        fix_conditions = [
+            Relation.id.in_(
+                select(IntegrityIssue.entity_id).where(
+                    IntegrityIssue.kind == KIND_DANGLING_RELATION
+                )
+            ),
+            Relation.is_deleted == False  # noqa
+        ]
+        log_bulk_change(
+            ENTITY_RELATION, OPERATION_UPDATE,
+            select(Relation.id).where(*fix_conditions),
+            after={"is_deleted": True}, user_id=user_id
+        )
+        result["fixed"] = db.session.execute(
+            update(Relation).where(*fix_conditions).values(is_deleted=True)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.execute(
+            delete(IntegrityIssue).where(
+                IntegrityIssue.kind == KIND_DANGLING_RELATION
+            )
+        )
+    return result
+
+
+def sweep_integrity(fix: bool = False, user_id: int = None) -> Dict[str, int]:
+    """Find integrity issues and write them to the report table
+
+    Parameters
+    ----------
+    fix : bool, optional
+        If True, soft-delete the dangling relations (which are then
+        removed from the report).
+        The default is False.
+    user_id : int, optional
+        ID of the user running the sweep (for the change log).
+        The default is None.
+
+    Returns
+    -------
+    Dict[str, int]
+        Number of issues of every kind (in `ISSUE_KINDS`) found, and the
+        number of relations `fixed`
+    """
+    result = {kind: 0 for kind in ISSUE_KINDS + ["fixed"]}
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            try:
+                for key, count in _sweep(fix=fix, user_id=user_id).items():
+                    result[key] += count
+            except Exception:
+                db.session.rollback()
+                raise
+            else:
+                db.session.commit()
+
+    LOGGER.info(f"Integrity sweep: {result}")
+    return result
+
+
+def get_integrity_report(kind: str = None, limit: int = 100) -> Dict:
+    """Issues found by the most recent sweep
+
+    Parameters
+    ----------
+    kind : str, optional
+        Only list issues of this kind.
+        The default is None.
+    limit : int, optional
+        Maximum number of issues listed.
+        The default is 100.
+
+    Returns
+    -------
+    dict
+        `counts` of issues by kind, `detected_at` (time of the most recent
+        sweep, None if there are no issues) and `issues`
+    """
+    counts = {kind: 0 for kind in ISSUE_KINDS}
+    detected_at = None
+    issues: List[Dict] = []
+    for shard_id in shards.iter_shards():
+        with shards.use_shard(shard_id):
+            query = db.session.query(
+                IntegrityIssue.kind,
+                func.count(IntegrityIssue.id),
+                func.max(IntegrityIssue.detected_at)
+            ).group_by(IntegrityIssue.kind)
+            for _kind, count, _detected_at in query:
+                counts[_kind] = counts.get(_kind, 0) + count
+                if detected_at is None or _detected_at > detected_at:
+                    detected_at = _detected_at
+
+            issue_query = IntegrityIssue.query
+            if kind is not None:
+                issue_query = issue_query.filter(IntegrityIssue.kind == kind)
+            issues.extend(
+                {
+                    "kind": issue.kind,
+                    "entity_type": issue.entity_type,
+                    "entity_id": issue.entity_id,
+                    "line_id": issue.line_id,
+                    "related_id": issue.related_id,
+                }
+                for issue in issue_query.order_by(
+                    IntegrityIssue.id
+                ).limit(limit)
+            )
+
+    return {
+        "counts": counts,
+        "detected_at": detected_at.isoformat() if detected_at else None,
+        "issues": issues[:limit],
+    }
+
+###############################################################################
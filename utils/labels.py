@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Label Maps
+
+In-process maps of label text to label ID for the label models
+(`NodeLabel`, `RelationLabel`, ...), which are looked up for every
+submitted annotation but change rarely.
+
+A map is loaded on first use and invalidated by `invalidate_label_map()`
+whenever labels are changed (ontology actions). Since labels may also be
+added by another process, a lookup which misses reloads the map once.
+
+As with the lookups they replace, deleted labels are part of the map.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+import threading
+from typing import Dict
+
+from models_sqla import db
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+_LABEL_MAPS = {}
+_LABEL_MAPS_LOCK = threading.Lock()
+
+###############################################################################
+
+
+def _load_label_map(model) -> Dict[str, int]:
+    label_map = dict(db.session.query(model.label, model.id))
+    _LABEL_MAPS[model.__name__] = label_map
+    LOGGER.debug(f"Loaded {len(label_map)} {model.__name__}s.")
+    return label_map
+
+
+def get_label_map(model) -> Dict[str, int]:
+    """Map of label text to label ID for a label model (loaded if needed)"""
+    with _LABEL_MAPS_LOCK:
+        label_map = _LABEL_MAPS.get(model.__name__)
+        if label_map is None:
+            label_map = _load_label_map(model)
+        return label_map
+
+
+def get_label_id(model, label: str) -> int:
+    """ID of a label, or None if the label does not exist
+
+    If the label is not in the map, the map is reloaded once.
+    """
+    label_id = get_label_map(model).get(label)
+    if label_id is None:
+        with _LABEL_MAPS_LOCK:
+            label_id = _load_label_map(model).get(label)
+    return label_id
+
+
+def invalidate_label_map(model=None):
+    """Invalidate the map of a label model (or of all models, if None)"""
+    with _LABEL_MAPS_LOCK:
+        if model is None:
+            _LABEL_MAPS.clear()
+        else:
+            _LABEL_MAPS.pop(model.__name__, None)
+
+###############################################################################
@@ -426,6 +426,44 @@ class PropertyGraph:
 
         return jsonl_content
 
+    @classmethod
+    def from_jsonl(cls, path: str or Path) -> "PropertyGraph":
+        """
+        Create a graph from its JSONL representation (see `to_jsonl()`).
+
+        Properties are restored as they are, including list values.
+
+        Parameters
+        ----------
+        path : str or Path
+            Location of the JSONL file
+
+        Returns
+        -------
+        PropertyGraph
+            Graph with the nodes and relationships of the file
+        """
+        graph = cls()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                properties = record.get('properties') or {}
+                if record.get('type') == 'node':
+                    graph.add_node(record['id'], record.get('labels'))
+                    graph.nodes[record['id']].properties = properties
+                else:
+                    edge_tuple = (
+                        record['start']['id'],
+                        record['label'],
+                        record['end']['id']
+                    )
+                    graph.add_edge(*edge_tuple)
+                    graph.edges[edge_tuple].properties = properties
+        return graph
+
     # ----------------------------------------------------------------------- #
 
     def to_csv(self, prefix: str = None) -> Dict[str, str]:
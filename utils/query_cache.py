@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Query Result Cache
+
+Results of (read-only) Cypher queries, cached in front of
+`Graph.run_query()`, keyed by
+* the normalised query text, i.e. with whitespace collapsed and keywords
+  upper-cased outside of string literals and identifiers (the applied
+  LIMIT is a part of the query text), and
+* the graph version, a token which changes whenever the graph is cleared
+  or reloaded (see `Graph.get_version()`). The token does not depend on
+  the process, so that a persisted cache remains valid after a restart.
+
+Results are stored serialised (JSON), and the least recently used ones are
+evicted once the total serialised size exceeds the configured bound.
+The graph version is checked at most once every `version_interval`
+seconds, and all entries are dropped when it changes. Changes made to the
+graph by the process itself (counted by `Graph.generation`) drop all the
+entries right away.
+
+Optionally, the cache is persisted to a file (on exit, and periodically),
+and loaded from it on start-up, so that it survives restarts.
+
+Usage,
+
+    query_cache.init_app(webapp, app.query_cache)
+    query_cache.check_version(GRAPH.get_version, GRAPH.generation)
+    result = query_cache.get(query)
+    if result is None:
+        result = GRAPH.run_query(query)
+        query_cache.put(query, result)
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import os
+import re
+import json
+import tempfile
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+# String literals and escaped identifiers, which are kept as they are
+LITERAL_PATTERN = re.compile(
+    r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)""", re.DOTALL
+)
+WHITESPACE_PATTERN = re.compile(r"\s+")
+BRACKET_SPACE_PATTERN = re.compile(r"(?<=[(\[{])\s+|\s+(?=[)\]},])")
+
+CYPHER_KEYWORDS = [
+    "MATCH", "OPTIONAL", "WHERE", "RETURN", "WITH", "UNWIND", "AS",
+    "ORDER", "BY", "ASC", "ASCENDING", "DESC", "DESCENDING", "SKIP",
+    "LIMIT", "DISTINCT", "UNION", "ALL", "AND", "OR", "XOR", "NOT", "IN",
+    "IS", "NULL", "TRUE", "FALSE", "STARTS", "ENDS", "CONTAINS", "CASE",
+    "WHEN", "THEN", "ELSE", "END", "EXISTS", "CALL", "YIELD",
+]
+KEYWORD_PATTERN = re.compile(
+    r"\b(?:" + "|".join(CYPHER_KEYWORDS) + r")\b", re.IGNORECASE
+)
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+DEFAULT_VERSION_INTERVAL = 60
+DEFAULT_SAVE_INTERVAL = 300
+
+###############################################################################
+
+
+def _upper_keyword(match: re.Match) -> str:
+    """Upper-case a keyword, unless it is a label, type, property or key"""
+    text = match.string
+    before = text[:match.start()].rstrip()
+    after = text[match.end():].lstrip()
+    if before.endswith((":", ".", "$")) or after.startswith(":"):
+        return match.group(0)
+    return match.group(0).upper()
+
+
+def normalise_query(query: str) -> str:
+    """Normalise a Cypher query for use as a cache key
+
+    Outside of string literals and escaped identifiers, whitespace is
+    collapsed (and removed next to brackets) and keywords are upper-cased.
+    Labels, relationship types, properties and map keys are left as they
+    are, since these are case-sensitive.
+    """
+    parts = LITERAL_PATTERN.split(query.strip().rstrip(";"))
+    for idx in range(0, len(parts), 2):
+        part = WHITESPACE_PATTERN.sub(" ", parts[idx])
+        part = BRACKET_SPACE_PATTERN.sub("", part)
+        parts[idx] = KEYWORD_PATTERN.sub(_upper_keyword, part)
+    return "".join(parts).strip()
+
+###############################################################################
+
+
+class QueryCache:
+    """LRU cache of query results, bounded by serialised size
+
+    Parameters (`init_app()` config)
+    --------------------------------
+    max_size : int
+        Maximum total size (in bytes) of the serialised results.
+        If 0, the cache is disabled.
+    path : str, optional
+        File to persist the cache to. If empty, the cache is kept in
+        memory only.
+    version_interval : float, optional
+        Minimum number of seconds between two checks of the graph version.
+    save_interval : float, optional
+        Minimum number of seconds between two periodic saves.
+    """
+
+    def __init__(self):
+        self.max_size = 0
+        self.path = None
+        self.version_interval = DEFAULT_VERSION_INTERVAL
+        self.save_interval = DEFAULT_SAVE_INTERVAL
+
+        self.version = None
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.RLock()
+        self._version_checked_at = None
+        self._generation = None
+        self._saved_at = time.monotonic()
+        self._dirty = False
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def init_app(self, webapp, config: dict):
+        self.max_size = config.get("max_size", DEFAULT_MAX_SIZE) or 0
+        self.path = config.get("path") or None
+        self.version_interval = config.get(
+            "version_interval", DEFAULT_VERSION_INTERVAL
+        )
+        self.save_interval = config.get(
+            "save_interval", DEFAULT_SAVE_INTERVAL
+        )
+        if self.enabled and self.path:
+            self.load()
+            atexit.register(self.save)
+        webapp.extensions["query_cache"] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    # ----------------------------------------------------------------------- #
+
+    def check_version(
+        self,
+        get_version: Callable[[], str],
+        generation: int = None,
+        force: bool = False
+    ):
+        """Check the graph version, dropping all entries if it has changed
+
+        `get_version` is called at most once every `version_interval`
+        seconds, unless `force` is True or `generation` (a counter of the
+        changes made to the graph by this process) has changed since the
+        last check, in which case all entries are dropped as well.
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                if self._generation is not None:
+                    LOGGER.info("Graph changed, dropping cached results.")
+                    self.invalidations += 1
+                    self._clear()
+                    force = True
+                self._generation = generation
+            if (
+                not force and
+                self._version_checked_at is not None and
+                now - self._version_checked_at < self.version_interval
+            ):
+                return
+            self._version_checked_at = now
+
+        version = str(get_version())
+        with self._lock:
+            if version != self.version:
+                if self.version is not None:
+                    LOGGER.info(f"Graph version changed ({self.version} -> "
+                                f"{version}), dropping cached results.")
+                    self.invalidations += 1
+                self._clear()
+                self.version = version
+
+    def get(self, query: str) -> Any:
+        """Cached result of a query, or None"""
+        if not self.enabled:
+            return None
+        key = normalise_query(query)
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return json.loads(value)
+
+    def put(self, query: str, result: Any):
+        """Cache the result of a query
+
+        Results larger than `max_size` (when serialised) are not cached.
+        """
+        if not self.enabled:
+            return
+        key = normalise_query(query)
+        value = json.dumps(result, ensure_ascii=False, separators=(",", ":"))
+        size = self._entry_size(key, value)
+        if size > self.max_size:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= self._entry_size(key, previous)
+            self._entries[key] = value
+            self._size += size
+            while self._size > self.max_size:
+                _key, _value = self._entries.popitem(last=False)
+                self._size -= self._entry_size(_key, _value)
+                self.evictions += 1
+            self._dirty = True
+
+        if (
+            self.path and
+            time.monotonic() - self._saved_at >= self.save_interval
+        ):
+            self.save()
+
+    def clear(self):
+        """Drop all the cached results"""
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> Dict:
+        """Counters and current size of the cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "version": self.version,
+                "entries": len(self._entries),
+                "size": self._size,
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / lookups) if lookups else None,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "path": self.path,
+            }
+
+    # ----------------------------------------------------------------------- #
+
+    def save(self):
+        """Write the cache to `path` (if anything has changed)"""
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            content = {
+                "version": self.version,
+                "entries": list(self._entries.items()),
+            }
+            self._dirty = False
+            self._saved_at = time.monotonic()
+
+        # unique temporary file, in case several processes save at once
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                prefix=f"{os.path.basename(self.path)}.",
+                suffix=".tmp",
+                dir=os.path.dirname(os.path.abspath(self.path))
+            )
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(content, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            LOGGER.warning(f"Could not save the query cache: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def load(self):
+        """Read the cache from `path` (if it exists)"""
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                content = json.load(f)
+        except (OSError, ValueError) as e:
+            LOGGER.warning(f"Ignoring unreadable query cache: {e}")
+            return
+
+        with self._lock:
+            self._clear()
+            self.version = content.get("version")
+            for key, value in content.get("entries", []):
+                self._entries[key] = value
+                self._size += self._entry_size(key, value)
+            while self._size > self.max_size:
+                _key, _value = self._entries.popitem(last=False)
+                self._size -= self._entry_size(_key, _value)
+        LOGGER.info(f"Loaded {len(self._entries)} cached query results.")
+
+    # ----------------------------------------------------------------------- #
+
+    @staticmethod
+    def _entry_size(key: str, value: str) -> int:
+        return len(key.encode("utf-8")) + len(value.encode("utf-8"))
+
+    def _clear(self):
+        if self._entries:
+            self._dirty = True
+        self._entries.clear()
+        self._size = 0
+
+
+query_cache = QueryCache()
+
+###############################################################################
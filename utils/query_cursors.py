@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Query Result Cursors
+
+Paginated Cypher query results. The result of a paginated query is
+materialised once (up to `max_rows` rows) and held on the server, and is
+then served one page at a time, instead of the query being re-run with
+`SKIP` for every page.
+
+Every page is a (matches, nodes, edges) triple, as `Graph.run_query()`,
+holding only the nodes and relationships referred to by the matches of
+the page, along with the cursor for the next page (if any). Cursors are of
+the form `<id>:<offset>`, so a page can be fetched again (e.g. on retry).
+
+Memory held by abandoned cursors is bounded,
+* cursors not accessed for `ttl` seconds are dropped,
+* at most `max_cursors` cursors are held (per worker process), and at most
+  `cursors_per_user` per user, dropping the least recently used ones, and
+* a result holds at most `max_rows` rows.
+
+Cursors live in the memory of the worker process, so with several worker
+processes, page requests must reach the same process (as with query jobs).
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+DEFAULT_PAGE_SIZE = 100
+DEFAULT_MAX_ROWS = 10000
+DEFAULT_TTL = 600
+DEFAULT_MAX_CURSORS = 100
+DEFAULT_CURSORS_PER_USER = 5
+
+###############################################################################
+
+
+class QueryCursorError(Exception):
+    """Cursor is invalid or has expired"""
+
+
+class QueryCursor:
+    """Materialised result of a query, served one page at a time"""
+
+    def __init__(
+        self,
+        result: Tuple[List, Dict, Dict],
+        page_size: int,
+        user_id: int = None,
+        truncated: bool = False
+    ):
+        self.id = uuid.uuid4().hex
+        self.matches, self.nodes, self.edges = result
+        self.page_size = page_size
+        self.user_id = user_id
+        self.truncated = truncated
+        self.accessed_at = time.monotonic()
+
+    @property
+    def total(self) -> int:
+        return len(self.matches)
+
+    def token(self, offset: int) -> str:
+        """Cursor for the page starting at `offset` (None past the end)"""
+        return f"{self.id}:{offset}" if offset < self.total else None
+
+    def page(self, offset: int) -> Tuple[Tuple[List, Dict, Dict], Dict]:
+        """Page starting at `offset`, and its cursor information"""
+        matches = self.matches[offset:offset + self.page_size]
+        node_ids = set()
+        edge_ids = set()
+        stack = [list(match.values()) for match in matches]
+        while stack:
+            for value in stack.pop():
+                if isinstance(value, (list, tuple)):
+                    stack.append(value)
+                elif isinstance(value, dict):
+                    stack.append(list(value.values()))
+                elif isinstance(value, str):
+                    if value in self.nodes:
+                        node_ids.add(value)
+                    elif value in self.edges:
+                        edge_ids.add(value)
+
+        # endpoints of the relationships
+        for edge_id in edge_ids:
+            edge = self.edges[edge_id]
+            for end in ("start", "end"):
+                node_id = edge[end]["id"]
+                if node_id in self.nodes:
+                    node_ids.add(node_id)
+
+        nodes = {
+            node_id: node
+            for node_id, node in self.nodes.items()
+            if node_id in node_ids
+        }
+        edges = {
+            edge_id: edge
+            for edge_id, edge in self.edges.items()
+            if edge_id in edge_ids
+        }
+        info = {
+            "cursor": self.token(offset + self.page_size),
+            "offset": offset,
+            "page_size": self.page_size,
+            "total": self.total,
+            "truncated": self.truncated,
+        }
+        return (matches, nodes, edges), info
+
+
+class QueryCursorManager:
+    """Bounded store of query result cursors
+
+    Parameters (`init_app()` config)
+    --------------------------------
+    page_size : int
+        Default number of rows per page
+    max_rows : int
+        Maximum number of rows of a paginated result
+    ttl : float
+        Seconds after the last access for which a cursor is kept
+    max_cursors : int
+        Maximum number of cursors held
+    cursors_per_user : int
+        Maximum number of cursors held per user
+    """
+
+    def __init__(self):
+        self.page_size = DEFAULT_PAGE_SIZE
+        self.max_rows = DEFAULT_MAX_ROWS
+        self.ttl = DEFAULT_TTL
+        self.max_cursors = DEFAULT_MAX_CURSORS
+        self.cursors_per_user = DEFAULT_CURSORS_PER_USER
+
+        self._cursors = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, webapp, config: dict):
+        self.page_size = config.get("page_size", DEFAULT_PAGE_SIZE)
+        self.max_rows = config.get("max_rows", DEFAULT_MAX_ROWS)
+        self.ttl = config.get("ttl", DEFAULT_TTL)
+        self.max_cursors = config.get("max_cursors", DEFAULT_MAX_CURSORS)
+        self.cursors_per_user = config.get(
+            "cursors_per_user", DEFAULT_CURSORS_PER_USER
+        )
+        webapp.extensions["query_cursors"] = self
+
+    # ----------------------------------------------------------------------- #
+
+    def open(
+        self,
+        result: Tuple[List, Dict, Dict],
+        page_size: int = None,
+        user_id: int = None,
+        truncated: bool = False
+    ) -> Tuple[Tuple[List, Dict, Dict], Dict]:
+        """First page of a query result
+
+        The result is held (as a cursor) only if it has more pages.
+
+        Parameters
+        ----------
+        result : Tuple[List, Dict, Dict]
+            Query result, i.e. matches, nodes and edges
+        page_size : int, optional
+            Number of rows per page.
+            The default is None, i.e. `page_size` of the manager.
+        user_id : int, optional
+            ID of the user the cursor belongs to.
+            The default is None.
+        truncated : bool, optional
+            Whether the result was cut short at `max_rows`.
+            The default is False.
+
+        Returns
+        -------
+        Tuple[Tuple[List, Dict, Dict], Dict]
+            First page (matches, nodes, edges), and cursor information,
+            i.e. cursor (None on the last page), offset, page_size, total
+            and truncated
+        """
+        cursor = QueryCursor(
+            result, page_size or self.page_size,
+            user_id=user_id, truncated=truncated
+        )
+        page = cursor.page(0)
+        if page[1]["cursor"] is not None:
+            with self._lock:
+                self._purge()
+                self._cursors[cursor.id] = cursor
+                self._evict(user_id)
+        return page
+
+    def fetch(
+        self,
+        token: str,
+        user_id: int = None
+    ) -> Tuple[Tuple[List, Dict, Dict], Dict]:
+        """Page of a held result, given its cursor (see `open()`)
+
+        Raises
+        ------
+        QueryCursorError
+            If the cursor is invalid, or has expired
+        """
+        cursor_id, _, offset = (token or "").partition(":")
+        with self._lock:
+            self._purge()
+            cursor = self._cursors.get(cursor_id)
+            if cursor is None or cursor.user_id != user_id:
+                raise QueryCursorError(
+                    "Invalid or expired cursor. Run the query again."
+                )
+            cursor.accessed_at = time.monotonic()
+            self._cursors.move_to_end(cursor_id)
+
+        try:
+            offset = int(offset)
+        except ValueError:
+            offset = -1
+        if not 0 <= offset < cursor.total:
+            raise QueryCursorError("Invalid cursor offset.")
+        return cursor.page(offset)
+
+    def close(self, token: str, user_id: int = None) -> bool:
+        """Drop a held result, given any of its cursors"""
+        cursor_id = (token or "").partition(":")[0]
+        with self._lock:
+            cursor = self._cursors.get(cursor_id)
+            if cursor is None or cursor.user_id != user_id:
+                return False
+            del self._cursors[cursor_id]
+        return True
+
+    def stats(self) -> Dict:
+        """Number of cursors and rows held"""
+        with self._lock:
+            self._purge()
+            return {
+                "cursors": len(self._cursors),
+                "rows": sum(c.total for c in self._cursors.values()),
+                "max_cursors": self.max_cursors,
+                "max_rows": self.max_rows,
+            }
+
+    # ----------------------------------------------------------------------- #
+
+    def _purge(self):
+        """Drop the cursors not accessed for `ttl` seconds"""
+        expired_before = time.monotonic() - self.ttl
+        for cursor_id in [
+            cursor_id
+            for cursor_id, cursor in self._cursors.items()
+            if cursor.accessed_at < expired_before
+        ]:
+            del self._cursors[cursor_id]
+
+    def _evict(self, user_id: int = None):
+        """Drop the least recently used cursors beyond the limits"""
+        user_cursors = [
+            cursor_id
+            for cursor_id, cursor in self._cursors.items()
+            if cursor.user_id == user_id
+        ]
+        for cursor_id in user_cursors[:-self.cursors_per_user or None]:
+            del self._cursors[cursor_id]
+        while len(self._cursors) > self.max_cursors:
+            cursor_id, _ = self._cursors.popitem(last=False)
+            LOGGER.info(f"Dropped query cursor {cursor_id} (limit reached).")
+
+
+query_cursors = QueryCursorManager()
+
+###############################################################################
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asynchronous Query Jobs
+
+Cypher queries submitted as jobs run on a bounded thread pool instead of
+the request thread. The request waits for a short budget (`sync_budget`),
+which is the fast path for quick queries, and otherwise returns the job ID
+at once. The result is then fetched by polling.
+
+Every job query is prefixed with a comment holding a marker unique to the
+job (`// job:<id>`), by which its Neo4j transaction is found and
+terminated,
+* when it runs longer than `timeout` seconds (server-side timeout), or
+* when the user cancels the job.
+(Queued jobs are simply dropped from the pool.)
+Queries which are not run by Neo4j (i.e. by the embedded graph engine) can
+not be terminated this way, and instead stop on their own once the
+`cancelled` event of their job is set, which happens in either case.
+
+Finished jobs are kept for `ttl` seconds. Jobs live in the memory of the
+worker process, so with several worker processes, polling requests must
+reach the same process (e.g. threaded workers or sticky sessions).
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+STATUS_TIMEOUT = "timeout"
+
+FINISHED_STATUSES = [
+    STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED, STATUS_TIMEOUT
+]
+
+DEFAULT_WORKERS = 2
+DEFAULT_TIMEOUT = 120
+DEFAULT_SYNC_BUDGET = 2
+DEFAULT_TTL = 600
+DEFAULT_JOBS_PER_USER = 2
+
+###############################################################################
+
+
+class QueryJobError(Exception):
+    """Job can not be submitted (e.g. too many jobs)"""
+
+
+class QueryJob:
+    """A query running (or waiting to run) on the job pool"""
+
+    def __init__(self, query: str, user_id: int = None):
+        self.id = uuid.uuid4().hex
+        self.query = query
+        self.user_id = user_id
+        self.status = STATUS_QUEUED
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.done = threading.Event()
+        # set when the job is cancelled or times out, for queries which
+        # check it while running (see `utils.cypher_engine`)
+        self.cancelled = threading.Event()
+
+    @property
+    def marker(self) -> str:
+        return f"job:{self.id}"
+
+    @property
+    def marked_query(self) -> str:
+        """Query text with the job marker"""
+        return f"// {self.marker}\n{self.query}"
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self) -> Dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "submitted_at": self.submitted_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class QueryJobManager:
+    """Bounded pool of query jobs, with timeout and cancellation
+
+    Parameters (`init_app()` config)
+    --------------------------------
+    workers : int
+        Number of jobs running at a time
+    timeout : float
+        Seconds after which a running job is terminated
+    sync_budget : float
+        Seconds a request waits for a job to finish
+    ttl : float
+        Seconds for which a finished job is kept
+    jobs_per_user : int
+        Maximum number of unfinished jobs of a user
+    """
+
+    def __init__(self):
+        self.workers = DEFAULT_WORKERS
+        self.timeout = DEFAULT_TIMEOUT
+        self.sync_budget = DEFAULT_SYNC_BUDGET
+        self.ttl = DEFAULT_TTL
+        self.jobs_per_user = DEFAULT_JOBS_PER_USER
+
+        self._executor = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, webapp, config: dict):
+        self.workers = config.get("workers", DEFAULT_WORKERS)
+        self.timeout = config.get("timeout", DEFAULT_TIMEOUT)
+        self.sync_budget = config.get("sync_budget", DEFAULT_SYNC_BUDGET)
+        self.ttl = config.get("ttl", DEFAULT_TTL)
+        self.jobs_per_user = config.get(
+            "jobs_per_user", DEFAULT_JOBS_PER_USER
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="query-job"
+        )
+        webapp.extensions["query_jobs"] = self
+
+    # ----------------------------------------------------------------------- #
+
+    def submit(
+        self,
+        query: str,
+        run: Callable[[QueryJob], Any],
+        terminate: Callable[[str], Any],
+        user_id: int = None
+    ) -> QueryJob:
+        """Submit a query job
+
+        Parameters
+        ----------
+        query : str
+            Cypher query
+        run : Callable[[QueryJob], Any]
+            Function running the job (i.e. `job.marked_query`) and
+            returning its result, stopping early if `job.cancelled` is set
+        terminate : Callable[[str], Any]
+            Function terminating the transactions of a job, given the
+            job marker
+        user_id : int, optional
+            ID of the user submitting the job.
+            The default is None.
+
+        Raises
+        ------
+        QueryJobError
+            If the user already has `jobs_per_user` unfinished jobs
+        """
+        job = QueryJob(query, user_id=user_id)
+        with self._lock:
+            self._purge()
+            active = sum(
+                1 for _job in self._jobs.values()
+                if _job.user_id == user_id and not _job.finished
+            )
+            if active >= self.jobs_per_user:
+                raise QueryJobError(
+                    f"Too many queries running ({active}). "
+                    "Wait for them to finish, or cancel them."
+                )
+            self._jobs[job.id] = job
+            job.future = self._executor.submit(
+                self._run, job, run, terminate
+            )
+        return job
+
+    def wait(self, job: QueryJob, timeout: float = None) -> bool:
+        """Wait for a job to finish (for `sync_budget` seconds by default)"""
+        if timeout is None:
+            timeout = self.sync_budget
+        return job.done.wait(timeout)
+
+    def get(self, job_id: str, user_id: int = None) -> QueryJob:
+        """Job with the given ID (of the given user), or None"""
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    def cancel(
+        self,
+        job_id: str,
+        terminate: Callable[[str], Any],
+        user_id: int = None
+    ) -> QueryJob:
+        """Cancel a job (terminating its transaction, if it is running)"""
+        job = self.get(job_id, user_id=user_id)
+        if job is None or job.finished:
+            return job
+        if job.future.cancel():
+            self._finish(job, STATUS_CANCELLED)
+        elif self._finish(job, STATUS_CANCELLED, terminate=terminate):
+            LOGGER.info(f"Cancelled query job {job.id}.")
+        return job
+
+    # ----------------------------------------------------------------------- #
+
+    def _run(self, job: QueryJob, run: Callable, terminate: Callable):
+        with self._lock:
+            if job.finished:
+                return
+            job.status = STATUS_RUNNING
+            job.started_at = time.time()
+
+        timer = threading.Timer(
+            self.timeout, self._finish, args=(job, STATUS_TIMEOUT),
+            kwargs={"terminate": terminate}
+        )
+        timer.daemon = True
+        timer.start()
+        try:
+            result = run(job)
+        except Exception as e:
+            self._finish(job, STATUS_FAILED, error=str(e))
+        else:
+            self._finish(job, STATUS_DONE, result=result)
+        finally:
+            timer.cancel()
+
+    def _finish(
+        self,
+        job: QueryJob,
+        status: str,
+        result: Any = None,
+        error: str = None,
+        terminate: Callable[[str], Any] = None
+    ) -> bool:
+        """Set the final status of a job, unless it is already finished"""
+        with self._lock:
+            if job.finished:
+                return False
+            job.status = status
+            job.result = result
+            job.error = error
+            if status == STATUS_TIMEOUT:
+                job.error = f"Query timed out after {self.timeout} seconds."
+            job.finished_at = time.time()
+        if status in (STATUS_CANCELLED, STATUS_TIMEOUT):
+            job.cancelled.set()
+        job.done.set()
+
+        if terminate is not None:
+            try:
+                terminate(job.marker)
+            except Exception as e:
+                LOGGER.warning(
+                    f"Could not terminate query job {job.id}. ({e})"
+                )
+        return True
+
+    def _purge(self):
+        """Forget the jobs finished more than `ttl` seconds ago"""
+        expired_before = time.time() - self.ttl
+        for job_id in [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.finished and job.finished_at < expired_before
+        ]:
+            del self._jobs[job_id]
+
+
+query_jobs = QueryJobManager()
+
+###############################################################################
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Routed Sessions
+
+`RoutingSQLAlchemy` is a drop-in replacement of `SQLAlchemy` whose session
+sends every statement to the engine selected for the current context,
+in the order of preference,
+* the engine selected using `use_bind()` (e.g. a corpus shard),
+* the read-only engine, within `read_only()` (if one is configured),
+* the usual bind selection otherwise.
+
+`read_only()` works as a context manager as well as a view decorator,
+
+    @webapp.route("/api/line/<int:line_id>")
+    @read_only()
+    def api_line(line_id):
+        ...
+
+Statements within `read_only()` must not write, as the read-only engine is
+typically a replica or a read-only connection (`mode=ro`) to the database.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+
+from sqlalchemy import orm, create_engine
+from sqlalchemy.engine import Engine
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+
+###############################################################################
+
+_CURRENT_BIND = ContextVar("current_bind", default=None)
+_READ_ONLY = ContextVar("read_only", default=False)
+
+###############################################################################
+
+
+class ReadOnlyEngine:
+    """Optional secondary engine for read-only statements
+
+    Parameters
+    ----------
+    database_uri : str
+        Database URI of the read-only engine. If empty, statements within
+        `read_only()` use the usual engine.
+    engine_options : dict, optional
+        Keyword arguments to `create_engine()`
+    """
+
+    def __init__(self):
+        self.engine = None
+
+    def init_app(self, webapp, config: dict):
+        database_uri = config.get("database_uri")
+        if database_uri:
+            self.engine = create_engine(
+                database_uri, **(config.get("engine_options") or {})
+            )
+        webapp.extensions["read_only_engine"] = self
+
+    @property
+    def enabled(self) -> bool:
+        return self.engine is not None
+
+
+read_only_engine = ReadOnlyEngine()
+
+###############################################################################
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        bind = _CURRENT_BIND.get()
+        if bind is not None:
+            return bind
+        if _READ_ONLY.get() and read_only_engine.enabled:
+            return read_only_engine.engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+###############################################################################
+
+
+def get_current_bind() -> Engine or None:
+    """Engine selected for the current context (None means default)"""
+    return _CURRENT_BIND.get()
+
+
+def set_bind(bind: Engine or None) -> Token:
+    """Select an engine for the current context
+
+    The returned token must be passed to `reset_bind()`.
+    """
+    return _CURRENT_BIND.set(bind)
+
+
+def reset_bind(token: Token):
+    _CURRENT_BIND.reset(token)
+
+
+@contextmanager
+def use_bind(bind: Engine or None):
+    """Send all the statements within the block to `bind`
+
+    If `bind` is None, the default bind selection is used.
+    """
+    token = set_bind(bind)
+    try:
+        yield bind
+    finally:
+        reset_bind(token)
+
+
+@contextmanager
+def read_only():
+    """Send the statements within the block to the read-only engine
+
+    An engine selected using `use_bind()` still takes precedence.
+    Also usable as a decorator, i.e. `@read_only()`.
+    """
+    token = _READ_ONLY.set(True)
+    try:
+        yield
+    finally:
+        _READ_ONLY.reset(token)
+
+###############################################################################
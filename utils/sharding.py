@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-Corpus Database Shards
+
+When sharding is enabled, every new corpus gets a database of its own,
+holding the corpus tables (`Chapter`, `Verse`, `Line`, `Analysis`) and the
+annotation tables (`Node`, `Relation`, ...) of that corpus. The shared
+tables (users, roles, labels, lexicon, change log, `Corpus` itself) remain
+in the main database. Corpora created before sharding was enabled remain
+in the main database as well.
+
+Routing
+-------
+Row IDs of the corpus with ID `c` are allocated from the range
+`[c * id_span, (c + 1) * id_span)`, so the shard of any chapter, verse,
+line, node or relation is `id // id_span` (0 means the main database).
+IDs in the main database must therefore stay below `id_span`.
+
+While a shard is in use (`use_shard()`), *every* statement of the session
+is sent to the shard engine, over a single connection. The shared tables
+are visible on that connection, so joins across shared and corpus tables
+and transactions spanning both keep working,
+* SQLite: the main database is attached to every shard connection,
+* PostgreSQL: a shard is a schema of the main database, placed before the
+  shared schema in the `search_path` of the shard URI, e.g.
+  `postgresql://.../db?options=-csearch_path%3Dcorpus_{corpus_id},public`
+
+Shard tables are created without the foreign keys to the shared tables,
+as SQLite does not support foreign keys across databases.
+MySQL is not supported for shards.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+from sqlalchemy import MetaData, create_engine, event, select, text
+from sqlalchemy.engine import Engine
+
+from models_sqla import (db, CorpusShard, Chapter, Verse, Line, Analysis,
+                         Node, Relation, Action, NodeArchive, RelationArchive,
+                         Concordance, IntegrityIssue)
+from utils.routing import use_bind
+from utils.sqlite import apply_sqlite_profile
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+SHARDED_MODELS = [
+    Chapter, Verse, Line, Analysis,
+    Node, Relation, Action, NodeArchive, RelationArchive,
+    Concordance, IntegrityIssue,
+]
+
+# Alias of the main database on SQLite shard connections
+SHARED_DATABASE_ALIAS = "shared"
+
+# Request parameters used to identify the shard of a request
+REQUEST_ID_KEYS = [
+    "chapter_id", "verse_id", "line_id", "node_id", "relation_id",
+    "old_node_id",
+]
+REQUEST_CORPUS_KEY = "corpus_id"
+
+###############################################################################
+
+
+def shard_metadata() -> MetaData:
+    """Metadata of the tables in a shard
+
+    Copies of the sharded tables, without the foreign keys to the shared
+    tables, and with AUTOINCREMENT on SQLite (so that the ID ranges set by
+    `ShardManager.create_shard()` are respected).
+    """
+    metadata = MetaData()
+    for model in SHARDED_MODELS:
+        model.__table__.to_metadata(metadata)
+
+    for table in metadata.tables.values():
+        for constraint in list(table.foreign_key_constraints):
+            referred_table_name = constraint.elements[0].target_fullname
+            if referred_table_name.split(".")[0] in metadata.tables:
+                continue
+            table.constraints.discard(constraint)
+            for element in constraint.elements:
+                element.parent.foreign_keys.discard(element)
+                table.foreign_keys.discard(element)
+        table.dialect_options["sqlite"]["autoincrement"] = True
+    return metadata
+
+###############################################################################
+
+
+class ShardManager:
+    """Shard registry, engines and routing
+
+    Parameters
+    ----------
+    enabled : bool
+        If False, everything stays in the main database.
+    uri_template : str
+        Database URI of a shard, formatted with `corpus_id`
+    id_span : int
+        Size of the ID range of a corpus
+    schema_template : str, optional
+        PostgreSQL schema of a shard, formatted with `corpus_id`,
+        created if it does not exist.
+    engine_options : dict, optional
+        Keyword arguments to `create_engine()` for shard engines
+    sqlite_pragmas : dict, optional
+        PRAGMAs for SQLite shards (see `utils.sqlite.apply_sqlite_profile`)
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.uri_template = None
+        self.id_span = None
+        self.schema_template = None
+        self.engine_options = {}
+        self.sqlite_pragmas = {}
+        self._engines = {}
+        self._corpus_ids = set()
+        self._lock = threading.Lock()
+
+    def init_app(self, webapp, config: Dict, sqlite_pragmas: Dict = None):
+        self.enabled = bool(config.get("enabled"))
+        self.uri_template = config.get("uri_template")
+        self.id_span = int(config.get("id_span") or 10_000_000)
+        self.schema_template = config.get("schema_template") or None
+        self.engine_options = config.get("engine_options") or {}
+        self.sqlite_pragmas = sqlite_pragmas or {}
+        webapp.extensions["shards"] = self
+
+    # ----------------------------------------------------------------------- #
+    # Registry
+
+    def _load_registry(self):
+        with db.engine.connect() as connection:
+            self._corpus_ids = {
+                corpus_id
+                for corpus_id, in connection.execute(
+                    select(CorpusShard.corpus_id)
+                )
+            }
+
+    def is_sharded(self, corpus_id: int) -> bool:
+        """True if the corpus is stored in a shard"""
+        if not self.enabled or corpus_id is None:
+            return False
+        corpus_id = int(corpus_id)
+        if corpus_id not in self._corpus_ids:
+            self._load_registry()
+        return corpus_id in self._corpus_ids
+
+    def corpus_ids(self) -> List[int]:
+        """IDs of the corpora stored in shards"""
+        if not self.enabled:
+            return []
+        self._load_registry()
+        return sorted(self._corpus_ids)
+
+    # ----------------------------------------------------------------------- #
+    # Engines
+
+    def _attach_shared_database(self, engine: Engine):
+        main_url = db.engine.url
+        if main_url.get_backend_name() != "sqlite":
+            raise ValueError(
+                "SQLite shards require an SQLite main database."
+            )
+
+        @event.listens_for(engine, "connect")
+        def attach_shared_database(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(
+                f"ATTACH DATABASE ? AS {SHARED_DATABASE_ALIAS}",
+                (main_url.database,)
+            )
+            cursor.close()
+
+    def get_engine(self, corpus_id: int) -> Engine:
+        """Engine of the shard of a corpus"""
+        corpus_id = int(corpus_id)
+        with self._lock:
+            if corpus_id not in self._engines:
+                uri = self.uri_template.format(corpus_id=corpus_id)
+                engine = create_engine(uri, **self.engine_options)
+                if engine.url.get_backend_name() == "sqlite":
+                    self._attach_shared_database(engine)
+                    apply_sqlite_profile(engine, self.sqlite_pragmas)
+                self._engines[corpus_id] = engine
+            return self._engines[corpus_id]
+
+    # ----------------------------------------------------------------------- #
+    # Routing
+
+    def shard_of(self, entity_id: int) -> int or None:
+        """Corpus ID of the shard containing a row (None if main database)"""
+        if not self.enabled or entity_id is None:
+            return None
+        corpus_id = int(entity_id) // self.id_span
+        return corpus_id or None
+
+    def shard_of_request(self, request) -> int or None:
+        """Corpus ID of the shard addressed by a request
+
+        Looks for the IDs in `REQUEST_ID_KEYS` (or a `corpus_id`) in the view
+        arguments, query parameters and form data, in that order.
+        """
+        if not self.enabled:
+            return None
+        sources = [request.view_args or {}, request.args, request.form]
+        for source in sources:
+            for key in REQUEST_ID_KEYS:
+                try:
+                    entity_id = int(source.get(key))
+                except (TypeError, ValueError):
+                    continue
+                return self.shard_of(entity_id)
+
+        for source in sources:
+            try:
+                corpus_id = int(source.get(REQUEST_CORPUS_KEY))
+            except (TypeError, ValueError):
+                continue
+            return corpus_id if self.is_sharded(corpus_id) else None
+        return None
+
+    @contextmanager
+    def use_shard(self, corpus_id: int or None):
+        """Send all the statements within the block to the shard
+
+        If `corpus_id` is None, the main database is used.
+        """
+        engine = None
+        if self.enabled and corpus_id is not None:
+            engine = self.get_engine(corpus_id)
+        with use_bind(engine):
+            yield engine
+
+    @contextmanager
+    def use_corpus(self, corpus_id: int):
+        """`use_shard()` for a corpus, which may or may not be sharded"""
+        shard_id = corpus_id if self.is_sharded(corpus_id) else None
+        with self.use_shard(shard_id):
+            yield
+
+    def iter_shards(self) -> List[int or None]:
+        """Main database (None) followed by every shard"""
+        return [None] + self.corpus_ids()
+
+    def partition(self, entity_ids: Iterable[int]) -> Dict[int, List[int]]:
+        """Group row IDs by shard (None for the main database)"""
+        partitions = {}
+        for entity_id in entity_ids:
+            partitions.setdefault(
+                self.shard_of(entity_id), []
+            ).append(entity_id)
+        return partitions
+
+    # ----------------------------------------------------------------------- #
+    # Shard Creation
+
+    def create_shard(self, corpus_id: int) -> Engine:
+        """Create the shard database of a corpus and register it
+
+        Tables are created (if they do not exist) and their ID sequences are
+        moved to the start of the ID range of the corpus.
+        """
+        if not self.enabled:
+            raise ValueError("Sharding is not enabled.")
+
+        corpus_id = int(corpus_id)
+        if corpus_id * self.id_span > 2 ** 31 - 1:
+            LOGGER.warning(
+                f"IDs of corpus {corpus_id} exceed 32-bit integer range."
+            )
+
+        engine = self.get_engine(corpus_id)
+        metadata = shard_metadata()
+        id_start = corpus_id * self.id_span
+        with engine.begin() as connection:
+            backend = connection.dialect.name
+            if backend == "postgresql" and self.schema_template:
+                schema = self.schema_template.format(corpus_id=corpus_id)
+                preparer = connection.dialect.identifier_preparer
+                connection.execute(text(
+                    f"CREATE SCHEMA IF NOT EXISTS {preparer.quote(schema)}"
+                ))
+
+            metadata.create_all(connection)
+            for table in metadata.sorted_tables:
+                if backend == "sqlite":
+                    connection.execute(
+                        text("DELETE FROM main.sqlite_sequence "
+                             "WHERE name = :name"),
+                        {"name": table.name}
+                    )
+                    connection.execute(
+                        text("INSERT INTO main.sqlite_sequence (name, seq) "
+                             "SELECT :name, :seq WHERE NOT EXISTS "
+                             f"(SELECT 1 FROM main.{table.name})"),
+                        {"name": table.name, "seq": id_start}
+                    )
+                elif backend == "postgresql":
+                    connection.execute(
+                        text("SELECT setval("
+                             "pg_get_serial_sequence(:name, 'id'), :seq) "
+                             f"WHERE NOT EXISTS (SELECT 1 FROM {table.name})"),
+                        {"name": table.name, "seq": id_start}
+                    )
+
+        if not self.is_sharded(corpus_id):
+            db.session.add(CorpusShard(corpus_id=corpus_id))
+            db.session.commit()
+            self._corpus_ids.add(corpus_id)
+        LOGGER.info(f"Created shard for corpus {corpus_id}.")
+        return engine
+
+###############################################################################
+
+
+shards = ShardManager()
+
+###############################################################################
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SQLite Production Profile
+
+PRAGMAs applied to every new connection of an SQLite engine,
+* journal_mode=WAL: readers do not block the writer (and vice versa),
+* synchronous=NORMAL: no fsync on every commit (safe in WAL mode),
+* busy_timeout: wait for locks instead of failing immediately,
+* cache_size, mmap_size: page cache and memory-mapped I/O, either fixed
+  or 'auto', in which case they are sized from the database file size,
+* temp_store=MEMORY: temporary tables and indices in memory.
+
+`PRAGMA optimize` is run on every profiled engine at interpreter exit.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import os
+import atexit
+import logging
+import weakref
+from typing import Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+PRODUCTION_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "cache_size": "auto",
+    "mmap_size": "auto",
+    "temp_store": "MEMORY",
+}
+
+SQLITE_PROFILES = {
+    "default": {},
+    "production": PRODUCTION_PRAGMAS,
+}
+
+MiB = 1024 * 1024
+
+# Bounds of the 'auto' sizes (in bytes)
+AUTO_CACHE_SIZE = (16 * MiB, 256 * MiB)
+AUTO_MMAP_SIZE = (64 * MiB, 1024 * MiB)
+
+# PRAGMAs which require write access to the database
+WRITE_PRAGMAS = ["journal_mode"]
+
+_OPTIMIZE_ENGINES = weakref.WeakSet()
+
+###############################################################################
+
+
+def _clamp(value: int, bounds) -> int:
+    return max(bounds[0], min(value, bounds[1]))
+
+
+def resolve_pragmas(pragmas: Dict, database_path: str = None) -> Dict:
+    """Resolve 'auto' values of `cache_size` and `mmap_size`
+
+    The page cache is sized to a quarter of the database and memory-mapped
+    I/O to twice the database (to leave room for growth), within bounds.
+    `cache_size` is returned as a negative value, i.e. in KiB.
+    """
+    database_size = 0
+    if database_path and os.path.isfile(database_path):
+        database_size = os.path.getsize(database_path)
+
+    resolved = dict(pragmas)
+    if resolved.get("cache_size") == "auto":
+        cache_size = _clamp(database_size // 4, AUTO_CACHE_SIZE)
+        resolved["cache_size"] = -(cache_size // 1024)
+    if resolved.get("mmap_size") == "auto":
+        resolved["mmap_size"] = _clamp(database_size * 2, AUTO_MMAP_SIZE)
+    return resolved
+
+
+def get_profile_pragmas(profile: str, overrides: Dict = None) -> Dict:
+    """PRAGMAs of a profile from `SQLITE_PROFILES`, with overrides"""
+    if profile not in SQLITE_PROFILES:
+        raise ValueError(f"Invalid SQLite profile: '{profile}'")
+    return {**SQLITE_PROFILES[profile], **(overrides or {})}
+
+
+def apply_sqlite_profile(
+    engine: Engine,
+    pragmas: Dict = None,
+    read_only: bool = False,
+    optimize: bool = True
+) -> Dict:
+    """Apply PRAGMAs to every new connection of an SQLite engine
+
+    Parameters
+    ----------
+    engine : Engine
+        SQLAlchemy engine. Engines of other backends are left untouched.
+    pragmas : dict, optional
+        PRAGMA names and values.
+        If None, `PRODUCTION_PRAGMAS` are used.
+        The default is None.
+    read_only : bool, optional
+        If True, PRAGMAs requiring write access are skipped.
+        The default is False.
+    optimize : bool, optional
+        If True, run `PRAGMA optimize` on the engine at interpreter exit.
+        The default is True.
+
+    Returns
+    -------
+    dict
+        Resolved PRAGMAs
+    """
+    if engine.url.get_backend_name() != "sqlite":
+        return {}
+
+    if pragmas is None:
+        pragmas = PRODUCTION_PRAGMAS
+    pragmas = resolve_pragmas(pragmas, engine.url.database)
+    if read_only:
+        pragmas = {
+            name: value
+            for name, value in pragmas.items()
+            if name not in WRITE_PRAGMAS
+        }
+
+    @event.listens_for(engine, "connect")
+    def set_profile_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    if optimize and not read_only:
+        _OPTIMIZE_ENGINES.add(engine)
+
+    LOGGER.info(f"SQLite profile for {engine.url.database}: {pragmas}")
+    return pragmas
+
+###############################################################################
+
+
+def optimize_database(engine: Engine):
+    """Run `PRAGMA optimize` (updates query planner statistics if needed)"""
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA optimize")
+
+
+@atexit.register
+def _optimize_on_exit():
+    for engine in list(_OPTIMIZE_ENGINES):
+        try:
+            optimize_database(engine)
+        except Exception as e:
+            LOGGER.warning(f"PRAGMA optimize failed ({engine.url}): {e}")
+
+###############################################################################
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lexicon Transliteration
+
+`Lexicon.transliteration` holds the searchable transliterations of a lemma
+in every configured scheme (`app.config['schemes']`), each prefixed by `##`.
+
+* `get_transliteration()` is memoised, since the same lemmas recur across
+  requests (node suggestions, lexicon updates, bulk imports).
+* `retransliterate_lexicon()` recomputes the column for the whole table,
+  e.g. after the configured schemes have changed. Lemmas are transliterated
+  in chunks on a process pool and changed rows are written back in batches.
+  Progress is saved to a checkpoint file after every batch, so that an
+  interrupted job resumes where it stopped. Rows which already have the
+  correct value are not written, so running the job again is harmless.
+  A row is written only if its lemma is still the one transliterated, so
+  that a lemma renamed meanwhile keeps the transliteration set with it.
+
+@author: Hrishikesh Terdalkar
+"""
+
+###############################################################################
+
+import os
+import json
+import logging
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import bindparam, select, update
+from indic_transliteration.sanscript import transliterate
+
+from models_sqla import db, Lexicon
+from utils.bulk import fetch_in
+from utils.changelog import log_changes, ENTITY_LEXICON, OPERATION_UPDATE
+
+###############################################################################
+
+LOGGER = logging.getLogger(__name__)
+
+###############################################################################
+
+# Number of lexicon entries transliterated by a worker in one task
+CHUNK_SIZE = 1000
+
+# Number of chunks written back (and checkpointed) in one transaction
+CHUNKS_PER_BATCH = 10
+
+# Size of the cache of `get_transliteration()`
+CACHE_SIZE = 65536
+
+###############################################################################
+
+
+def make_transliteration(
+    lemma: str, schemes: Tuple[str], unnamed_prefix: str
+) -> str:
+    """Searchable transliterations of a lemma (`Lexicon.transliteration`)
+
+    Lemmas of unnamed entities (starting with `unnamed_prefix`) are not
+    transliterated, and result in an empty string.
+    """
+    if lemma.startswith(unnamed_prefix):
+        return ''
+    return ''.join(
+        f"##{transliterate(lemma, 'devanagari', scheme)}"
+        for scheme in schemes
+    )
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def get_transliteration(
+    lemma: str, schemes: Tuple[str], unnamed_prefix: str
+) -> str:
+    """Memoised `make_transliteration()`
+
+    `schemes` must be a tuple (hashable), and being a part of the key,
+    changing the configured schemes does not return stale values.
+    """
+    return make_transliteration(lemma, schemes, unnamed_prefix)
+
+###############################################################################
+
+
+def _transliterate_chunk(
+    rows: List[Tuple[int, str]], schemes: Tuple[str], unnamed_prefix: str
+) -> List[Tuple[int, str]]:
+    """(id, transliteration) of (id, lemma) rows (run in a worker process)"""
+    return [
+        (lexicon_id, make_transliteration(lemma, schemes, unnamed_prefix))
+        for lexicon_id, lemma in rows
+    ]
+
+
+def _read_chunks(
+    start_id: int, chunk_size: int
+) -> Iterable[List[Tuple[int, str, str]]]:
+    """(id, lemma, transliteration) rows with `id > start_id`, in chunks
+
+    Uses keyset pagination, i.e. every chunk is a separate indexed query,
+    so that writes in between do not invalidate an open cursor.
+    """
+    last_id = start_id
+    while True:
+        rows = db.session.execute(
+            select(Lexicon.id, Lexicon.lemma, Lexicon.transliteration)
+            .where(Lexicon.id > last_id)
+            .order_by(Lexicon.id)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _load_checkpoint(checkpoint_path: str, job: Dict) -> Dict:
+    """Saved progress of the same job, if any"""
+    if checkpoint_path is None or not os.path.isfile(checkpoint_path):
+        return None
+    try:
+        with open(checkpoint_path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError) as e:
+        LOGGER.warning(f"Ignoring unreadable checkpoint: {e}")
+        return None
+
+    if checkpoint.get("job") != job:
+        LOGGER.info("Checkpoint belongs to a different job, starting over.")
+        return None
+    return checkpoint
+
+
+def _save_checkpoint(checkpoint_path: str, checkpoint: Dict):
+    if checkpoint_path is None:
+        return
+    temp_path = f"{checkpoint_path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_path, checkpoint_path)
+
+
+def _write_batch(changes: List[Tuple[int, str, str, str]]) -> int:
+    """Write changed transliterations and log them, in one transaction
+
+    `changes` are (id, lemma, old, new) tuples, where `lemma` is the lemma
+    which was transliterated. Entries whose lemma has changed since are
+    skipped, and only the entries actually updated are logged.
+    """
+    updated = []
+    if changes:
+        table = Lexicon.__table__
+        db.session.execute(
+            update(table)
+            .where(
+                table.c.id == bindparam("_id"),
+                table.c.lemma == bindparam("_lemma")
+            )
+            .values(transliteration=bindparam("_transliteration")),
+            [
+                {"_id": lexicon_id, "_lemma": lemma, "_transliteration": new}
+                for lexicon_id, lemma, _, new in changes
+            ]
+        )
+        current = {
+            lexicon_id: transliteration
+            for lexicon_id, _, transliteration in fetch_in(
+                [Lexicon.id, Lexicon.lemma, Lexicon.transliteration],
+                [(lexicon_id, lemma) for lexicon_id, lemma, _, _ in changes]
+            )
+        }
+        updated = [
+            (lexicon_id, old, new)
+            for lexicon_id, _, old, new in changes
+            if lexicon_id in current and current[lexicon_id] == new
+        ]
+        log_changes(ENTITY_LEXICON, OPERATION_UPDATE, [
+            (lexicon_id, {"transliteration": old}, {"transliteration": new})
+            for lexicon_id, old, new in updated
+        ])
+    db.session.commit()
+    return len(updated)
+
+
+def retransliterate_lexicon(
+    schemes: Iterable[str],
+    unnamed_prefix: str,
+    checkpoint_path: str = None,
+    chunk_size: int = CHUNK_SIZE,
+    chunks_per_batch: int = CHUNKS_PER_BATCH,
+    workers: int = None,
+) -> Dict:
+    """Recompute `Lexicon.transliteration` for every lexicon entry
+
+    Parameters
+    ----------
+    schemes : Iterable[str]
+        Transliteration schemes (`app.config['schemes']`)
+    unnamed_prefix : str
+        Prefix of the lemmas of unnamed entities
+        (`app.config['unnamed_prefix']`)
+    checkpoint_path : str, optional
+        File to save the progress to after every batch.
+        If the file holds the progress of the same job (same schemes and
+        prefix), the job resumes from there. It is removed on completion.
+        If None, the job is not resumable.
+        The default is None.
+    chunk_size : int, optional
+        Number of entries transliterated by a worker in one task.
+        The default is CHUNK_SIZE.
+    chunks_per_batch : int, optional
+        Number of chunks written back in one transaction.
+        The default is CHUNKS_PER_BATCH.
+    workers : int, optional
+        Number of worker processes.
+        If None, the number of processors is used.
+        The default is None.
+
+    Returns
+    -------
+    dict
+        Counts of `checked` and `updated` entries (including the ones
+        processed before resuming) and `resumed_from` (lexicon ID)
+    """
+    schemes = tuple(schemes)
+    job = {"schemes": list(schemes), "unnamed_prefix": unnamed_prefix}
+    checkpoint = _load_checkpoint(checkpoint_path, job) or {
+        "job": job, "last_id": 0, "checked": 0, "updated": 0
+    }
+    resumed_from = checkpoint["last_id"]
+    if resumed_from:
+        LOGGER.info(f"Resuming re-transliteration after lexicon "
+                    f"{resumed_from} ({checkpoint['checked']} checked).")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+
+        def flush():
+            # Results are consumed in submission order, so `last_id`
+            # only advances past rows that have been written
+            changes = []
+            for chunk, future in pending:
+                current = {
+                    lexicon_id: (lemma, transliteration)
+                    for lexicon_id, lemma, transliteration in chunk
+                }
+                for lexicon_id, transliteration in future.result():
+                    lemma, old = current[lexicon_id]
+                    if (old or '') != transliteration:
+                        changes.append(
+                            (lexicon_id, lemma, old, transliteration or None)
+                        )
+                checkpoint["checked"] += len(chunk)
+                checkpoint["last_id"] = chunk[-1][0]
+            checkpoint["updated"] += _write_batch(changes)
+            _save_checkpoint(checkpoint_path, checkpoint)
+            pending.clear()
+            LOGGER.info(f"Re-transliterated up to lexicon "
+                        f"{checkpoint['last_id']} "
+                        f"({checkpoint['updated']} updated).")
+
+        for chunk in _read_chunks(checkpoint["last_id"], chunk_size):
+            rows = [(lexicon_id, lemma) for lexicon_id, lemma, _ in chunk]
+            pending.append((
+                chunk,
+                executor.submit(
+                    _transliterate_chunk, rows, schemes, unnamed_prefix
+                )
+            ))
+            if len(pending) >= chunks_per_batch:
+                flush()
+        if pending:
+            flush()
+
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    get_transliteration.cache_clear()
+    return {
+        "checked": checkpoint["checked"],
+        "updated": checkpoint["updated"],
+        "resumed_from": resumed_from,
+    }
+
+###############################################################################